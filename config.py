@@ -2,4 +2,160 @@
 
 DATASET_NAME = "kixlab/CUPID"
 PREFMATCHER_MODEL_NAME = "kixlab/prefmatcher-7b" 
-VLLM_HOST = "http://localhost:8000"
\ No newline at end of file
+VLLM_HOST = "http://localhost:8000"
+
+# Maximum number of concurrent in-flight requests per provider for the async generation path
+PROVIDER_CONCURRENCY = {
+    "openai": 64,
+    "anthropic": 32,
+    "anthropic_bedrock": 32,
+    "together": 32,
+    "gemini": 32,
+    "vllm": 128
+}
+
+# Persistent cache for deterministic LLM responses (opt-in per Generator)
+RESPONSE_CACHE_PATH = ".cache/cupid_responses.sqlite"
+RESPONSE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Hits, misses and access times are buffered per process and written at most this often (seconds)
+RESPONSE_CACHE_FLUSH_INTERVAL = 5
+
+# Shared rate limits (requests/min and tokens/min), keyed by provider or model name.
+# Keys without an entry are not limited. Limits are enforced across all worker processes.
+RATE_LIMIT_PATH = ".cache/cupid_rate_limits.sqlite"
+RATE_LIMIT_MAX_RETRIES = 6
+RATE_LIMITS = {
+    "gpt-4o-2024-11-20": {"rpm": 10000, "tpm": 2000000},
+    "gpt-4.1-nano-2025-04-14": {"rpm": 10000, "tpm": 10000000},
+    "anthropic": {"rpm": 4000, "tpm": 400000},
+    "anthropic_bedrock": {"rpm": 250, "tpm": 2000000},
+    "together": {"rpm": 600, "tpm": 180000}
+}
+
+# Models discovered by `python -m utils.providers --refresh`, merged with the static model lists
+MODEL_REGISTRY_PATH = ".cache/cupid_models.json"
+
+# Prices in USD per 1M tokens, used for usage cost estimates.
+# Prompt-cache reads and writes are billed at the input price unless "cache_read"/"cache_write" are given.
+MODEL_PRICES = {
+    "gpt-4o-2024-11-20": {"input": 2.5, "output": 10.0, "cache_read": 1.25},
+    "gpt-4o-mini": {"input": 0.15, "output": 0.6, "cache_read": 0.075},
+    "gpt-4.1-nano-2025-04-14": {"input": 0.1, "output": 0.4, "cache_read": 0.025},
+    "claude-3-7-sonnet-20250219": {"input": 3.0, "output": 15.0, "cache_read": 0.3, "cache_write": 3.75},
+    "claude-3-5-sonnet-20241022": {"input": 3.0, "output": 15.0, "cache_read": 0.3, "cache_write": 3.75},
+    "claude-3-5-haiku-20241022": {"input": 0.8, "output": 4.0, "cache_read": 0.08, "cache_write": 1.0},
+    "us.anthropic.claude-3-7-sonnet-20250219-v1:0": {"input": 3.0, "output": 15.0, "cache_read": 0.3, "cache_write": 3.75},
+    "anthropic.claude-3-5-sonnet-20241022-v2:0": {"input": 3.0, "output": 15.0},
+    "anthropic.claude-3-5-haiku-20241022-v1:0": {"input": 0.8, "output": 4.0, "cache_read": 0.08, "cache_write": 1.0},
+    "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": {"input": 0.18, "output": 0.18},
+    "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": {"input": 0.88, "output": 0.88},
+    "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo": {"input": 3.5, "output": 3.5},
+    "kixlab/prefmatcher-7b": {"input": 0.0, "output": 0.0}
+}
+
+# Provider batch APIs bill tokens at this fraction of the listed price
+BATCH_PRICE_FACTOR = 0.5
+
+# Shared state for deduplicating identical in-flight deterministic requests across processes
+SINGLEFLIGHT_PATH = ".cache/cupid_singleflight.sqlite"
+SINGLEFLIGHT_LEASE_SECONDS = 900
+SINGLEFLIGHT_LINGER_SECONDS = 30
+
+# Anthropic prompt caching: cache breakpoints on the stable system prompt prefix and the chat history.
+# Bedrock only accepts cache breakpoints for the models listed here.
+ANTHROPIC_PROMPT_CACHING = True
+BEDROCK_PROMPT_CACHING_MODELS = [
+    "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
+    "anthropic.claude-3-5-haiku-20241022-v1:0"
+]
+
+# Shared HTTP connection pool for all provider clients in a process
+HTTP_MAX_CONNECTIONS = 256
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 128
+HTTP_KEEPALIVE_EXPIRY = 300
+HTTP2 = True
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 600
+
+# Per-call deadline, and hedging: a call still running after the HEDGE_PERCENTILE of the model's
+# recent latencies (rolling window of HEDGE_WINDOW calls per process) gets a duplicate request
+REQUEST_DEADLINE_SECONDS = 300
+REQUEST_DEADLINE_RETRIES = 2
+HEDGING = True
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+
+# Logical models served by several (provider, model) endpoints; requests are spread across the
+# endpoints with credentials and fail over between them. Models not listed use MODEL_DICTIONARY.
+MODEL_ROUTES = {
+    "claude-3-7-sonnet-20250219": [
+        ["anthropic", "claude-3-7-sonnet-20250219"],
+        ["anthropic_bedrock", "us.anthropic.claude-3-7-sonnet-20250219-v1:0"]
+    ],
+    "claude-3-5-sonnet-20241022": [
+        ["anthropic", "claude-3-5-sonnet-20241022"],
+        ["anthropic_bedrock", "anthropic.claude-3-5-sonnet-20241022-v2:0"]
+    ],
+    "claude-3-5-haiku-20241022": [
+        ["anthropic", "claude-3-5-haiku-20241022"],
+        ["anthropic_bedrock", "anthropic.claude-3-5-haiku-20241022-v1:0"]
+    ],
+}
+ROUTER_PATH = ".cache/cupid_router.sqlite"
+# An endpoint is skipped for CIRCUIT_BREAKER_COOLDOWN seconds after this many consecutive failures
+CIRCUIT_BREAKER_FAILURES = 5
+CIRCUIT_BREAKER_COOLDOWN = 60
+
+# Context windows in tokens, matched by longest model-name prefix. Prompts are checked against them
+# before sending; CONTEXT_WINDOW_MARGIN of each window is held back for tokenizer differences.
+CONTEXT_WINDOW_MARGIN = 0.05
+CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "o1": 200000,
+    "o1-mini": 128000,
+    "o3": 200000,
+    "o4-mini": 200000,
+    "claude-3": 200000,
+    "us.anthropic.claude-3": 200000,
+    "anthropic.claude-3": 200000,
+    "meta-llama/Meta-Llama-3.1": 131072,
+    "meta-llama/Meta-Llama-3-": 8192,
+    "mistralai/Mixtral-8x7B": 32768,
+    "mistralai/Mixtral-8x22B": 65536,
+    "mistralai/Mistral-7B-Instruct-v0.3": 32768,
+    "deepseek-ai/DeepSeek-R1": 163840,
+    "Qwen/Qwen2.5-72B": 32768,
+    "gemini-2.0": 1048576,
+}
+
+# Seconds a replayed rate-limit error asks the caller to wait (see utils.replay)
+REPLAY_RETRY_AFTER = 1
+
+# Instances evaluated concurrently by the asyncio driver (evaluation/run.py --async_driver)
+EVALUATION_CONCURRENCY = 64
+
+# (model, instance) references handed to a Pool worker at a time by evaluate_parallel; instances take
+# seconds each, so small chunks keep the workers evenly loaded while still batching the IPC
+POOL_CHUNK_SIZE = 4
+
+# Pipelined evaluation scheduler (evaluation/run.py --pipelined): workers per stage, and an optional
+# budget of stage tasks started per minute (None for no budget), shared by all processes using RATE_LIMIT_PATH
+PIPELINE_STAGES = {
+    "inference": {"concurrency": 32, "rpm": None},
+    "matching": {"concurrency": 32, "rpm": None},
+    "generation": {"concurrency": 32, "rpm": None},
+    "judging": {"concurrency": 32, "rpm": None},
+}
+# Instances waiting in front of each stage before the stage upstream of it stalls
+PIPELINE_QUEUE_SIZE = 64
+# Seconds between progress reports of the pipelined scheduler
+PIPELINE_REPORT_INTERVAL = 30
+
+# Seconds between live status reports (running metrics, progress, ETA) written to <results_dir>/<model>/status.json
+STATUS_INTERVAL = 30
+
+# Bootstrap resamples and confidence level of the confidence intervals in results.json (0 resamples disables them)
+BOOTSTRAP_RESAMPLES = 1000
+BOOTSTRAP_CONFIDENCE = 0.95
@@ -2,14 +2,11 @@
 GPT-4.1 Nano model wrapper for evaluation pipeline.
 Implements the Model interface and registers itself for use.
 """
-import os
-import openai
 import logging
 from evaluation.models.model import Model, register_model
+from utils.generation import generate_chat
+from utils.async_generation import agenerate_chat
 
-openai_client = openai.Client(
-    api_key=os.environ.get("OPENAI_API_KEY")
-)
 logger = logging.getLogger(__name__)
 
 @register_model
@@ -18,22 +15,41 @@ class GPT41Nano(Model):
     Model wrapper for OpenAI GPT-4.1 Nano.
     """
     model_name = "gpt-4.1-nano-2025-04-14"
+    supports_early_stop = True
+    max_tokens = 8192
 
-    def __call__(self, system_prompt, user_prompt):
+    def __call__(self, system_prompt, user_prompt, until=None):
         """
         Generate a response from the model given system and user prompts.
         """
         try:
-            response = openai_client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
+            response = generate_chat(
+                self.model_name,
+                system_prompt,
+                [{"role": "user", "content": user_prompt}],
                 temperature=0,
-                max_tokens=8192
+                max_tokens=self.max_tokens,
+                until=until
             )
-            return response.choices[0].message.content.strip()
+            return response.strip()
         except Exception as e:
             logger.error(f"Error during OpenAI API call: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    async def acall(self, system_prompt, user_prompt, until=None):
+        """
+        Coroutine counterpart of __call__.
+        """
+        try:
+            response = await agenerate_chat(
+                self.model_name,
+                system_prompt,
+                [{"role": "user", "content": user_prompt}],
+                temperature=0,
+                max_tokens=self.max_tokens,
+                until=until
+            )
+            return response.strip()
+        except Exception as e:
+            logger.error(f"Error during OpenAI API call: {e}")
+            raise
@@ -2,6 +2,7 @@
 Model registry and base class for models to evaluate.
 Provides registration and lookup utilities for model classes.
 """
+import asyncio
 import pkgutil
 import importlib
 import os
@@ -27,13 +28,27 @@ class Model:
     """
     Base class for all evaluation models.
     Subclasses should implement the __call__ method.
+    Models that set supports_early_stop accept an `until` keyword in __call__: a predicate on the
+    output so far, after which generation may stop (see utils.generation.generate).
+    max_tokens is the completion budget held back when prompts are fitted to the context window
+    listed for model_name in CONTEXT_WINDOWS.
     """
+    supports_early_stop = False
+    max_tokens = None
+
     def __init__(self):
         pass
 
     def __call__(self, system_prompt, user_prompt):
         pass
 
+    async def acall(self, system_prompt, user_prompt, **kwargs):
+        """
+        Coroutine counterpart of __call__, used by the asyncio evaluation driver.
+        Runs __call__ in a worker thread unless a subclass provides a native implementation.
+        """
+        return await asyncio.to_thread(self, system_prompt, user_prompt, **kwargs)
+
 # Lookup function for model class by model_name
 
 def get_model_class(model_name):
@@ -2,54 +2,130 @@
 Module for inferring user preferences from interaction logs during evaluation.
 Uses prompt templates and a preference decomposer for checklist extraction.
 """
-import yaml
-from importlib import resources
-from utils import format_interaction_log
+import asyncio
+import contextvars
+from utils.prompts import get_prompt
+from utils.tokens import fit_interaction_log
 from synthesis.modules import PreferenceDecomposer
 import logging
 
 logger = logging.getLogger(__name__)
 
+PREFERENCE_HEADER = "### Most Likely Preference"
+
+# The fit of the last prompt built in this thread or task, so that a shared inferrer can serve concurrent instances
+_context_fit = contextvars.ContextVar("preference_inferrer_context_fit", default=None)
+
+def preference_complete(output):
+    """
+    Return True once the output holds the full line after the most likely preference header,
+    which is all that process_output keeps.
+    """
+    if PREFERENCE_HEADER not in output:
+        return False
+    return "\n" in output.split(PREFERENCE_HEADER, 1)[1].lstrip()
+
 class PreferenceInferrer:
     """
     Infers user preferences and generates a checklist from interaction logs using a model.
     """
-    def __init__(self, model):
-        prompt_file = resources.files('prompts') / "evaluation/preference_inferrer.yaml"
-        with prompt_file.open('r') as file:
-            prompt = yaml.safe_load(file)
-        self.system_template = prompt.get('system_prompt', None)
+    def __init__(self, model, oversize_policy="skip"):
+        prompt = get_prompt("evaluation/preference_inferrer.yaml")
+        self.system_prompt = prompt['system_prompt'].format()
         self.prompt_template = prompt['user_prompt']
         self.decomposer = PreferenceDecomposer()
         self.model = model
+        # What to do with prompts too long for the model (see utils.tokens)
+        self.oversize_policy = oversize_policy
+
+    @property
+    def context_fit(self):
+        """
+        How the last prompt built in the current thread or task was fitted to the context window.
+        """
+        return _context_fit.get()
 
     def process_output(self, output):
         """
         Extract the most likely preference from the model output.
         """
         try:
-            processed = output.split("### Most Likely Preference")[1].strip()
+            processed = output.split(PREFERENCE_HEADER)[1].strip()
             processed = processed.split("\n")[0].strip()
         except Exception as e:
             logger.error(f"Error processing output: {e}\nOutput: {output}")
             raise
         return processed
     
+    def model_options(self):
+        # Stop generating once the preference line is complete when the model supports it
+        return {"until": preference_complete} if getattr(self.model, 'supports_early_stop', False) else {}
+
+    def fit_user_prompt(self, curr_request, prev_interactions):
+        """
+        Return the user prompt, with the interaction log fitted to the model's context window, and the fit.
+        """
+        interaction_log, fit = fit_interaction_log(
+            self.model.model_name,
+            self.model.max_tokens,
+            lambda log: self.system_prompt + self.prompt_template.format(curr_request=curr_request, interaction_log=log),
+            prev_interactions,
+            policy=self.oversize_policy
+        )
+        return self.prompt_template.format(
+            curr_request=curr_request,
+            interaction_log=interaction_log
+        ), fit
+
+    def build_user_prompt(self, curr_request, prev_interactions):
+        """
+        Format the user prompt, fitting the interaction log to the model's context window.
+        """
+        # Cleared first, so a prompt that does not fit never reports the fit of the previous instance
+        _context_fit.set(None)
+        user_prompt, fit = self.fit_user_prompt(curr_request, prev_interactions)
+        _context_fit.set(fit)
+        return user_prompt
+
+    async def abuild_user_prompt(self, curr_request, prev_interactions):
+        """
+        Coroutine counterpart of build_user_prompt; counting the tokens of a long log runs in a thread.
+        """
+        _context_fit.set(None)
+        user_prompt, fit = await asyncio.to_thread(self.fit_user_prompt, curr_request, prev_interactions)
+        _context_fit.set(fit)
+        return user_prompt
+
     def __call__(self, curr_request, prev_interactions):
         """
         Infer preference and checklist from the current request and previous interactions.
         """
         try:
             output = self.model(
-                system_prompt=self.system_template,
-                user_prompt=self.prompt_template.format(
-                    curr_request=curr_request,
-                    interaction_log=format_interaction_log(prev_interactions)
-                )
+                system_prompt=self.system_prompt,
+                user_prompt=self.build_user_prompt(curr_request, prev_interactions),
+                **self.model_options()
             )
             preference = self.process_output(output)
         except Exception as e:
             logger.error(f"Error inferring preference: {e}")
             raise
         checklist = self.decomposer(preference)
+        return preference, checklist
+
+    async def acall(self, curr_request, prev_interactions):
+        """
+        Coroutine counterpart of __call__.
+        """
+        try:
+            output = await self.model.acall(
+                system_prompt=self.system_prompt,
+                user_prompt=await self.abuild_user_prompt(curr_request, prev_interactions),
+                **self.model_options()
+            )
+            preference = self.process_output(output)
+        except Exception as e:
+            logger.error(f"Error inferring preference: {e}")
+            raise
+        checklist = await self.decomposer.acall(preference)
         return preference, checklist
\ No newline at end of file
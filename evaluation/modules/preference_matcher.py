@@ -3,7 +3,13 @@ Module for matching inferred preferences to ground-truth preferences during eval
 Provides PreferenceMatcher class for scoring and label assignment.
 """
 import json
+import asyncio
+import contextvars
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from utils import Generator, parse_json
+from utils.prompts import get_prompt
+from utils.usage import add_usage
 from config import PREFMATCHER_MODEL_NAME
 import logging
 
@@ -91,6 +97,77 @@ def score_to_label(score):
     else:
         return "Not Covered"
 
+MATCH_LABELS = ["Fully Covered", "Partially Covered", "Not Covered"]
+
+def format_examples(examples):
+    """
+    Render few-shot examples in the matcher's output format.
+    """
+    examples_str = ""
+    for example in examples:
+        examples_str += f"#### Preference\n\n{example['preference']}\n\n#### Output\n\n```json\n"
+        json_obj = {
+            "results": [
+                {
+                    "index": i + 1,
+                    "entry": entry,
+                    "label": score_to_label(example['checklist'][entry]),
+                } for i, entry in enumerate(example['checklist'])
+            ]
+        }
+        examples_str += json.dumps(json_obj, indent=2)
+        examples_str += "\n```\n\n---\n\n"
+    return examples_str.strip()
+
+def format_checklist(checklist):
+    return "\n".join([f"{j + 1}. {entry}" for j, entry in enumerate(checklist)])
+
+def format_pairs(pairs):
+    """
+    Render (checklist, preference) pairs as the user prompt of a batched matcher request.
+    """
+    return "\n\n---\n\n".join(
+        f"### Pair {k + 1}\n\n#### Preference\n\n{preference}\n\n#### Checklist\n\n{format_checklist(checklist)}"
+        for k, (checklist, preference) in enumerate(pairs)
+    )
+
+def split_batch_output(output, pairs):
+    """
+    Split the output of a batched matcher request into the results of each pair, ordered by entry.
+    A pair whose results do not label every entry of its checklist exactly once is returned as None.
+    """
+    try:
+        batch = parse_json(output)['pairs']
+    except Exception as e:
+        logger.error(f"Error parsing batched matcher output: {e}\nOutput: {output}")
+        return [None] * len(pairs)
+    by_pair = {}
+    for item in batch:
+        if isinstance(item, dict) and isinstance(item.get('results'), list):
+            by_pair[item.get('pair')] = item['results']
+
+    split = []
+    for k, (checklist, _) in enumerate(pairs):
+        results = {}
+        for result in by_pair.get(k + 1, []):
+            index = result.get('index') if isinstance(result, dict) else None
+            if index in results or not isinstance(index, int) or result.get('label') not in MATCH_LABELS:
+                results = None
+                break
+            results[index] = result
+        if results is None or sorted(results) != list(range(1, len(checklist) + 1)):
+            split.append(None)
+            continue
+        split.append([{**results[i + 1], "entry": entry} for i, entry in enumerate(checklist)])
+    return split
+
+@lru_cache(maxsize=None)
+def system_template(prompt_file):
+    """
+    Return the matcher's system prompt template with the few-shot examples rendered in, once per process.
+    """
+    return get_prompt(prompt_file)['system_prompt'].bind(examples=format_examples(EXAMPLES))
+
 class PreferenceMatcher(Generator):
     """
     Matches checklist entries to preferences and assigns coverage labels using a model.
@@ -101,44 +178,117 @@ class PreferenceMatcher(Generator):
         prompt_file="evaluation/preference_matcher.yaml",
         temperature=0,
         max_tokens=8192,
-        verbose=False
+        verbose=False,
+        cache=True,
+        batch_size=1
     ):
         self.is_finetuned = model_name == PREFMATCHER_MODEL_NAME
+        # The fine-tuned matcher only knows the single-pair format
+        self.batch_size = 1 if self.is_finetuned else max(batch_size, 1)
+        if self.is_finetuned:
+            prompt_file = "evaluation/preference_matcher_model.yaml"
         super().__init__(
             model_name,
-            prompt_file if not self.is_finetuned else "evaluation/preference_matcher_model.yaml",
+            prompt_file,
             temperature=temperature,
             max_tokens=max_tokens,
-            verbose=verbose
+            verbose=verbose,
+            cache=cache
         )
+        self.system_template = system_template(prompt_file)
+        if self.batch_size > 1:
+            self.batch_generator = Generator(
+                model_name,
+                "evaluation/preference_matcher_batch.yaml",
+                temperature=temperature,
+                max_tokens=max_tokens,
+                verbose=verbose,
+                cache=cache
+            )
+            self.batch_generator.system_template = system_template("evaluation/preference_matcher_batch.yaml")
 
     def __call__(self, checklist, preference):
         """
         Match checklist entries to a preference and return results with labels.
         """
-        examples_str = ""
-        for example in EXAMPLES:
-            examples_str += f"#### Preference\n\n{example['preference']}\n\n#### Output\n\n```json\n"
-            json_obj = {
-                "results": [
-                    {
-                        "index": i + 1,
-                        "entry": entry,
-                        "label": score_to_label(example['checklist'][entry]),
-                    } for i, entry in enumerate(example['checklist'])
-                ]
-            }
-            examples_str += json.dumps(json_obj, indent=2)
-            examples_str += "\n```\n\n---\n\n"
         try:
             output = super().__call__(
-                checklist="\n".join([f"{j + 1}. {entry}" for j, entry in enumerate(checklist)]),
-                preference=preference,
-                examples=examples_str.strip() if not self.is_finetuned else None
+                checklist=format_checklist(checklist),
+                preference=preference
             )
             matches = parse_json(output)
         except Exception as e:
             logger.error(f"Error parsing matcher output: {e}\nOutput: {output if 'output' in locals() else ''}")
             raise
       
-        return matches['results'] if not self.is_finetuned else matches, output
\ No newline at end of file
+        return matches['results'] if not self.is_finetuned else matches, output
+
+    async def acall(self, checklist, preference):
+        """
+        Coroutine counterpart of __call__.
+        """
+        try:
+            output = await super().acall(
+                checklist=format_checklist(checklist),
+                preference=preference
+            )
+            matches = parse_json(output)
+        except Exception as e:
+            logger.error(f"Error parsing matcher output: {e}\nOutput: {output if 'output' in locals() else ''}")
+            raise
+
+        return matches['results'] if not self.is_finetuned else matches, output
+
+    def _chunks(self, pairs):
+        return [pairs[i:i + self.batch_size] for i in range(0, len(pairs), self.batch_size)]
+
+    def _missing(self, chunk, split):
+        missing = [k for k, results in enumerate(split) if results is None]
+        if missing:
+            logger.warning(f"Batched matcher request left {len(missing)} of {len(chunk)} pairs incomplete; matching them one by one")
+            add_usage(self.model_name, {"matcher_batch_fallbacks": len(missing)})
+        return missing
+
+    def _match_batch(self, chunk):
+        output = self.batch_generator(pairs=format_pairs(chunk))
+        split = split_batch_output(output, chunk)
+        matches = [(results, output) for results in split]
+        for k in self._missing(chunk, split):
+            matches[k] = self(*chunk[k])
+        return matches
+
+    async def _amatch_batch(self, chunk):
+        output = await self.batch_generator.acall(pairs=format_pairs(chunk))
+        split = split_batch_output(output, chunk)
+        matches = [(results, output) for results in split]
+        missing = self._missing(chunk, split)
+        fallbacks = await asyncio.gather(*[self.acall(*chunk[k]) for k in missing])
+        for k, match in zip(missing, fallbacks):
+            matches[k] = match
+        return matches
+
+    def match_pairs(self, pairs):
+        """
+        Match several (checklist, preference) pairs concurrently and return their (results, output) in order.
+        With batch_size > 1, up to batch_size pairs share one request (and its few-shot examples); pairs
+        that do not come back complete are matched on their own.
+        """
+        if len(pairs) == 1 and self.batch_size == 1:
+            return [self(*pairs[0])]
+        if self.batch_size > 1:
+            tasks = [(self._match_batch, chunk) for chunk in self._chunks(pairs)]
+        else:
+            tasks = [(lambda pair: [self(*pair)], pair) for pair in pairs]
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            # Threads do not inherit the caller's context, which carries the usage stage
+            futures = [executor.submit(contextvars.copy_context().run, fn, arg) for fn, arg in tasks]
+            return [match for future in futures for match in future.result()]
+
+    async def amatch_pairs(self, pairs):
+        """
+        Coroutine counterpart of match_pairs.
+        """
+        if self.batch_size > 1:
+            chunks = await asyncio.gather(*[self._amatch_batch(chunk) for chunk in self._chunks(pairs)])
+            return [match for chunk in chunks for match in chunk]
+        return await asyncio.gather(*[self.acall(*pair) for pair in pairs])
@@ -2,37 +2,93 @@
 Module for generating AI assistant responses during evaluation.
 Loads prompt templates and formats interaction logs for model input.
 """
-import yaml
-from importlib import resources
-from utils import format_interaction_log
+import asyncio
+import contextvars
+from utils.prompts import get_prompt
+from utils.tokens import fit_interaction_log
 import logging
 
 logger = logging.getLogger(__name__)
 
+# The fit of the last prompt built in this thread or task, so that a shared generator can serve concurrent instances
+_context_fit = contextvars.ContextVar("response_generator_context_fit", default=None)
+
 class ResponseGenerator:
     """
     Generates AI assistant responses given the current request and previous interactions.
     """
-    def __init__(self, model):
-        prompt_file = resources.files('prompts') / "evaluation/response_generator.yaml"
-        with prompt_file.open('r') as file:
-            prompt = yaml.safe_load(file)
-        self.system_template = prompt.get('system_prompt', None)
+    def __init__(self, model, oversize_policy="skip"):
+        prompt = get_prompt("evaluation/response_generator.yaml")
+        self.system_prompt = prompt['system_prompt'].format()
         self.prompt_template = prompt['user_prompt']
         self.model = model
+        # What to do with prompts too long for the model (see utils.tokens)
+        self.oversize_policy = oversize_policy
+
+    @property
+    def context_fit(self):
+        """
+        How the last prompt built in the current thread or task was fitted to the context window.
+        """
+        return _context_fit.get()
     
+    def fit_user_prompt(self, curr_request, prev_interactions):
+        """
+        Return the user prompt, with the interaction log fitted to the model's context window, and the fit.
+        """
+        interaction_log_str, fit = fit_interaction_log(
+            self.model.model_name,
+            self.model.max_tokens,
+            lambda log: self.system_prompt + self.prompt_template.format(curr_request=curr_request, interaction_log=log),
+            prev_interactions,
+            policy=self.oversize_policy
+        )
+        return self.prompt_template.format(
+            curr_request=curr_request,
+            interaction_log=interaction_log_str
+        ), fit
+
+    def build_user_prompt(self, curr_request, prev_interactions):
+        """
+        Format the user prompt, fitting the interaction log to the model's context window.
+        """
+        # Cleared first, so a prompt that does not fit never reports the fit of the previous instance
+        _context_fit.set(None)
+        user_prompt, fit = self.fit_user_prompt(curr_request, prev_interactions)
+        _context_fit.set(fit)
+        return user_prompt
+
+    async def abuild_user_prompt(self, curr_request, prev_interactions):
+        """
+        Coroutine counterpart of build_user_prompt; counting the tokens of a long log runs in a thread.
+        """
+        _context_fit.set(None)
+        user_prompt, fit = await asyncio.to_thread(self.fit_user_prompt, curr_request, prev_interactions)
+        _context_fit.set(fit)
+        return user_prompt
+
     def __call__(self, curr_request, prev_interactions):
         """
         Generate a response for the current request, using the model and formatted interaction log.
         """
-        interaction_log_str = format_interaction_log(prev_interactions)
         try:
             output = self.model(
-                system_prompt=self.system_template,
-                user_prompt=self.prompt_template.format(
-                    curr_request=curr_request,
-                    interaction_log=interaction_log_str
-                )
+                system_prompt=self.system_prompt,
+                user_prompt=self.build_user_prompt(curr_request, prev_interactions)
+            )
+        except Exception as e:
+            logger.error(f"Error generating response: {e}")
+            raise
+        return curr_request, output
+
+    async def acall(self, curr_request, prev_interactions):
+        """
+        Coroutine counterpart of __call__.
+        """
+        try:
+            output = await self.model.acall(
+                system_prompt=self.system_prompt,
+                user_prompt=await self.abuild_user_prompt(curr_request, prev_interactions)
             )
         except Exception as e:
             logger.error(f"Error generating response: {e}")
@@ -17,9 +17,10 @@ class ResponseJudger(Generator):
         prompt_file="evaluation/response_judger.yaml", 
         temperature=0, 
         max_tokens=8192, 
-        verbose=False
+        verbose=False,
+        cache=True
     ):
-        super().__init__(model_name, prompt_file, temperature=temperature, max_tokens=max_tokens, verbose=verbose)
+        super().__init__(model_name, prompt_file, temperature=temperature, max_tokens=max_tokens, verbose=verbose, cache=cache)
     
     def process_output(self, output):
         """
@@ -52,6 +53,22 @@ class ResponseJudger(Generator):
                 checklist="\n".join(list(map(lambda x: f"- {x}", checklist)))
             )
             return self.process_output(output)
+        except Exception as e:
+            logger.error(f"Error judging response: {e}")
+            raise
+
+    async def acall(self, user_request, ai_response, preference, checklist):
+        """
+        Coroutine counterpart of __call__.
+        """
+        try:
+            output = await super().acall(
+                user_request=user_request,
+                ai_response=ai_response,
+                preference=preference,
+                checklist="\n".join(list(map(lambda x: f"- {x}", checklist)))
+            )
+            return self.process_output(output)
         except Exception as e:
             logger.error(f"Error judging response: {e}")
             raise
\ No newline at end of file
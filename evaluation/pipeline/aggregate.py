@@ -0,0 +1,146 @@
+"""
+Vectorized aggregation of evaluation results.
+Loads the per-instance metrics kept by the results store into NumPy arrays and computes micro and
+macro precision/recall/F1 and the mean judge score, overall and per instance type (consistent,
+contrastive, changing), each with percentile bootstrap confidence intervals. Resamples are drawn in
+chunks of at most BOOTSTRAP_CHUNK_ELEMENTS indices and reduced to per-row draw counts, so memory
+stays bounded for large runs.
+"""
+import logging
+import numpy as np
+from config import BOOTSTRAP_RESAMPLES, BOOTSTRAP_CONFIDENCE
+from evaluation.pipeline.store import get_results_store, infer_instance_type
+
+logger = logging.getLogger(__name__)
+
+BOOTSTRAP_CHUNK_ELEMENTS = 4_000_000
+
+def safe_divide(numerator, denominator):
+    """
+    Elementwise numerator / denominator, 0 where the denominator is 0 (as calculate_prf does).
+    """
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape), where=denominator > 0)
+
+def f1_score(precision, recall):
+    return safe_divide(2 * precision * recall, precision + recall)
+
+def load_metrics(results_dir, model_name):
+    """
+    Return the per-instance metrics of a model as arrays: {"inference": {...}, "generation": {...}},
+    each with an "instance_type" array of labels ("unknown" where the type is not known).
+    """
+    store = get_results_store(results_dir)
+    metrics = {}
+    for section in ["inference", "generation"]:
+        rows = store.metric_rows(model_name, section)
+        instance_types = np.array(
+            [instance_type or infer_instance_type(instance_name) or "unknown" for instance_name, instance_type, *_ in rows],
+            dtype=object
+        )
+        values = np.array([row[2:] for row in rows], dtype=float).reshape(len(rows), 5)
+        metrics[section] = {
+            "instance_type": instance_types,
+            "true_matched": values[:, 0],
+            "predicted_matched": values[:, 1],
+            "n_true": values[:, 2],
+            "n_predicted": values[:, 3],
+            "score": values[:, 4]
+        }
+    return metrics
+
+def bootstrap_means(columns, resamples, rng):
+    """
+    Return the column means of `resamples` bootstrap resamples of the rows of `columns` (n_rows x n_columns),
+    as a (resamples x n_columns) array.
+    """
+    n_rows = columns.shape[0]
+    chunk = max(BOOTSTRAP_CHUNK_ELEMENTS // max(n_rows, 1), 1)
+    means = np.empty((resamples, columns.shape[1]))
+    for start in range(0, resamples, chunk):
+        size = min(chunk, resamples - start)
+        indices = rng.integers(0, n_rows, size=(size, n_rows))
+        # How often each row is drawn in each resample; a matrix product then sums all columns at once
+        indices += np.arange(size)[:, None] * n_rows
+        counts = np.bincount(indices.ravel(), minlength=size * n_rows).reshape(size, n_rows)
+        means[start:start + size] = counts @ columns / n_rows
+    return means
+
+def interval(samples, confidence):
+    low, high = np.quantile(samples, [(1 - confidence) / 2, 1 - (1 - confidence) / 2])
+    return [float(low), float(high)]
+
+def inference_metrics(arrays, mask, resamples, confidence, rng):
+    """
+    Micro and macro precision/recall/F1 of the selected instances, with bootstrap intervals.
+    """
+    true_matched = arrays['true_matched'][mask]
+    predicted_matched = arrays['predicted_matched'][mask]
+    n_true = arrays['n_true'][mask]
+    n_predicted = arrays['n_predicted'][mask]
+    precision = safe_divide(predicted_matched, n_predicted)
+    recall = safe_divide(true_matched, n_true)
+
+    # Micro metrics are ratios of sums, so resampled means of the counts give them directly
+    columns = np.stack([true_matched, predicted_matched, n_true, n_predicted, precision, recall, f1_score(precision, recall)], axis=1)
+
+    def summarize(means):
+        micro_precision = safe_divide(means[..., 1], means[..., 3])
+        micro_recall = safe_divide(means[..., 0], means[..., 2])
+        return {
+            "micro_precision": micro_precision,
+            "micro_recall": micro_recall,
+            "micro_f1": f1_score(micro_precision, micro_recall),
+            "macro_precision": means[..., 4],
+            "macro_recall": means[..., 5],
+            "macro_f1": means[..., 6]
+        }
+
+    n_instances = int(mask.sum())
+    values = summarize(columns.mean(axis=0)) if n_instances > 0 else {name: 0.0 for name in summarize(np.zeros(7))}
+    result = {"n_instances": n_instances}
+    samples = summarize(bootstrap_means(columns, resamples, rng)) if n_instances > 0 and resamples > 0 else None
+    for name, value in values.items():
+        result[name] = {"value": float(value)}
+        if samples is not None:
+            result[name]["ci"] = interval(samples[name], confidence)
+    return result
+
+def generation_metrics(arrays, mask, resamples, confidence, rng):
+    """
+    Mean judge score of the selected instances, with its bootstrap interval.
+    """
+    scores = arrays['score'][mask]
+    n_instances = int(mask.sum())
+    result = {"n_instances": n_instances, "average_score": {"value": float(scores.mean()) if n_instances > 0 else 0.0}}
+    if n_instances > 0 and resamples > 0:
+        result["average_score"]["ci"] = interval(bootstrap_means(scores[:, None], resamples, rng)[:, 0], confidence)
+    return result
+
+def breakdown(metrics, task, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE, seed=0):
+    """
+    Return the metrics of loaded arrays overall and by instance type, for the sections of `task`.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    sections = {"inference": inference_metrics, "generation": generation_metrics}
+    for section, compute in sections.items():
+        if task not in [section, "both"]:
+            continue
+        arrays = metrics[section]
+        instance_types = arrays['instance_type']
+        results[section] = {
+            "overall": compute(arrays, np.ones(len(instance_types), dtype=bool), resamples, confidence, rng),
+            "by_instance_type": {
+                str(instance_type): compute(arrays, instance_types == instance_type, resamples, confidence, rng)
+                for instance_type in sorted(set(instance_types))
+            }
+        }
+    return results
+
+def aggregate_breakdown(results_dir, model_name, task, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE, seed=0):
+    """
+    Load a model's stored results and return their micro/macro metrics, per-type breakdowns and confidence intervals.
+    """
+    return breakdown(load_metrics(results_dir, model_name), task, resamples=resamples, confidence=confidence, seed=seed)
@@ -0,0 +1,308 @@
+"""
+Asyncio evaluation driver.
+Runs the evaluation pipeline (inference, matching, generation, judging) for every instance as
+coroutines in a single process, keeping up to `concurrency` instances in flight. Models without a
+native acall run in a thread pool of the same size. Results are saved per instance exactly as by
+evaluate, so runs of either driver resume each other. Several models can be evaluated together, with
+each instance loaded once and handed to every model in turn.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.files import ensure_directory
+from utils.usage import usage_stage, usage_scope, flush_usage
+from utils.transport import flush_http_stats
+from utils.replay import flush_replay
+from config import EVALUATION_CONCURRENCY
+from evaluation.pipeline.evaluate import iter_model_instances, model_names
+from evaluation.pipeline.context import get_evaluation_context
+from evaluation.pipeline.store import get_results_store
+
+logger = logging.getLogger(__name__)
+
+class EvaluationJob:
+    """
+    The results of one instance as it moves through the evaluation stages, and the modules
+    of the shared evaluation context that evaluate it. The results store is SQLite shared across
+    processes, so its results are read with aload and written with asave, both in a thread.
+    """
+    def __init__(self, model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=False, oversize_policy="skip", matcher_batch_size=1):
+        self.model_name = model_name
+        self.instance_name = instance_name
+        self.instance_data = instance_data
+        self.store = get_results_store(results_dir)
+        self.results = None
+
+        context = get_evaluation_context(model_name, evaluator_model, use_matcher, oversize_policy, matcher_batch_size)
+        self.matcher, self.judger = context.matcher, context.judger
+        self.inferrer, self.generator = context.inferrer, context.generator
+
+    async def aload(self):
+        """
+        Load the stored results of the instance and return the job.
+        """
+        self.results = await asyncio.to_thread(self.store.load, self.model_name, self.instance_name)
+        if 'inference' not in self.results:
+            self.results['inference'] = {}
+        if 'generation' not in self.results:
+            self.results['generation'] = {}
+        return self
+
+    async def asave(self, section):
+        await asyncio.to_thread(
+            self.store.save, self.model_name, self.instance_name, section, self.results[section],
+            instance_type=self.instance_data.get('instance_type')
+        )
+
+async def run_inference(job):
+    """
+    1. Inference: Infer the preference from the interactions.
+    Returns False if the instance cannot proceed to matching.
+    """
+    model_name, instance_name, instance_data, results = job.model_name, job.instance_name, job.instance_data, job.results
+    if 'inferred' in results['inference']:
+        return True
+    logger.info(f"[{model_name}] {instance_name}: Inference task...")
+    try:
+        with usage_stage("inference"):
+            preference, checklist = await job.inferrer.acall(
+                instance_data['current_request'],
+                instance_data['prior_interactions']
+            )
+    except Exception as e:
+        if "context_length_exceeded" in str(e):
+            logger.warning(f"[{model_name}] {instance_name}: Context length exceeded during inference.")
+            preference = "ERROR: Context length exceeded"
+            checklist = []
+        else:
+            logger.error(f"[{model_name}] {instance_name}: Inference task failed: {e}")
+            return False
+    results['inference'] = {
+        "inferred": {
+            "preference": preference,
+            "checklist": checklist
+        },
+        "groundtruth": {
+            "preference": instance_data['current_contextual_preference'],
+            "checklist": instance_data['current_checklist']
+        }
+    }
+    if job.inferrer.context_fit is not None and job.inferrer.context_fit['sessions_dropped'] > 0:
+        results['inference']['truncation'] = job.inferrer.context_fit
+    await job.asave("inference")
+    return True
+
+async def run_matching(job):
+    """
+    2. Matching: Match the inferred preference to the groundtruth preference.
+    """
+    model_name, instance_name, results = job.model_name, job.instance_name, job.results
+    if 'match' in results['inference']:
+        return True
+    logger.info(f"[{model_name}] {instance_name}: Evaluate match of inferred preference...")
+    inferred = results['inference']['inferred']
+    groundtruth = results['inference']['groundtruth']
+    if len(inferred['checklist']) > 0:
+        try:
+            with usage_stage("matching"):
+                # Both directions are independent, so they run concurrently
+                (match_infer_to_gt, _), (match_gt_to_infer, _) = await job.matcher.amatch_pairs(match_pairs(job))
+            results['inference']['match'] = {
+                "infer_to_gt": match_infer_to_gt,
+                "gt_to_infer": match_gt_to_infer
+            }
+        except Exception as e:
+            logger.error(f"[{model_name}] {instance_name}: Matching task failed: {e}")
+            results['inference']['match'] = {
+                "infer_to_gt": [],
+                "gt_to_infer": []
+            }
+    else:
+        # if the inference is empty, set the match to all 0
+        results['inference']['match'] = {
+            "infer_to_gt": [
+                {
+                    "entry": entry,
+                    "score": 0
+                } for entry in inferred['checklist']
+            ],
+            "gt_to_infer": [
+                {
+                    "entry": entry,
+                    "score": 0
+                } for entry in groundtruth['checklist']
+            ]
+        }
+    await job.asave("inference")
+    return True
+
+def match_pairs(job):
+    """
+    Return the (checklist, preference) pairs matched for an instance: inferred to groundtruth, then groundtruth to inferred.
+    """
+    inferred = job.results['inference']['inferred']
+    groundtruth = job.results['inference']['groundtruth']
+    return [
+        (inferred['checklist'], groundtruth['preference']),
+        (groundtruth['checklist'], inferred['preference'])
+    ]
+
+async def run_matching_batch(jobs):
+    """
+    Match several instances with their pairs packed into shared matcher requests (see PreferenceMatcher.match_pairs).
+    Instances that need no matcher call, or whose batch fails, are matched with run_matching.
+    Instances of different models are packed separately, so each request's usage belongs to one model.
+    """
+    pending = {}
+    for job in jobs:
+        if 'match' in job.results['inference'] or len(job.results['inference']['inferred']['checklist']) == 0:
+            await run_matching(job)
+        else:
+            pending.setdefault(job.model_name, []).append(job)
+    await asyncio.gather(*[match_batch(model_jobs) for model_jobs in pending.values()])
+    return [True] * len(jobs)
+
+async def match_batch(pending):
+    """
+    Match the instances of one model with their pairs packed into shared matcher requests.
+    """
+    for job in pending:
+        logger.info(f"[{job.model_name}] {job.instance_name}: Evaluate match of inferred preference...")
+    pairs = [pair for job in pending for pair in match_pairs(job)]
+    try:
+        with usage_scope(pending[0].model_name), usage_stage("matching"):
+            matches = await pending[0].matcher.amatch_pairs(pairs)
+    except Exception as e:
+        logger.error(f"Batched matching of {len(pending)} instances failed, matching them one by one: {e}")
+        await asyncio.gather(*[run_matching(job) for job in pending])
+        return
+
+    for i, job in enumerate(pending):
+        (match_infer_to_gt, _), (match_gt_to_infer, _) = matches[2 * i], matches[2 * i + 1]
+        job.results['inference']['match'] = {
+            "infer_to_gt": match_infer_to_gt,
+            "gt_to_infer": match_gt_to_infer
+        }
+        await job.asave("inference")
+
+async def run_generation(job):
+    """
+    3. Response: Generate adapted response.
+    Returns False if the instance cannot proceed to judging.
+    """
+    model_name, instance_name, instance_data, results = job.model_name, job.instance_name, job.instance_data, job.results
+    if 'ai_response' in results['generation']:
+        return True
+    logger.info(f"[{model_name}] {instance_name}: Generate response...")
+    try:
+        with usage_stage("generation"):
+            request, response = await job.generator.acall(
+                instance_data['current_request'],
+                instance_data['prior_interactions']
+            )
+    except Exception as e:
+        if "context_length_exceeded" in str(e):
+            logger.warning(f"[{model_name}] {instance_name}: Context length exceeded during generation.")
+            request = instance_data['current_request']
+            response = "ERROR: Context length exceeded"
+        else:
+            logger.error(f"[{model_name}] {instance_name}: Generation task failed: {e}")
+            return False
+    results['generation'] = {
+        "user_request": request,
+        "ai_response": response
+    }
+    if job.generator.context_fit is not None and job.generator.context_fit['sessions_dropped'] > 0:
+        results['generation']['truncation'] = job.generator.context_fit
+    await job.asave("generation")
+    return True
+
+async def run_judging(job):
+    """
+    4. Judging: Evaluate the response.
+    """
+    model_name, instance_name, instance_data, results = job.model_name, job.instance_name, job.instance_data, job.results
+    if 'alignment' in results['generation']:
+        return True
+    logger.info(f"[{model_name}] {instance_name}: Judge response...")
+    if results['generation']['ai_response'] != "ERROR: Context length exceeded":
+        try:
+            with usage_stage("judging"):
+                analysis, score = await job.judger.acall(
+                    user_request=results['generation']['user_request'],
+                    ai_response=results['generation']['ai_response'],
+                    preference=instance_data['current_contextual_preference'],
+                    checklist=instance_data['current_checklist']
+                )
+            results['generation']['alignment'] = {"score": score, "analysis": analysis}
+        except Exception as e:
+            logger.error(f"[{model_name}] {instance_name}: Judging of generation failed: {e}")
+            results['generation']['alignment'] = {"score": 0, "analysis": str(e)}
+    else:
+        results['generation']['alignment'] = {"score": 0, "analysis": "Context length exceeded"}
+    await job.asave("generation")
+    return True
+
+async def aevaluate(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=False, task="inference", oversize_policy="skip", matcher_batch_size=1):
+    """
+    Coroutine counterpart of evaluation.pipeline.evaluate.evaluate.
+    """
+    job = await EvaluationJob(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size).aload()
+
+    # Inference + Matching
+    if task in ["inference", "both"]:
+        if not await run_inference(job):
+            return
+        await run_matching(job)
+
+    # Generation + Judging
+    if task in ["generation", "both"]:
+        if not await run_generation(job):
+            return
+        await run_judging(job)
+
+async def aevaluate_all(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, task="both", concurrency=EVALUATION_CONCURRENCY, oversize_policy="skip", matcher_batch_size=1):
+    """
+    Evaluate all instances with up to `concurrency` instances in flight.
+    model_name may be a list of models, whose instances then share the `concurrency` slots.
+    """
+    models = model_names(model_name)
+    for name in models:
+        ensure_directory(f"{results_dir}/{name}")
+    # Sync models and blocking helpers run in the loop's default executor, sized to match
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    instances = iter_model_instances(models, data_dir)
+    n_done = 0
+
+    async def worker():
+        nonlocal n_done
+        # Workers pull instances lazily, so the dataset is never fully materialized as tasks
+        for name, instance_name, instance_data in instances:
+            try:
+                with usage_scope(name):
+                    await aevaluate(name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size)
+            except Exception as e:
+                logger.error(f"[{name}] {instance_name}: Evaluation failed: {e}")
+            finally:
+                await asyncio.to_thread(flush_usage, f"{results_dir}/{name}", scope=name)
+            n_done += 1
+            if n_done % 100 == 0:
+                logger.info(f"[{', '.join(models)}] {n_done} instances evaluated")
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        for name in models:
+            await asyncio.to_thread(flush_usage, f"{results_dir}/{name}", scope=name)
+            await asyncio.to_thread(flush_http_stats, f"{results_dir}/{name}")
+        await asyncio.to_thread(flush_replay)
+
+def evaluate_async(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, task="both", concurrency=EVALUATION_CONCURRENCY, oversize_policy="skip", matcher_batch_size=1):
+    """
+    Run the evaluation pipeline for all data instances in this process with the asyncio driver.
+    """
+    asyncio.run(aevaluate_all(
+        model_name, evaluator_model, results_dir, data_dir,
+        use_matcher=use_matcher, task=task, concurrency=concurrency, oversize_policy=oversize_policy,
+        matcher_batch_size=matcher_batch_size
+    ))
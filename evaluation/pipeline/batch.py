@@ -0,0 +1,48 @@
+"""
+Batch-mode evaluation driver.
+Runs evaluate over all instances in rounds: each round queues the next LLM request of every
+unfinished instance, submits the queued requests as provider batch jobs, and waits for their
+results. Per-instance results and batch progress are persisted, so an interrupted run resumes
+where it stopped.
+"""
+import logging
+from utils.files import ensure_directory
+from utils.batch import BatchCollector, BatchPending, set_batch_collector
+from evaluation.pipeline.evaluate import evaluate_instance, instance_refs, load_instance
+
+logger = logging.getLogger(__name__)
+
+def evaluate_batch(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, task="both", poll_interval=60, oversize_policy="skip", matcher_batch_size=1):
+    """
+    Run the evaluation pipeline for all data instances through provider batch APIs.
+    Requests to providers without a batch backend are sent directly as usual.
+    """
+    ensure_directory(f"{results_dir}/{model_name}")
+    # Instances are reloaded from their references every round rather than all held in memory
+    refs = list(instance_refs(data_dir))
+    collector = BatchCollector(f"{results_dir}/{model_name}/batch")
+    set_batch_collector(collector)
+    try:
+        # Finish any jobs submitted before an interruption
+        collector.wait(poll_interval)
+        round_index = 0
+        while True:
+            round_index += 1
+            n_waiting = 0
+            for ref in refs:
+                instance = load_instance(ref, data_dir)
+                if instance is None:
+                    continue
+                instance_name, instance_data = instance
+                try:
+                    evaluate_instance(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size)
+                except BatchPending:
+                    n_waiting += 1
+            if not collector.pending:
+                break
+            logger.info(f"Batch round {round_index}: {n_waiting} instances waiting on {len(collector.pending)} requests")
+            collector.submit_pending()
+            collector.wait(poll_interval)
+    finally:
+        set_batch_collector(None)
+    logger.info(f"Batch evaluation finished after {round_index} rounds")
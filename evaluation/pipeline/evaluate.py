@@ -1,45 +1,55 @@
 """
 Evaluation pipeline for running model inference, preference matching, response generation, and judging.
 Provides evaluate and evaluate_parallel functions for single and multi-process evaluation.
+The drivers take one model name or a list of them: several models are evaluated in one run over a
+single pass through the data, with each instance handed to every model in turn.
+Pool workers are sent only instance references (dataset row indices or data_dir file names) and load
+each instance themselves, from the memory-mapped Arrow dataset or its JSON file.
 """
 import os
 import json
 import logging
+from functools import partial
 from multiprocessing import Pool
 from datasets import load_dataset
-from utils.files import load_json, save_json, ensure_directory
+from utils.files import load_json, ensure_directory
 from utils.logging import setup_worker_logging
-from config import DATASET_NAME, PREFMATCHER_MODEL_NAME
-from evaluation.models.model import get_model_class
-from evaluation.modules import PreferenceInferrer, PreferenceMatcher, ResponseGenerator, ResponseJudger
+from utils.usage import usage_stage, usage_scope, flush_usage
+from utils.transport import flush_http_stats
+from utils.replay import flush_replay
+from config import DATASET_NAME, POOL_CHUNK_SIZE
+from evaluation.pipeline.context import get_evaluation_context, init_evaluation_context
+from evaluation.pipeline.store import get_results_store
 
 logger = logging.getLogger(__name__)
 
 log_queue = None  # Global for worker processes
+_dataset = None
 
-def worker_init(queue):
+def worker_init(queue, context_args=None):
     global log_queue
     log_queue = queue
     setup_worker_logging(log_queue)
+    # Build the model and modules of every evaluated model once per worker instead of once per instance
+    for args in context_args or []:
+        init_evaluation_context(*args)
 
-def evaluate(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=False, task="inference"):
+def evaluate(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=False, task="inference", oversize_policy="skip", matcher_batch_size=1):
     """
     Run the evaluation pipeline for a single data instance.
     Steps: inference, matching, response generation, and judging.
-    Only runs the stages specified by task.
+    Only runs the stages specified by task. Prompts too long for the model are skipped or have their
+    oldest sessions truncated according to oversize_policy (see utils.tokens). With matcher_batch_size > 1,
+    both matching directions share one matcher request.
     """
     # No need to set up logging here; handled by worker_init
     ensure_directory(f"{results_dir}/{model_name}")
-    results = load_json(f"{results_dir}/{model_name}/{instance_name}.json", default={})
+    store = get_results_store(results_dir)
+    results = store.load(model_name, instance_name)
     
-    ModelClass = get_model_class(model_name)
-    model = ModelClass()
-
-    matcher = PreferenceMatcher(model_name=evaluator_model if not use_matcher else PREFMATCHER_MODEL_NAME)
-    judger = ResponseJudger(model_name=evaluator_model)
-
-    inferrer = PreferenceInferrer(model)
-    generator = ResponseGenerator(model)
+    context = get_evaluation_context(model_name, evaluator_model, use_matcher, oversize_policy, matcher_batch_size)
+    matcher, judger = context.matcher, context.judger
+    inferrer, generator = context.inferrer, context.generator
 
     if 'inference' not in results:
         results['inference'] = {}
@@ -52,10 +62,11 @@ def evaluate(model_name, evaluator_model, instance_name, instance_data, results_
         if 'inferred' not in results['inference']:
             logger.info(f"[{model_name}] {instance_name}: Inference task...")
             try:
-                preference, checklist = inferrer(
-                    instance_data['current_request'], 
-                    instance_data['prior_interactions']
-                )
+                with usage_stage("inference"):
+                    preference, checklist = inferrer(
+                        instance_data['current_request'], 
+                        instance_data['prior_interactions']
+                    )
             except Exception as e:
                 if "context_length_exceeded" in str(e):
                     logger.warning(f"[{model_name}] {instance_name}: Context length exceeded during inference.")
@@ -74,7 +85,9 @@ def evaluate(model_name, evaluator_model, instance_name, instance_data, results_
                     "checklist": instance_data['current_checklist']
                 }
             }
-            save_json(f"{results_dir}/{model_name}/{instance_name}.json", results, indent=4)
+            if inferrer.context_fit is not None and inferrer.context_fit['sessions_dropped'] > 0:
+                results['inference']['truncation'] = inferrer.context_fit
+            store.save(model_name, instance_name, "inference", results['inference'], instance_type=instance_data.get('instance_type'))
 
         # 2. Matching: Match the inferred preference to the groundtruth preference
         if 'match' not in results['inference']:
@@ -83,14 +96,12 @@ def evaluate(model_name, evaluator_model, instance_name, instance_data, results_
             groundtruth = results['inference']['groundtruth']
             if len(inferred['checklist']) > 0:
                 try:
-                    match_infer_to_gt, _ = matcher(
-                        inferred['checklist'],
-                        groundtruth['preference']
-                    )
-                    match_gt_to_infer, _ = matcher(
-                        groundtruth['checklist'],
-                        inferred['preference']
-                    )
+                    with usage_stage("matching"):
+                        # Both directions are independent, so they are matched concurrently
+                        (match_infer_to_gt, _), (match_gt_to_infer, _) = matcher.match_pairs([
+                            (inferred['checklist'], groundtruth['preference']),
+                            (groundtruth['checklist'], inferred['preference'])
+                        ])
                     results['inference']['match'] = {
                         "infer_to_gt": match_infer_to_gt,
                         "gt_to_infer": match_gt_to_infer
@@ -117,18 +128,20 @@ def evaluate(model_name, evaluator_model, instance_name, instance_data, results_
                         } for entry in groundtruth['checklist'] 
                     ]
                 }
-            save_json(f"{results_dir}/{model_name}/{instance_name}.json", results, indent=4)
+            store.save(model_name, instance_name, "inference", results['inference'], instance_type=instance_data.get('instance_type'))
 
     # Generation + Judging
     if task in ["generation", "both"]:
         # 3. Response: Generate adapted response
         if 'ai_response' not in results['generation']:
             logger.info(f"[{model_name}] {instance_name}: Generate response...")
+            request = instance_data['current_request']
             try:
-                request, response = generator(
-                    instance_data['current_request'],
-                    instance_data['prior_interactions']
-                )
+                with usage_stage("generation"):
+                    request, response = generator(
+                        instance_data['current_request'],
+                        instance_data['prior_interactions']
+                    )
             except Exception as e:
                 if "context_length_exceeded" in str(e):
                     logger.warning(f"[{model_name}] {instance_name}: Context length exceeded during generation.")
@@ -140,64 +153,154 @@ def evaluate(model_name, evaluator_model, instance_name, instance_data, results_
                 "user_request": request,
                 "ai_response": response
             }
-            save_json(f"{results_dir}/{model_name}/{instance_name}.json", results, indent=4)
+            if generator.context_fit is not None and generator.context_fit['sessions_dropped'] > 0:
+                results['generation']['truncation'] = generator.context_fit
+            store.save(model_name, instance_name, "generation", results['generation'], instance_type=instance_data.get('instance_type'))
 
         # 4. Judging: Evaluate the response
         if 'alignment' not in results['generation']:
             logger.info(f"[{model_name}] {instance_name}: Judge response...")
             if results['generation']['ai_response'] != "ERROR: Context length exceeded":
                 try:
-                    analysis, score = judger(
-                        user_request=results['generation']['user_request'],
-                        ai_response=results['generation']['ai_response'],
-                        preference=instance_data['current_contextual_preference'],
-                        checklist=instance_data['current_checklist']
-                    )
+                    with usage_stage("judging"):
+                        analysis, score = judger(
+                            user_request=results['generation']['user_request'],
+                            ai_response=results['generation']['ai_response'],
+                            preference=instance_data['current_contextual_preference'],
+                            checklist=instance_data['current_checklist']
+                        )
                     results['generation']['alignment'] = {"score": score, "analysis": analysis}
                 except Exception as e:
                     logger.error(f"[{model_name}] {instance_name}: Judging of generation failed: {e}")
                     results['generation']['alignment'] = {"score": 0, "analysis": str(e)}
             else:
                 results['generation']['alignment'] = {"score": 0, "analysis": "Context length exceeded"}
-            save_json(f"{results_dir}/{model_name}/{instance_name}.json", results, indent=4)
+            store.save(model_name, instance_name, "generation", results['generation'], instance_type=instance_data.get('instance_type'))
+
+
+def evaluate_instance(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=False, task="inference", oversize_policy="skip", matcher_batch_size=1):
+    """
+    Evaluate a single instance and flush the token usage it recorded to the model's results directory.
+    """
+    try:
+        with usage_scope(model_name):
+            evaluate(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size)
+    finally:
+        flush_usage(f"{results_dir}/{model_name}", scope=model_name)
+        flush_http_stats(f"{results_dir}/{model_name}")
+        flush_replay()
 
+def get_dataset():
+    """
+    Return the CUPID test split, loaded once per process. The rows stay in the memory-mapped Arrow
+    cache, so processes that load it (or inherit it through fork) share its pages instead of copying them.
+    """
+    global _dataset
+    if _dataset is None:
+        _dataset = load_dataset(DATASET_NAME, split="test")
+    return _dataset
+
+def instance_refs(data_dir=None):
+    """
+    Return a reference to every instance: row indices of the CUPID dataset, or file names in data_dir.
+    """
+    if data_dir is None:
+        return range(len(get_dataset()))
+    return os.listdir(f"{data_dir}")
+
+def load_instance(ref, data_dir=None):
+    """
+    Return (instance_name, instance_data) for an instance reference from instance_refs, or None if it cannot be loaded.
+    """
+    if data_dir is None:
+        instance = get_dataset()[ref]
+        instance_name = instance['persona_id']
+        instance_data = {
+            "current_request": instance['current_request'],
+            "current_contextual_preference": instance['current_contextual_preference'],
+            "current_checklist": instance['current_checklist'],
+            "prior_interactions": instance['prior_interactions'],
+            "instance_type": instance.get('instance_type')
+        }
+        return instance_name, instance_data
+    instance_name = ref.split(".")[0]
+    instance_data = load_json(f"{data_dir}/{ref}", default=None)
+    if instance_data is None:
+        logger.error(f"ERROR: Loading {data_dir}/{ref}")
+        return None
+    return instance_name, instance_data
 
-def evaluate_parallel(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, n_workers=8, task="both", log_queue=None):
+def iter_instances(data_dir=None):
+    """
+    Yield (instance_name, instance_data) for every instance in the CUPID dataset, or in data_dir if given.
+    """
+    for ref in instance_refs(data_dir):
+        instance = load_instance(ref, data_dir)
+        if instance is not None:
+            yield instance
+
+def model_names(model_name):
+    """
+    Return the models of a driver's model_name argument: a single name or a list of names.
+    """
+    return list(model_name) if isinstance(model_name, (list, tuple)) else [model_name]
+
+def iter_model_instances(model_name, data_dir=None):
+    """
+    Yield (model_name, instance_name, instance_data) for every model and instance, loading each instance once.
+    Models take turns on every instance, so each model's provider sees a steady share of the requests.
+    """
+    models = model_names(model_name)
+    for instance_name, instance_data in iter_instances(data_dir):
+        for name in models:
+            yield name, instance_name, instance_data
+
+def count_instances(data_dir=None):
+    """
+    Return the number of instances iter_instances will yield (counting files for data_dir).
+    """
+    return len(instance_refs(data_dir))
+
+def evaluate_ref(task_ref, evaluator_model, results_dir, data_dir=None, use_matcher=False, task="inference", oversize_policy="skip", matcher_batch_size=1):
+    """
+    Load the instance of a (model_name, instance reference) pair in this worker and evaluate it.
+    """
+    model_name, ref = task_ref
+    instance = load_instance(ref, data_dir)
+    if instance is None:
+        return
+    instance_name, instance_data = instance
+    evaluate_instance(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size)
+
+def evaluate_parallel(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, n_workers=8, task="both", log_queue=None, oversize_policy="skip", matcher_batch_size=1):
     """
     Run the evaluation pipeline in parallel for all data instances in a directory.
     Uses multiprocessing if n_workers > 1.
-    Passes task to each evaluation.
+    Passes task to each evaluation. model_name may be a list of models to evaluate in the same run.
+    Workers receive (model_name, instance reference) pairs in chunks of POOL_CHUNK_SIZE and load the
+    instances themselves, so neither the submission nor the workers hold a copy of the whole dataset.
     """
-    args = []
     ensure_directory(results_dir)
+    models = model_names(model_name)
 
-    if data_dir is None:
-        dataset = load_dataset(DATASET_NAME, split="test")
-        for instance in dataset:
-            instance_name = instance['persona_id']
-            instance_data = {
-                "current_request": instance['current_request'],
-                "current_contextual_preference": instance['current_contextual_preference'],
-                "current_checklist": instance['current_checklist'],
-                "prior_interactions": instance['prior_interactions']
-            }
-            if n_workers == 1:
-                evaluate(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task)
-            else:
-                args.append((model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher, task))
-    else:
-        instances_filenames = os.listdir(f"{data_dir}")
-        for i, instance_filename in enumerate(instances_filenames):
-            instance_name = instance_filename.split(".")[0]
-            instance_data = load_json(f"{data_dir}/{instance_filename}", default=None)
-            if instance_data is None:
-                logger.error(f"ERROR: Loading {data_dir}/{instance_filename}")
-                continue
-            if n_workers == 1:
-                evaluate(model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task)
-            else:
-                args.append((model_name, evaluator_model, instance_name, instance_data, results_dir, use_matcher, task))
-        
-    if n_workers > 1:
-        with Pool(n_workers, initializer=worker_init, initargs=(log_queue,)) as p:
-            p.starmap(evaluate, args)
\ No newline at end of file
+    if n_workers == 1:
+        for name, instance_name, instance_data in iter_model_instances(models, data_dir):
+            evaluate_instance(name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, task=task, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size)
+        return
+
+    run = partial(
+        evaluate_ref,
+        evaluator_model=evaluator_model,
+        results_dir=results_dir,
+        data_dir=data_dir,
+        use_matcher=use_matcher,
+        task=task,
+        oversize_policy=oversize_policy,
+        matcher_batch_size=matcher_batch_size
+    )
+    # Models take turns on every instance, as in iter_model_instances
+    task_refs = ((name, ref) for ref in instance_refs(data_dir) for name in models)
+    context_args = [(name, evaluator_model, use_matcher, oversize_policy, matcher_batch_size) for name in models]
+    with Pool(n_workers, initializer=worker_init, initargs=(log_queue, context_args)) as p:
+        for _ in p.imap_unordered(run, task_refs, chunksize=POOL_CHUNK_SIZE):
+            pass
@@ -0,0 +1,111 @@
+"""
+Live progress and running metrics of an evaluation run.
+A ProgressReporter thread in the main process periodically reads the counters kept by the results
+store (instances per stage, summed metrics) and writes them to {results_dir}/{model_name}/status.json
+with throughput and an ETA, so precision/recall/F1 and judge scores can be followed while a run is
+going, whichever driver runs it.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from config import STATUS_INTERVAL
+from evaluation.pipeline.result import summarize_totals
+from evaluation.pipeline.store import get_results_store
+
+logger = logging.getLogger(__name__)
+
+# The stages an instance must complete for each task
+TASK_STAGES = {
+    "inference": ["matching"],
+    "generation": ["judging"],
+    "both": ["matching", "judging"]
+}
+
+class ProgressReporter:
+    """
+    Writes the running aggregates of a model's evaluation to status.json every `interval` seconds.
+    """
+    def __init__(self, results_dir, model_name, task, total=None, interval=STATUS_INTERVAL):
+        self.results_dir = results_dir
+        self.model_name = model_name
+        self.task = task
+        self.total = total
+        self.interval = interval
+        self.path = os.path.join(results_dir, model_name, "status.json")
+        self._store = get_results_store(results_dir)
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+        self._start_done = 0
+
+    def status(self):
+        """
+        Return the current progress, throughput, ETA and running metrics.
+        """
+        progress = self._store.progress(self.model_name, TASK_STAGES[self.task])
+        elapsed = time.monotonic() - self._start_time
+        # Instances finished by earlier runs of a resumed evaluation do not count towards throughput
+        throughput = (progress['done'] - self._start_done) / elapsed if elapsed > 0 else 0
+        remaining = self.total - progress['done'] if self.total is not None else None
+        return {
+            "model": self.model_name,
+            "task": self.task,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "elapsed_seconds": round(elapsed, 1),
+            "total": self.total,
+            "done": progress['done'],
+            "stages": progress['stages'],
+            "throughput": throughput,
+            "eta_seconds": round(remaining / throughput, 1) if remaining is not None and throughput > 0 else None,
+            "results": summarize_totals(self._store.totals(self.model_name), self.task)
+        }
+
+    def write(self):
+        """
+        Write the current status, replacing status.json atomically, and log a one-line summary.
+        """
+        status = self.status()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+        summary = f"[{self.model_name}] {status['done']}{f'/{self.total}' if self.total is not None else ''} instances done, {status['throughput']:.2f}/s"
+        if status['eta_seconds'] is not None:
+            summary += f", ETA {status['eta_seconds'] / 60:.1f} min"
+        if 'inference' in status['results']:
+            summary += f", F1 {status['results']['inference']['f1']*100:.2f}%"
+        if 'generation' in status['results']:
+            summary += f", score {status['results']['generation']['average_score']:.2f}"
+        logger.info(summary)
+        return status
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                # Reporting must never interrupt the evaluation
+                logger.warning(f"Failed to write evaluation status: {e}")
+
+    def start(self):
+        # Count the finished instances of a resumed run that predates the results store
+        self._store.import_json(self.model_name)
+        self._store.refresh_metrics(self.model_name)
+        self._start_time = time.monotonic()
+        self._start_done = self._store.progress(self.model_name, TASK_STAGES[self.task])['done']
+        self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop reporting and write the final status.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.write()
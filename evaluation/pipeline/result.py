@@ -2,8 +2,6 @@
 Result processing and aggregation utilities for evaluation pipeline.
 Provides functions to process, aggregate, and summarize evaluation results.
 """
-import os
-from utils.files import load_json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -29,15 +27,17 @@ def process_inference_result(inference_result):
     n_predicted = len(inference_result['inferred']['checklist'])
     true_matched = 0
     predicted_matched = 0
+    # Entries matched without a matcher call (an empty inferred checklist) have a score but no label
     for result in inference_result['match']['gt_to_infer']:
-        true_matched += match_label_to_score(result['label'])
+        true_matched += match_label_to_score(result.get('label'))
     for result in inference_result['match']['infer_to_gt']:
-        predicted_matched += match_label_to_score(result['label'])
+        predicted_matched += match_label_to_score(result.get('label'))
     return {
         "true_matched": true_matched,
         "predicted_matched": predicted_matched,
         "n_true": n_true,
-        "n_predicted": n_predicted
+        "n_predicted": n_predicted,
+        "truncated": 'truncation' in inference_result
     }
 
 def process_generation_result(generation_result):
@@ -61,24 +61,20 @@ def process_generation_result(generation_result):
             logger.error(f"Error parsing generation score: {e}\nScore value: {score}")
             score = 0
     return {
-        "score": score
+        "score": score,
+        "truncated": 'truncation' in generation_result
     }
 
 def process_results(results_dir, model_name, task):
     """
-    Process all result files for a given model and return a dictionary of results.
+    Process all stored results for a given model and return a dictionary of results.
     """
-    results_files = os.listdir(f"{results_dir}/{model_name}")
+    from evaluation.pipeline.store import get_results_store
+    store = get_results_store(results_dir)
+    # Runs from before the results store left one JSON file per instance
+    store.import_json(model_name)
     results = {}
-    for result_file in results_files:
-        if result_file == "results.json":
-            continue
-        instance_name = result_file.split(".")[0]
-        try:
-            result = load_json(f"{results_dir}/{model_name}/{result_file}")
-        except Exception as e:
-            logger.error(f"Error loading result file {result_file}: {e}")
-            continue
+    for instance_name, result in store.iter_results(model_name):
         results[instance_name] = {}
         if task in ["inference", "both"]:
             results[instance_name]['inference'] = process_inference_result(result['inference'])
@@ -99,53 +95,77 @@ def calculate_prf(n_true, n_predicted, true_matched, predicted_matched):
         "f1": f1
     }
 
-def aggregate_results(results_dir, model_name, task):
+def summarize_totals(totals, task):
     """
-    Aggregate all processed results for a model and return summary statistics.
-    """
-    results = process_results(results_dir, model_name, task)
-    aggregated_results = {
-        "inference": {
-            "precision": 0,
-            "recall": 0,
-            "f1": 0,
-            "n_true_matched": 0,
-            "n_predicted_matched": 0,
-            "n_true": 0,
-            "n_predicted": 0
-        },
-        "generation": {
-            "average_score": 0,
-            "n_instances": 0,
-            "total_score": 0
-        }
-    }
-    for instance_name, result in results.items():
-        if task in ["inference", "both"]:
-            aggregated_results['inference']['n_true_matched'] += result['inference']['true_matched']
-            aggregated_results['inference']['n_predicted_matched'] += result['inference']['predicted_matched']
-            aggregated_results['inference']['n_true'] += result['inference']['n_true']
-            aggregated_results['inference']['n_predicted'] += result['inference']['n_predicted']
-        if task in ["generation", "both"]:
-            aggregated_results['generation']['total_score'] += result['generation']['score']
-            aggregated_results['generation']['n_instances'] += 1
+    Turn summed metrics (see ResultsStore.totals) into summary statistics.
+    """
+    inference = totals['inference']
+    generation = totals['generation']
+    aggregated_results = {}
     if task in ["inference", "both"]:
-        inference_prf = calculate_prf(
-            aggregated_results['inference']['n_true'],
-            aggregated_results['inference']['n_predicted'],
-            aggregated_results['inference']['n_true_matched'],
-            aggregated_results['inference']['n_predicted_matched']
-        )
-        aggregated_results['inference']['precision'] = inference_prf['precision']
-        aggregated_results['inference']['recall'] = inference_prf['recall']
-        aggregated_results['inference']['f1'] = inference_prf['f1']
+        aggregated_results['inference'] = {
+            **calculate_prf(
+                inference['n_true'],
+                inference['n_predicted'],
+                inference['n_true_matched'],
+                inference['n_predicted_matched']
+            ),
+            "n_true_matched": inference['n_true_matched'],
+            "n_predicted_matched": inference['n_predicted_matched'],
+            "n_true": inference['n_true'],
+            "n_predicted": inference['n_predicted'],
+            "n_truncated": inference['n_truncated']
+        }
+    if task in ["generation", "both"]:
+        aggregated_results['generation'] = {
+            "average_score": generation['total_score'] / generation['n_instances'] if generation['n_instances'] > 0 else 0,
+            "n_instances": generation['n_instances'],
+            "n_truncated": generation['n_truncated']
+        }
+    return aggregated_results
+
+def aggregate_results(results_dir, model_name, task):
+    """
+    Aggregate all stored results for a model and return summary statistics.
+    The per-instance metrics are kept up to date by the results store, so this is a single query.
+    """
+    from evaluation.pipeline.store import get_results_store
+    store = get_results_store(results_dir)
+    # Runs from before the results store left one JSON file per instance
+    store.import_json(model_name)
+    store.refresh_metrics(model_name)
+    return summarize_totals(store.totals(model_name), task)
 
-    if aggregated_results['generation']['n_instances'] > 0:
-        aggregated_results['generation']['average_score'] = aggregated_results['generation']['total_score'] / aggregated_results['generation']['n_instances']
-    del aggregated_results['generation']['total_score']
+# Leaderboard columns of each task: (column, section, metric); breakdown metrics are read from their overall value
+LEADERBOARD_METRICS = {
+    "inference": [
+        ("precision", "inference", "precision"),
+        ("recall", "inference", "recall"),
+        ("f1", "inference", "f1"),
+        ("macro_f1", "inference", "macro_f1")
+    ],
+    "generation": [
+        ("average_score", "generation", "average_score")
+    ]
+}
 
-    if task == "generation":
-        del aggregated_results['inference']
-    elif task == "inference":
-        del aggregated_results['generation']
-    return aggregated_results
\ No newline at end of file
+def leaderboard(results_by_model, task):
+    """
+    Return the models x metrics matrix of several models' results.json contents, ranked by the
+    first metric of the task.
+    """
+    columns = [column for section in ["inference", "generation"] if task in [section, "both"] for column in LEADERBOARD_METRICS[section]]
+    rows = {}
+    for model_name, results in results_by_model.items():
+        row = {}
+        for column, section, metric in columns:
+            value = results[section].get(metric)
+            if value is None:
+                value = results.get("breakdown", {}).get(section, {}).get("overall", {}).get(metric, {}).get("value")
+            row[column] = value
+        rows[model_name] = row
+    ranked = sorted(rows, key=lambda model_name: rows[model_name][columns[0][0]] or 0, reverse=True)
+    return {
+        "metrics": [column for column, _, _ in columns],
+        "models": {model_name: rows[model_name] for model_name in ranked}
+    }
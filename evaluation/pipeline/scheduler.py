@@ -0,0 +1,238 @@
+"""
+Stage-pipelined evaluation scheduler.
+Inference, matching, generation and judging run as separate stages connected by bounded queues, so
+instances finished by a slow evaluated model are matched and judged by the evaluator while the next
+ones are still being generated. Each stage has its own number of workers and an optional budget of
+tasks started per minute (PIPELINE_STAGES), since the evaluated model and the evaluator have very
+different rate limits. Queue depth, running tasks and throughput of every stage are logged every
+PIPELINE_REPORT_INTERVAL seconds and saved to {results_dir}/{model_name}/pipeline.json.
+With matcher_batch_size > 1, the matching stage packs the pairs of the instances waiting in its queue
+into shared matcher requests. Several models can share one pipeline: every instance is loaded once and
+queued for each model in turn, and each model gets its own pipeline.json.
+"""
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.files import save_json, ensure_directory
+from utils.usage import usage_scope, flush_usage
+from utils.transport import flush_http_stats
+from utils.replay import flush_replay
+from utils.rate_limit import RateLimiter
+from config import PIPELINE_STAGES, PIPELINE_QUEUE_SIZE, PIPELINE_REPORT_INTERVAL, RATE_LIMIT_PATH
+from evaluation.pipeline.evaluate import iter_model_instances, model_names
+from evaluation.pipeline.context import init_evaluation_context
+from evaluation.pipeline.async_evaluate import EvaluationJob, run_inference, run_matching, run_matching_batch, run_generation, run_judging
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["inference", "matching", "generation", "judging"]
+
+class Stage:
+    """
+    A pool of workers that runs `run(job)` on the jobs in its queue and hands the successful ones downstream.
+    With batch_size > 1, `run(jobs)` takes up to batch_size waiting jobs at once and returns a result per job.
+    """
+    def __init__(self, name, run, concurrency, rpm=None, queue_size=PIPELINE_QUEUE_SIZE, downstream=None, limiter=None, batch_size=1):
+        self.name = name
+        self.run = run
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.downstream = downstream
+        self.limiter = limiter if rpm is not None else None
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.busy_seconds = 0.0
+        self.budget_wait_seconds = 0.0
+
+    async def put(self, job):
+        await self.queue.put(job)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    async def worker(self):
+        while True:
+            jobs = [await self.queue.get()]
+            # Batches only take what is already waiting, so a lone job is never held back
+            while len(jobs) < self.batch_size and not self.queue.empty():
+                jobs.append(self.queue.get_nowait())
+            try:
+                if self.limiter is not None:
+                    start = time.monotonic()
+                    await self.limiter.aacquire([f"stage:{self.name}"], 0)
+                    self.budget_wait_seconds += time.monotonic() - start
+                self.running += 1
+                start = time.monotonic()
+                try:
+                    with usage_scope(jobs[0].model_name):
+                        if self.batch_size > 1:
+                            proceed = await self.run(jobs)
+                        else:
+                            proceed = [await self.run(jobs[0])]
+                finally:
+                    self.running -= 1
+                    self.busy_seconds += time.monotonic() - start
+                for job, ok in zip(jobs, proceed):
+                    if ok:
+                        self.done += 1
+                        if self.downstream is not None:
+                            await self.downstream.put(job)
+                    else:
+                        self.failed += 1
+            except Exception as e:
+                self.failed += len(jobs)
+                logger.error(f"[{jobs[0].model_name}] {', '.join(str(job.instance_name) for job in jobs)}: {self.name} stage failed: {e}")
+            finally:
+                for _ in jobs:
+                    self.queue.task_done()
+
+    def stats(self, elapsed):
+        return {
+            "concurrency": self.concurrency,
+            "batch_size": self.batch_size,
+            "rpm": self.rpm,
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "running": self.running,
+            "done": self.done,
+            "failed": self.failed,
+            "throughput": self.done / elapsed if elapsed > 0 else 0,
+            "utilization": self.busy_seconds / (elapsed * self.concurrency) if elapsed > 0 else 0,
+            "budget_wait_seconds": round(self.budget_wait_seconds, 3)
+        }
+
+def parse_stage_options(text):
+    """
+    Parse "stage=value,..." (e.g. "inference=8,judging=64") into {stage: int}.
+    """
+    options = {}
+    if not text:
+        return options
+    for item in text.split(","):
+        stage, _, value = item.partition("=")
+        stage = stage.strip()
+        if stage not in STAGES or not value:
+            raise Exception(f"Invalid stage option '{item}': expected one of {', '.join(STAGES)} as stage=value")
+        options[stage] = int(value)
+    return options
+
+def stage_config(concurrency=None, rpm=None):
+    """
+    Return PIPELINE_STAGES with the given per-stage overrides applied.
+    """
+    config = {stage: dict(PIPELINE_STAGES[stage]) for stage in STAGES}
+    for stage, value in (concurrency or {}).items():
+        config[stage]["concurrency"] = value
+    for stage, value in (rpm or {}).items():
+        config[stage]["rpm"] = value
+    return config
+
+def log_stage_stats(model_name, stats):
+    for name, stage in stats["stages"].items():
+        logger.info(
+            f"[{model_name}] {name}: queue {stage['queue_depth']} (max {stage['max_queue_depth']}), "
+            f"{stage['running']}/{stage['concurrency']} running, {stage['done']} done, {stage['failed']} failed, "
+            f"{stage['throughput']:.2f}/s, {stage['utilization']*100:.0f}% busy"
+        )
+
+async def aevaluate_pipelined(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, task="both", stages=None, oversize_policy="skip", matcher_batch_size=1):
+    """
+    Evaluate all instances with the stages pipelined. Returns the per-stage stats.
+    model_name may be a list of models, whose instances then share the stages.
+    """
+    stages = stages or stage_config()
+    models = model_names(model_name)
+    for name in models:
+        ensure_directory(f"{results_dir}/{name}")
+    # Models without a native acall run in the loop's default executor; size it for every stage at once
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=sum(stage["concurrency"] for stage in stages.values()))
+    )
+    limits = {f"stage:{name}": {"rpm": stage["rpm"]} for name, stage in stages.items() if stage["rpm"] is not None}
+    limiter = RateLimiter(RATE_LIMIT_PATH, limits) if limits else None
+
+    def make_stage(name, run, downstream=None, batch_size=1):
+        return Stage(name, run, stages[name]["concurrency"], rpm=stages[name]["rpm"], downstream=downstream, limiter=limiter, batch_size=batch_size)
+
+    active = {}
+    if task in ["inference", "both"]:
+        # Every instance contributes two pairs (one per direction) to a matcher batch
+        if matcher_batch_size // 2 > 1:
+            active["matching"] = make_stage("matching", run_matching_batch, batch_size=matcher_batch_size // 2)
+        else:
+            active["matching"] = make_stage("matching", run_matching)
+        active["inference"] = make_stage("inference", run_inference, downstream=active["matching"])
+    if task in ["generation", "both"]:
+        active["judging"] = make_stage("judging", run_judging)
+        active["generation"] = make_stage("generation", run_generation, downstream=active["judging"])
+    entry_stages = [active[name] for name in ["inference", "generation"] if name in active]
+
+    start = time.monotonic()
+
+    def collect_stats():
+        elapsed = time.monotonic() - start
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "stages": {name: active[name].stats(elapsed) for name in STAGES if name in active}
+        }
+
+    async def feed():
+        for name, instance_name, instance_data in iter_model_instances(models, data_dir):
+            try:
+                job = await EvaluationJob(name, evaluator_model, instance_name, instance_data, results_dir, use_matcher=use_matcher, oversize_policy=oversize_policy, matcher_batch_size=matcher_batch_size).aload()
+            except Exception as e:
+                logger.error(f"[{name}] {instance_name}: Evaluation failed: {e}")
+                continue
+            # Blocks while the entry stages are full, so instances are loaded only as fast as they are evaluated
+            for stage in entry_stages:
+                await stage.put(job)
+
+    async def report():
+        while True:
+            await asyncio.sleep(PIPELINE_REPORT_INTERVAL)
+            log_stage_stats(", ".join(models), collect_stats())
+            for name in models:
+                await asyncio.to_thread(flush_usage, f"{results_dir}/{name}", scope=name)
+
+    workers = [
+        asyncio.create_task(stage.worker())
+        for stage in active.values()
+        for _ in range(stage.concurrency)
+    ]
+    reporter = asyncio.create_task(report())
+    try:
+        await feed()
+        # Upstream stages hand their jobs on before marking them done, so joining in order drains the pipeline
+        for name in STAGES:
+            if name in active:
+                await active[name].queue.join()
+    finally:
+        for worker in workers + [reporter]:
+            worker.cancel()
+        await asyncio.gather(*workers, reporter, return_exceptions=True)
+        for name in models:
+            await asyncio.to_thread(flush_usage, f"{results_dir}/{name}", scope=name)
+            await asyncio.to_thread(flush_http_stats, f"{results_dir}/{name}")
+        await asyncio.to_thread(flush_replay)
+
+    stats = collect_stats()
+    log_stage_stats(", ".join(models), stats)
+    if len(models) > 1:
+        stats["models"] = models
+    for name in models:
+        stats["context"] = init_evaluation_context(name, evaluator_model, use_matcher, oversize_policy, matcher_batch_size).stats()
+        save_json(f"{results_dir}/{name}/pipeline.json", stats, indent=2)
+    return stats
+
+def evaluate_pipelined(model_name, evaluator_model, results_dir, data_dir=None, use_matcher=False, task="both", stages=None, oversize_policy="skip", matcher_batch_size=1):
+    """
+    Run the evaluation pipeline for all data instances with the pipelined scheduler.
+    """
+    return asyncio.run(aevaluate_pipelined(
+        model_name, evaluator_model, results_dir, data_dir,
+        use_matcher=use_matcher, task=task, stages=stages, oversize_policy=oversize_policy,
+        matcher_batch_size=matcher_batch_size
+    ))
@@ -0,0 +1,316 @@
+"""
+Transactional store for evaluation results.
+
+Results of all models evaluated into a results directory live in one SQLite
+database, {results_dir}/results.sqlite, in WAL mode. Each instance has one row
+per section ("inference", "generation"), and every pipeline stage upserts its
+section in a single transaction, so concurrent Pool workers and async tasks
+never see a half-written result and a crash loses at most the stage in flight.
+
+Result directories written before the store existed ({model}/{instance}.json
+files) are read through: instances missing from the store are loaded from their
+JSON file, and imported when results are aggregated. export_json writes the
+stored results back out as per-instance JSON files for inspection.
+
+The same transaction that saves a section also records which stages of the
+instance are done and, once a section is complete, the instance's contribution
+to the aggregate metrics (matched checklist counts, judge score). Running totals
+for a model are then a single SQL sum (see totals and progress), both for live
+status reports during a run and for the final results.json.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from utils.files import load_json, save_json
+from evaluation.pipeline.result import process_inference_result, process_generation_result
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ["inference", "generation"]
+
+# Stages recorded as done once their output key is in the section
+STAGE_KEYS = {
+    "inference": [("inference", "inferred"), ("matching", "match")],
+    "generation": [("generation", "ai_response"), ("judging", "alignment")]
+}
+
+INSTANCE_TYPES = ["consistent", "contrastive", "changing"]
+
+def infer_instance_type(instance_name):
+    """
+    Return the instance type named by a synthesized instance's "{persona}+{type}" name, or None.
+    """
+    instance_type = str(instance_name).rsplit("+", 1)[-1]
+    return instance_type if instance_type in INSTANCE_TYPES else None
+
+def section_metrics(section, data):
+    """
+    Return the metrics row of a complete section, or None if the section is not complete yet.
+    """
+    if section == "inference" and 'match' in data:
+        result = process_inference_result(data)
+        return (result['true_matched'], result['predicted_matched'], result['n_true'], result['n_predicted'], None, int(result['truncated']))
+    if section == "generation" and 'alignment' in data:
+        result = process_generation_result(data)
+        return (None, None, None, None, result['score'], int(result['truncated']))
+    return None
+
+# Aggregate outputs that share the model directory with legacy per-instance files
+NON_INSTANCE_FILES = ["results.json", "usage.json", "pipeline.json", "status.json"]
+
+_stores = {}
+
+class ResultsStore:
+    """
+    Per-section evaluation results shared across processes through SQLite.
+    """
+    def __init__(self, results_dir):
+        self.results_dir = results_dir
+        self.path = os.path.join(results_dir, "results.sqlite")
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(results_dir, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "model TEXT, instance TEXT, section TEXT, data TEXT, updated REAL, "
+            "PRIMARY KEY (model, instance, section))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS progress ("
+            "model TEXT, instance TEXT, stage TEXT, completed REAL, "
+            "PRIMARY KEY (model, instance, stage))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS metrics ("
+            "model TEXT, instance TEXT, section TEXT, true_matched REAL, predicted_matched REAL, "
+            "n_true INTEGER, n_predicted INTEGER, score REAL, truncated INTEGER, instance_type TEXT, "
+            "PRIMARY KEY (model, instance, section))"
+        )
+        # Stores written before instance types were tracked
+        if "instance_type" not in [row[1] for row in conn.execute("PRAGMA table_info(metrics)")]:
+            conn.execute("ALTER TABLE metrics ADD COLUMN instance_type TEXT")
+
+    def _connection(self):
+        # Connections must not be shared across forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _rows(self, sql, params):
+        conn = self._connection()
+        with self._lock:
+            return conn.execute(sql, params).fetchall()
+
+    def _record(self, conn, model_name, instance_name, section, data, now, instance_type=None):
+        for stage, key in STAGE_KEYS[section]:
+            if key in data:
+                conn.execute("INSERT OR IGNORE INTO progress VALUES (?, ?, ?, ?)", (model_name, instance_name, stage, now))
+        metrics = section_metrics(section, data)
+        if metrics is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics "
+                "(model, instance, section, true_matched, predicted_matched, n_true, n_predicted, score, truncated, instance_type) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (model_name, instance_name, section, *metrics, instance_type or infer_instance_type(instance_name))
+            )
+        else:
+            conn.execute("DELETE FROM metrics WHERE model = ? AND instance = ? AND section = ?", (model_name, instance_name, section))
+
+    def save(self, model_name, instance_name, section, data, instance_type=None):
+        """
+        Atomically replace one section of an instance's results, with its progress and metrics.
+        instance_type (consistent, contrastive or changing) labels the metrics for per-type breakdowns.
+        """
+        instance_name = str(instance_name)
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (model_name, instance_name, section, json.dumps(data, ensure_ascii=False), now)
+            )
+            self._record(conn, model_name, instance_name, section, data, now, instance_type)
+
+    def _save_all(self, conn, model_name, instance_name, results):
+        now = time.time()
+        for section in SECTIONS:
+            if results.get(section):
+                conn.execute(
+                    "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)",
+                    (model_name, str(instance_name), section, json.dumps(results[section], ensure_ascii=False), now)
+                )
+                self._record(conn, model_name, str(instance_name), section, results[section], now)
+
+    def load(self, model_name, instance_name):
+        """
+        Return the stored results of an instance as {section: data}, reading a legacy JSON file if it has none.
+        """
+        rows = self._rows(
+            "SELECT section, data FROM results WHERE model = ? AND instance = ?",
+            (model_name, str(instance_name))
+        )
+        if rows:
+            return {section: json.loads(data) for section, data in rows}
+        return load_json(os.path.join(self.results_dir, model_name, f"{instance_name}.json"), default={})
+
+    def import_json(self, model_name):
+        """
+        Import legacy per-instance JSON files of a model that are not in the store yet. Returns how many were imported.
+        """
+        model_dir = os.path.join(self.results_dir, model_name)
+        if not os.path.isdir(model_dir):
+            return 0
+        filenames = [
+            filename for filename in os.listdir(model_dir)
+            if filename.endswith(".json") and filename not in NON_INSTANCE_FILES
+        ]
+        if not filenames:
+            return 0
+        stored = {row[0] for row in self._rows("SELECT DISTINCT instance FROM results WHERE model = ?", (model_name,))}
+        imported = 0
+        with self._transaction() as conn:
+            for filename in filenames:
+                instance_name = filename.split(".")[0]
+                if instance_name in stored:
+                    continue
+                results = load_json(os.path.join(model_dir, filename), default=None)
+                if not isinstance(results, dict):
+                    logger.error(f"Error loading result file {filename}")
+                    continue
+                self._save_all(conn, model_name, instance_name, results)
+                imported += 1
+        if imported:
+            logger.info(f"Imported {imported} result files of {model_name} into {self.path}")
+        return imported
+
+    def refresh_metrics(self, model_name):
+        """
+        Record the progress and metrics of complete sections that have none, e.g. from a store written
+        before they were tracked.
+        """
+        rows = self._rows(
+            "SELECT r.instance, r.section, r.data FROM results r LEFT JOIN metrics m "
+            "ON r.model = m.model AND r.instance = m.instance AND r.section = m.section "
+            "WHERE r.model = ? AND m.instance IS NULL",
+            (model_name,)
+        )
+        rows = [(instance_name, section, json.loads(data)) for instance_name, section, data in rows]
+        rows = [row for row in rows if section_metrics(row[1], row[2]) is not None]
+        if not rows:
+            return
+        with self._transaction() as conn:
+            for instance_name, section, data in rows:
+                self._record(conn, model_name, instance_name, section, data, time.time())
+
+    def totals(self, model_name):
+        """
+        Return the summed metrics of a model's complete sections.
+        """
+        inference = self._rows(
+            "SELECT COUNT(*), SUM(true_matched), SUM(predicted_matched), SUM(n_true), SUM(n_predicted), SUM(truncated) "
+            "FROM metrics WHERE model = ? AND section = 'inference'",
+            (model_name,)
+        )[0]
+        generation = self._rows(
+            "SELECT COUNT(*), SUM(score), SUM(truncated) FROM metrics WHERE model = ? AND section = 'generation'",
+            (model_name,)
+        )[0]
+        return {
+            "inference": {
+                "n_instances": inference[0],
+                "n_true_matched": inference[1] or 0,
+                "n_predicted_matched": inference[2] or 0,
+                "n_true": inference[3] or 0,
+                "n_predicted": inference[4] or 0,
+                "n_truncated": inference[5] or 0
+            },
+            "generation": {
+                "n_instances": generation[0],
+                "total_score": generation[1] or 0,
+                "n_truncated": generation[2] or 0
+            }
+        }
+
+    def metric_rows(self, model_name, section):
+        """
+        Return (instance, instance_type, true_matched, predicted_matched, n_true, n_predicted, score) for
+        every complete section of a model.
+        """
+        return self._rows(
+            "SELECT instance, instance_type, true_matched, predicted_matched, n_true, n_predicted, score "
+            "FROM metrics WHERE model = ? AND section = ? ORDER BY instance",
+            (model_name, section)
+        )
+
+    def progress(self, model_name, stages):
+        """
+        Return how many instances of a model have completed each stage, and how many have completed all of `stages`.
+        """
+        counts = dict(self._rows("SELECT stage, COUNT(*) FROM progress WHERE model = ? GROUP BY stage", (model_name,)))
+        placeholders = ", ".join("?" for _ in stages)
+        done = self._rows(
+            f"SELECT COUNT(*) FROM (SELECT instance FROM progress WHERE model = ? AND stage IN ({placeholders}) "
+            "GROUP BY instance HAVING COUNT(DISTINCT stage) = ?)",
+            (model_name, *stages, len(stages))
+        )[0][0]
+        return {
+            "stages": {stage: counts.get(stage, 0) for stage in ["inference", "matching", "generation", "judging"]},
+            "done": done
+        }
+
+    def iter_results(self, model_name):
+        """
+        Yield (instance_name, {section: data}) for every instance of a model in the store.
+        """
+        rows = self._rows(
+            "SELECT instance, section, data FROM results WHERE model = ? ORDER BY instance",
+            (model_name,)
+        )
+        current, results = None, {}
+        for instance_name, section, data in rows:
+            if instance_name != current:
+                if current is not None:
+                    yield current, results
+                current, results = instance_name, {}
+            results[section] = json.loads(data)
+        if current is not None:
+            yield current, results
+
+    def export_json(self, model_name):
+        """
+        Write every stored instance of a model to {results_dir}/{model_name}/{instance_name}.json.
+        """
+        n_exported = 0
+        for instance_name, results in self.iter_results(model_name):
+            save_json(os.path.join(self.results_dir, model_name, f"{instance_name}.json"), results, indent=4)
+            n_exported += 1
+        return n_exported
+
+def get_results_store(results_dir):
+    """
+    Return the process-wide ResultsStore of a results directory.
+    """
+    if results_dir not in _stores:
+        _stores[results_dir] = ResultsStore(results_dir)
+    return _stores[results_dir]
@@ -3,27 +3,105 @@ CLI entrypoint for evaluation pipeline.
 Evaluates model performance on the CUPID dataset or locally synthesized data.
 
 Usage: python evaluation/run.py --results_dir <results_dir> --model <model> [other options]
+       python evaluation/run.py --results_dir <results_dir> --models <model>,<model>,... [other options]
 Run this script from the cupid root directory.
 """
 import argparse
 import logging
 import os
-from evaluation.pipeline.evaluate import evaluate_parallel
-from evaluation.pipeline.result import aggregate_results
+from evaluation.pipeline.evaluate import evaluate_parallel, count_instances
+from evaluation.pipeline.async_evaluate import evaluate_async
+from evaluation.pipeline.scheduler import evaluate_pipelined, parse_stage_options, stage_config
+from evaluation.pipeline.batch import evaluate_batch
+from evaluation.pipeline.result import aggregate_results, leaderboard
+from evaluation.pipeline.aggregate import aggregate_breakdown
+from evaluation.pipeline.store import get_results_store
+from evaluation.pipeline.progress import ProgressReporter
 from utils.files import save_json
+from utils.cache import get_response_cache
+from utils.singleflight import get_single_flight
+from utils.router import get_router
+from utils.replay import add_replay_arguments, setup_replay
+from utils.usage import aggregate_usage
+from utils.transport import aggregate_http_stats
 from utils.logging import setup_main_logging
+from utils.tokens import load_tokenizer
+from config import EVALUATION_CONCURRENCY, BOOTSTRAP_RESAMPLES
+
+def format_metric(metric, scale=1, unit=""):
+    """
+    Format a breakdown metric as "value [low, high]".
+    """
+    text = f"{metric['value']*scale:.2f}{unit}"
+    if "ci" in metric:
+        text += f" [{metric['ci'][0]*scale:.2f}, {metric['ci'][1]*scale:.2f}]"
+    return text
+
+def save_model_results(args, model_name, logger):
+    """
+    Aggregate, save and log the results and usage of one evaluated model. Returns its results.
+    """
+    results_dir = args.results_dir
+    if args.export_json:
+        n_exported = get_results_store(results_dir).export_json(model_name)
+        logger.info(f"Exported {n_exported} instance results to {results_dir}/{model_name}/")
+
+    results = aggregate_results(results_dir, model_name, args.task)
+    results["breakdown"] = aggregate_breakdown(results_dir, model_name, args.task, resamples=args.bootstrap_resamples)
+    save_json(f"{results_dir}/{model_name}/results.json", results, indent=2)
+    logger.info("Aggregation completed successfully!")
+    logger.info(f"Results saved to {results_dir}/{model_name}/results.json")
+    # Print main results
+    if args.task in ["inference", "both"]:
+        logger.info(f"Inference Results ({model_name}):")
+        logger.info(f"  Precision: {results['inference']['precision']*100:.2f}%")
+        logger.info(f"  Recall: {results['inference']['recall']*100:.2f}%")
+        logger.info(f"  F1: {results['inference']['f1']*100:.2f}%")
+        for instance_type, metrics in results["breakdown"]["inference"]["by_instance_type"].items():
+            logger.info(f"  F1 ({instance_type}, {metrics['n_instances']} instances): {format_metric(metrics['micro_f1'], 100, '%')}, macro {format_metric(metrics['macro_f1'], 100, '%')}")
+    if args.task in ["generation", "both"]:
+        logger.info(f"Generation Results ({model_name}):")
+        logger.info(f"  Average Score: {results['generation']['average_score']:.2f} / 10")
+        for instance_type, metrics in results["breakdown"]["generation"]["by_instance_type"].items():
+            logger.info(f"  Average Score ({instance_type}, {metrics['n_instances']} instances): {format_metric(metrics['average_score'])} / 10")
+    usage = aggregate_usage(f"{results_dir}/{model_name}")
+    usage["http"] = aggregate_http_stats(f"{results_dir}/{model_name}")
+    save_json(f"{results_dir}/{model_name}/usage.json", usage, indent=2)
+    logger.info(f"Usage: {usage['total']['requests']} requests, {usage['total']['input_tokens']} input tokens, {usage['total']['output_tokens']} output tokens, {usage['total']['cache_read_tokens']} cache-read / {usage['total']['cache_write_tokens']} cache-write input tokens (estimated cost: ${usage['total']['cost']:.2f})")
+    for host, stats in usage["http"].items():
+        logger.info(f"HTTP {host}: {stats['requests']} requests over {stats['connections']} connections ({stats['reuse_rate']*100:.1f}% reused)")
+    if usage['total'].get('context_builds'):
+        logger.info(f"Evaluation contexts: {usage['total']['context_builds']} built in {usage['total']['context_build_seconds']:.2f}s, reused for {usage['total'].get('context_reuses', 0)} instances")
+    logger.info(f"Usage breakdown saved to {results_dir}/{model_name}/usage.json")
+    return results
 
 def main():
     parser = argparse.ArgumentParser(description="Run the evaluation pipeline for CUPID.")
     parser.add_argument("--results_dir", type=str, help="Directory to store evaluation results", required=True)
-    parser.add_argument("--model", type=str, help="Model to be evaluated (must match a class in evaluation/models/)", required=True)
+    parser.add_argument("--model", type=str, help="Model to be evaluated (must match a class in evaluation/models/)")
+    parser.add_argument("--models", type=str, help="Comma-separated models to evaluate together in one run, sharing the data and the evaluator; also writes <results_dir>/leaderboard.json (instead of --model)")
     parser.add_argument("--data_dir", type=str, help="Directory containing data instances to evaluate if using locally synthesized data (default: evaluate using CUPID dataset)")
     parser.add_argument("--evaluator", type=str, default="gpt-4o-2024-11-20", help="Model used for evaluation functions (default: gpt-4o-2024-11-20)")
     parser.add_argument("--use_matcher", action="store_true", help="Use the preference matcher model (default: False)")
     parser.add_argument("--n_workers", type=int, default=1, help="Number of parallel workers (default: 1)")
+    parser.add_argument("--async_driver", action="store_true", help="Evaluate all instances as coroutines in one process instead of a worker pool (default: False)")
+    parser.add_argument("--concurrency", type=int, default=EVALUATION_CONCURRENCY, help=f"Instances in flight with --async_driver (default: {EVALUATION_CONCURRENCY})")
+    parser.add_argument("--pipelined", action="store_true", help="Run the evaluation stages as a pipeline with per-stage concurrency and budgets (default: False)")
+    parser.add_argument("--stage_concurrency", type=str, default=None, help="Per-stage workers with --pipelined, e.g. inference=8,judging=64 (default: PIPELINE_STAGES)")
+    parser.add_argument("--stage_rpm", type=str, default=None, help="Per-stage tasks started per minute with --pipelined, e.g. judging=500 (default: PIPELINE_STAGES)")
+    parser.add_argument("--export_json", action="store_true", help="Also write every instance's results from results.sqlite to <results_dir>/<model>/<instance>.json (default: False)")
+    parser.add_argument("--bootstrap_resamples", type=int, default=BOOTSTRAP_RESAMPLES, help=f"Bootstrap resamples for the confidence intervals in results.json, 0 to skip them (default: {BOOTSTRAP_RESAMPLES})")
     parser.add_argument("--log_file", type=str, default="log.txt", help="Path to log file (optional)")
+    parser.add_argument("--batch_mode", action="store_true", help="Send OpenAI/Anthropic requests through their batch APIs (default: False)")
+    parser.add_argument("--batch_poll_interval", type=int, default=60, help="Seconds between batch job status checks (default: 60)")
+    parser.add_argument("--matcher_batch_size", type=int, default=1, help="Checklist/preference pairs packed into one matcher request; 1 sends every pair on its own (default: 1)")
+    parser.add_argument("--oversize_policy", type=str, choices=["skip", "truncate"], default="skip", help="Prompts too long for the model's context window: skip the stage, or drop the oldest sessions until it fits (default: skip)")
     parser.add_argument("--task", type=str, choices=["inference", "generation", "both"], default="inference", help="Which evaluation stages to run: inference, generation, or both (default: inference)")
+    add_replay_arguments(parser)
     args = parser.parse_args()
+    if (args.model is None) == (args.models is None):
+        parser.error("exactly one of --model and --models is required")
+    models = [args.model] if args.model else [name.strip() for name in args.models.split(",") if name.strip()]
     results_dir = args.results_dir
     data_dir = args.data_dir
 
@@ -46,40 +124,104 @@ def main():
     logger.info(f"Starting evaluation pipeline with parameters:")
     logger.info(f"  Results directory: {results_dir}")
     logger.info(f"  Data: {data_dir if data_dir else 'CUPID dataset'}")
-    logger.info(f"  Evaluated Model: {args.model}")
+    logger.info(f"  Evaluated Model{'s' if len(models) > 1 else ''}: {', '.join(models)}")
     logger.info(f"  Evaluator Model: {args.evaluator}")
     logger.info(f"  Use PrefMatcher: {args.use_matcher}")
-    logger.info(f"  Workers: {args.n_workers}")
+    if args.pipelined:
+        stages = stage_config(parse_stage_options(args.stage_concurrency), parse_stage_options(args.stage_rpm))
+        stage_workers = ", ".join(f"{name} x{stage['concurrency']}" for name, stage in stages.items())
+        logger.info(f"  Pipelined stages: {stage_workers}")
+    elif args.async_driver:
+        logger.info(f"  Async driver concurrency: {args.concurrency}")
+    else:
+        logger.info(f"  Workers: {args.n_workers}")
+    logger.info(f"  Batch mode: {args.batch_mode}")
+    logger.info(f"  Matcher batch size: {args.matcher_batch_size}")
+    logger.info(f"  Oversize policy: {args.oversize_policy}")
+    if args.record or args.replay:
+        logger.info(f"  {'Recording to' if args.record else 'Replaying from'}: {args.record or args.replay}")
     logger.info(f"  Log file: {log_file_path}")
 
     try:
+        setup_replay(args)
+        # Open the circuit breakers of unreachable endpoints before any worker picks them
+        get_router().check_health()
+        # Loaded once here and inherited by the workers, rather than downloaded by each of them
+        load_tokenizer(models)
+
         # Evaluate the model on the specified data
         logger.info("Phase 1: Evaluating model performance...")
-        evaluate_parallel(
-            args.model,
-            args.evaluator,
-            results_dir,
-            data_dir,
-            use_matcher=args.use_matcher,
-            n_workers=args.n_workers,
-            task=args.task,
-            log_queue=log_queue,  # Pass the log queue
-        )
+        # Running metrics and progress go to <results_dir>/<model>/status.json while the evaluation runs
+        total = count_instances(data_dir)
+        reporters = [ProgressReporter(results_dir, model_name, args.task, total=total).start() for model_name in models]
+        if args.batch_mode:
+            # Batch jobs are tracked per model directory, so models are evaluated one after another
+            for model_name in models:
+                evaluate_batch(
+                    model_name,
+                    args.evaluator,
+                    results_dir,
+                    data_dir,
+                    use_matcher=args.use_matcher,
+                    task=args.task,
+                    poll_interval=args.batch_poll_interval,
+                    oversize_policy=args.oversize_policy,
+                    matcher_batch_size=args.matcher_batch_size,
+                )
+        elif args.pipelined:
+            evaluate_pipelined(
+                models,
+                args.evaluator,
+                results_dir,
+                data_dir,
+                use_matcher=args.use_matcher,
+                task=args.task,
+                stages=stages,
+                oversize_policy=args.oversize_policy,
+                matcher_batch_size=args.matcher_batch_size,
+            )
+        elif args.async_driver:
+            evaluate_async(
+                models,
+                args.evaluator,
+                results_dir,
+                data_dir,
+                use_matcher=args.use_matcher,
+                task=args.task,
+                concurrency=args.concurrency,
+                oversize_policy=args.oversize_policy,
+                matcher_batch_size=args.matcher_batch_size,
+            )
+        else:
+            evaluate_parallel(
+                models,
+                args.evaluator,
+                results_dir,
+                data_dir,
+                use_matcher=args.use_matcher,
+                n_workers=args.n_workers,
+                task=args.task,
+                log_queue=log_queue,  # Pass the log queue
+                oversize_policy=args.oversize_policy,
+                matcher_batch_size=args.matcher_batch_size,
+            )
+        for reporter in reporters:
+            reporter.stop()
         logger.info("Evaluation completed successfully!")
 
-        results = aggregate_results(results_dir, args.model, args.task)
-        save_json(f"{results_dir}/{args.model}/results.json", results, indent=2)
-        logger.info("Aggregation completed successfully!")
-        logger.info(f"Results saved to {results_dir}/{args.model}/results.json")
-        # Print main results
-        if args.task in ["inference", "both"]:
-            logger.info(f"Inference Results:")
-            logger.info(f"  Precision: {results['inference']['precision']*100:.2f}%")
-            logger.info(f"  Recall: {results['inference']['recall']*100:.2f}%")
-            logger.info(f"  F1: {results['inference']['f1']*100:.2f}%")
-        if args.task in ["generation", "both"]:
-            logger.info(f"Generation Results:")
-            logger.info(f"  Average Score: {results['generation']['average_score']:.2f} / 10")
+        results_by_model = {model_name: save_model_results(args, model_name, logger) for model_name in models}
+        if len(models) > 1:
+            board = leaderboard(results_by_model, args.task)
+            save_json(f"{results_dir}/leaderboard.json", board, indent=2)
+            logger.info(f"Leaderboard saved to {results_dir}/leaderboard.json")
+            width = max(len(model_name) for model_name in board["models"])
+            logger.info(f"  {'model'.ljust(width)}  " + "  ".join(f"{metric:>13}" for metric in board["metrics"]))
+            for model_name, row in board["models"].items():
+                logger.info(f"  {model_name.ljust(width)}  " + "  ".join(f"{row[metric] or 0:>13.4f}" for metric in board["metrics"]))
+        cache_stats = get_response_cache().stats()
+        logger.info(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['entries']} entries, {cache_stats['bytes'] / 1e6:.1f} MB)")
+        flight_stats = get_single_flight().stats()
+        logger.info(f"Single-flight: {flight_stats['saved_all_processes']} duplicate in-flight requests shared so far")
         
     except Exception as e:
         logger.error(f"Evaluation pipeline failed: {str(e)}")
@@ -11,14 +11,16 @@ class PreferenceDecomposer(Generator):
         prompt_path="synthesis/preference_decomposer.yaml", 
         temperature=0, 
         max_tokens=4096, 
-        verbose=False
+        verbose=False,
+        cache=True
     ):
         super().__init__(
             model_name, 
             prompt_path, 
             temperature=temperature, 
             max_tokens=max_tokens, 
-            verbose=verbose
+            verbose=verbose,
+            cache=cache
         )
     
     def __call__(self, preferences):
@@ -38,6 +40,19 @@ class PreferenceDecomposer(Generator):
             logger.error(f"Error decomposing preferences: {str(e)}")
             logger.exception("Full traceback for preference decomposition:")
             raise
+
+    async def acall(self, preferences):
+        """
+        Coroutine counterpart of __call__.
+        """
+        try:
+            output = await super().acall(preferences=preferences)
+            checklist = parse_json(output)['checklist']
+            logger.info(f"Successfully decomposed preferences into {len(checklist)} checklist items")
+            return checklist
+        except Exception as e:
+            logger.error(f"Error decomposing preferences: {str(e)}")
+            raise
     
     def decompose_for_sessions(self, sessions):
         try:
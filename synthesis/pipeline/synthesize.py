@@ -6,6 +6,9 @@ from synthesis.modules import ContextFactorsGenerator, SessionsGenerator, Prefer
 from utils.validation import validate_context_factors, validate_sessions
 from utils.files import load_json, save_json, ensure_directory
 from utils.logging import setup_worker_logging
+from utils.usage import usage_stage, flush_usage
+from utils.transport import flush_http_stats
+from utils.replay import flush_replay
 
 logger = logging.getLogger(__name__)
 
@@ -68,7 +71,8 @@ def synthesize_data(model_name: str, persona: dict, output_dir: str, n_factors:
         if 'context_factors' not in data:
             logger.info(f"[{persona_id} {occupation}] - Generating context factors...")
             try:
-                data['context_factors'] = context_generator(persona, n_factors=n_factors)
+                with usage_stage("context_factors"):
+                    data['context_factors'] = context_generator(persona, n_factors=n_factors)
                 
                 # Validate the generated context factors
                 is_valid, error_msg = validate_context_factors(data['context_factors'])
@@ -87,7 +91,8 @@ def synthesize_data(model_name: str, persona: dict, output_dir: str, n_factors:
         if 'sessions' not in data:
             logger.info(f"[{persona_id} {occupation}] - Generating interaction sessions...")
             try:
-                data['sessions'] = sessions_generator(persona, data['context_factors'], n_sessions=n_sessions)
+                with usage_stage("sessions"):
+                    data['sessions'] = sessions_generator(persona, data['context_factors'], n_sessions=n_sessions)
                 
                 # Validate the generated sessions
                 is_valid, error_msg = validate_sessions(data['sessions'], data['context_factors'], n_sessions)
@@ -96,7 +101,8 @@ def synthesize_data(model_name: str, persona: dict, output_dir: str, n_factors:
                     return
                 
                 # Decompose preference for each session to guide interaction generation
-                data['sessions'] = preference_decomposer.decompose_for_sessions(data['sessions'])
+                with usage_stage("decomposition"):
+                    data['sessions'] = preference_decomposer.decompose_for_sessions(data['sessions'])
                 logger.info(f"[{persona_id} {occupation}] - SUCCESS generated interaction sessions")
                 save_json(filename, data, indent=4)
             except Exception as e:
@@ -122,11 +128,12 @@ def synthesize_data(model_name: str, persona: dict, output_dir: str, n_factors:
                     
                     # Generate interaction with variable turn length
                     # Last session gets 0 turns (just the request), others get max_turns
-                    interaction = interaction_simulator(
-                        persona, 
-                        session, 
-                        max_turns=max_turns if i != len(data['sessions']) - 1 else 0
-                    )
+                    with usage_stage("interactions"):
+                        interaction = interaction_simulator(
+                            persona, 
+                            session, 
+                            max_turns=max_turns if i != len(data['sessions']) - 1 else 0
+                        )
                     interactions.append(interaction)
                     
                     # Save interactions incrementally
@@ -152,6 +159,10 @@ def synthesize_data(model_name: str, persona: dict, output_dir: str, n_factors:
         logger.error(f"[{persona_id} {occupation}] - FATAL ERROR in synthesize_data: {str(e)}")
         logger.exception(f"[{persona_id} {occupation}] - Full traceback for synthesize_data:")
         raise
+    finally:
+        flush_usage(output_dir)
+        flush_http_stats(output_dir)
+        flush_replay()
 
 def synthesize_data_parallel(model_name, personas: List[dict], output_dir: str, n_factors: int, n_sessions: int, max_turns: int, n_workers: int = 8, log_file_path: str = None, log_queue=None) -> None:
     """
@@ -12,6 +12,11 @@ from synthesis.pipeline.persona import generate_personas
 from synthesis.pipeline.synthesize import synthesize_data_parallel
 from synthesis.pipeline.instances import create_instances
 from utils.logging import setup_main_logging
+from utils.files import save_json
+from utils.usage import usage_stage, flush_usage, aggregate_usage
+from utils.transport import flush_http_stats, aggregate_http_stats
+from utils.router import get_router
+from utils.replay import add_replay_arguments, setup_replay, flush_replay
 
 def main():
     parser = argparse.ArgumentParser()
@@ -23,6 +28,7 @@ def main():
     parser.add_argument("--max_turns", type=int, default=16, help="Maximum number of turns per interaction (default: 16)")
     parser.add_argument("--n_workers", type=int, default=1, help="Number of parallel workers (default: 1)")
     parser.add_argument("--log_file", type=str, default="log.txt", help="Path to log file (optional)")
+    add_replay_arguments(parser)
     args = parser.parse_args()
     output_dir = args.output_dir
 
@@ -41,10 +47,20 @@ def main():
         logger.info(f"  Max turns: {args.max_turns}")
         logger.info(f"  Workers: {args.n_workers}")
         logger.info(f"  Log file: {args.log_file}")
+        if args.record or args.replay:
+            logger.info(f"  {'Recording to' if args.record else 'Replaying from'}: {args.record or args.replay}")
+        setup_replay(args)
+
+        # Open the circuit breakers of unreachable endpoints before any worker picks them
+        get_router().check_health()
 
         # Generate given number of personas
         logger.info("Phase 1: Generating personas...")
-        personas = generate_personas(args.model, args.n_personas, output_dir)
+        with usage_stage("personas"):
+            personas = generate_personas(args.model, args.n_personas, output_dir)
+        flush_usage(output_dir)
+        flush_http_stats(output_dir)
+        flush_replay()
         logger.info(f"Successfully generated {len(personas)} personas")
 
         # Synthesize context factors, sessions, and interactions for each persona
@@ -67,6 +83,11 @@ def main():
         create_instances(output_dir)
         logger.info("Instance creation completed successfully")
         logger.info("Synthesis pipeline completed successfully!")
+
+        usage = aggregate_usage(output_dir)
+        usage["http"] = aggregate_http_stats(output_dir)
+        save_json(f"{output_dir}/usage.json", usage, indent=2)
+        logger.info(f"Usage: {usage['total']['requests']} requests, {usage['total']['input_tokens']} input tokens, {usage['total']['output_tokens']} output tokens, {usage['total']['cache_read_tokens']} cache-read / {usage['total']['cache_write_tokens']} cache-write input tokens (estimated cost: ${usage['total']['cost']:.2f})")
     except Exception as e:
         logger = logging.getLogger(__name__)
         logger.error(f"Synthesis pipeline failed: {str(e)}")
@@ -0,0 +1,19 @@
+import pytest
+import utils.cache
+import utils.rate_limit
+import utils.router
+import utils.singleflight
+
+STORES = [utils.cache._caches, utils.rate_limit._limiters, utils.router._routers, utils.singleflight._single_flights]
+
+@pytest.fixture(autouse=True)
+def shared_stores(tmp_path, monkeypatch):
+    """
+    Run each test against fresh process-wide SQLite stores under a temporary directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    for stores in STORES:
+        stores.clear()
+    yield tmp_path
+    for stores in STORES:
+        stores.clear()
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import pytest
+import utils.generation
+import utils.async_generation
+
+pytest.importorskip("datasets")
+from utils.generation import generate
+from utils.cache import get_response_cache
+from evaluation.models.model import Model, register_model
+from evaluation.pipeline.async_evaluate import aevaluate
+from evaluation.pipeline.store import get_results_store
+
+@register_model
+class SyncOnlyModel(Model):
+    """
+    A model without a native acall, so the async driver runs it in worker threads.
+    """
+    model_name = "sync-only-test-model"
+
+    def __call__(self, system_prompt, user_prompt):
+        return generate("gpt-4.1-nano-2025-04-14", system_prompt, user_prompt, cache=get_response_cache())
+
+INSTANCE = {
+    "current_request": "Plan my week.",
+    "prior_interactions": [],
+    "current_contextual_preference": "Plans should be brief.",
+    "current_checklist": ["Is the plan brief?"]
+}
+
+def test_sync_model_runs_through_aevaluate(monkeypatch, tmp_path):
+    threads = []
+    def dispatch(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+        threads.append(threading.get_ident())
+        return "A brief plan."
+    async def adispatch(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+        return "Looks brief.\n\n### Evaluation Score\n\n5"
+    monkeypatch.setattr(utils.generation, "dispatch_provider", dispatch)
+    monkeypatch.setattr(utils.async_generation, "adispatch_provider", adispatch)
+
+    results_dir = str(tmp_path / "results")
+    for instance_name in ["instance_0", "instance_1"]:
+        asyncio.run(aevaluate(SyncOnlyModel.model_name, "gpt-4o-2024-11-20", instance_name, INSTANCE, results_dir, task="generation"))
+
+    store = get_results_store(results_dir)
+    for instance_name in ["instance_0", "instance_1"]:
+        generation = store.load(SyncOnlyModel.model_name, instance_name)['generation']
+        assert generation['ai_response'] == "A brief plan."
+        assert generation['alignment']['score'] == "5"
+    # The model ran in executor threads, and its second identical request was served from the cache
+    assert len(threads) == 1 and threads[0] != threading.get_ident()
+    assert get_response_cache().stats()['hits'] >= 1
+
+@register_model
+class TruncatedTestModel(SyncOnlyModel):
+    """
+    A model with the context window of gpt-4o, for logs whose oldest session does not fit.
+    """
+    model_name = "gpt-4o-truncate-test"
+    max_tokens = 8192
+
+def test_aevaluate_records_truncation(monkeypatch, tmp_path):
+    monkeypatch.setattr(utils.generation, "dispatch_provider", lambda *args, **kwargs: "A brief plan.")
+    async def adispatch(*args, **kwargs):
+        return "### Evaluation Score\n\n5"
+    monkeypatch.setattr(utils.async_generation, "adispatch_provider", adispatch)
+    instance = dict(INSTANCE, prior_interactions=[
+        {"dialogue": [{"role": "user", "content": "word " * 600000}]},
+        {"dialogue": [{"role": "user", "content": "Keep it short."}]}
+    ])
+
+    results_dir = str(tmp_path / "results")
+    asyncio.run(aevaluate(TruncatedTestModel.model_name, "gpt-4o-2024-11-20", "instance_0", instance, results_dir, task="generation", oversize_policy="truncate"))
+
+    generation = get_results_store(results_dir).load(TruncatedTestModel.model_name, "instance_0")['generation']
+    assert generation['ai_response'] == "A brief plan."
+    assert generation['truncation']['sessions_dropped'] == 1
@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("datasets")
+from evaluation.models.model import Model, register_model
+from evaluation.pipeline.evaluate import evaluate
+from evaluation.pipeline.store import get_results_store
+
+@register_model
+class OversizeTestModel(Model):
+    """
+    A model with the context window of gpt-4o, which no instance below fits.
+    """
+    model_name = "gpt-4o-oversize-test"
+    max_tokens = 8192
+
+    def __call__(self, system_prompt, user_prompt):
+        raise AssertionError("oversize prompts must not be sent")
+
+# About 750k tokens by the character estimate, and more with tiktoken
+OVERSIZE_INSTANCE = {
+    "current_request": "Plan my week.",
+    "prior_interactions": [{"dialogue": [{"role": "user", "content": "word " * 600000}]}],
+    "current_contextual_preference": "Plans should be brief.",
+    "current_checklist": ["Is the plan brief?"]
+}
+
+def test_sync_evaluate_skips_oversize_generation(tmp_path):
+    results_dir = str(tmp_path / "results")
+    evaluate(OversizeTestModel.model_name, "gpt-4o-2024-11-20", "instance_0", OVERSIZE_INSTANCE, results_dir, task="generation")
+
+    generation = get_results_store(results_dir).load(OversizeTestModel.model_name, "instance_0")['generation']
+    assert generation['user_request'] == OVERSIZE_INSTANCE['current_request']
+    assert generation['ai_response'] == "ERROR: Context length exceeded"
+    assert generation['alignment']['score'] == 0
+
+def test_sync_evaluate_scores_empty_inferred_checklist(tmp_path):
+    results_dir = str(tmp_path / "results")
+    evaluate(OversizeTestModel.model_name, "gpt-4o-2024-11-20", "instance_0", OVERSIZE_INSTANCE, results_dir, task="inference")
+
+    store = get_results_store(results_dir)
+    inference = store.load(OversizeTestModel.model_name, "instance_0")['inference']
+    assert inference['inferred']['checklist'] == []
+    assert inference['match']['gt_to_infer'] == [{"entry": "Is the plan brief?", "score": 0}]
+    assert store.metric_rows(OversizeTestModel.model_name, "inference") == [("instance_0", None, 0, 0, 1, 0, None)]
@@ -0,0 +1,46 @@
+import time
+import asyncio
+import utils.usage
+from utils.usage import add_usage
+from utils.hedging import get_latency_tracker, run_with_deadline, arun_with_deadline
+
+def seed_latencies(model_name):
+    # Recent latencies of 50 ms make a call still running after 50 ms get a hedge
+    for _ in range(50):
+        get_latency_tracker().record(model_name, 0.05)
+
+def buffered_usage(model_name):
+    return {key[2]: totals for key, totals in utils.usage._buffer.items()}.get(model_name)
+
+def test_only_the_winning_call_records_usage(monkeypatch):
+    monkeypatch.setattr(utils.usage, "_buffer", {})
+    seed_latencies("hedge-usage-model")
+    outputs = iter(["slow", "fast"])
+
+    def call():
+        output = next(outputs)
+        time.sleep(0.3 if output == "slow" else 0.01)
+        add_usage("hedge-usage-model", {"requests": 1, "output_tokens": len(output)})
+        return output
+
+    assert run_with_deadline("hedge-usage-model", call, deadline=5, hedge=True) == "fast"
+    # Let the losing call finish
+    time.sleep(0.4)
+    usage = buffered_usage("hedge-usage-model")
+    assert usage['requests'] == 1 and usage['output_tokens'] == len("fast")
+    assert usage['hedges'] == 1
+
+def test_only_the_winning_task_records_usage(monkeypatch):
+    monkeypatch.setattr(utils.usage, "_buffer", {})
+    seed_latencies("ahedge-usage-model")
+    outputs = iter(["slow", "fast"])
+
+    async def call():
+        output = next(outputs)
+        await asyncio.sleep(0.3 if output == "slow" else 0.01)
+        add_usage("ahedge-usage-model", {"requests": 1, "output_tokens": len(output)})
+        return output
+
+    assert asyncio.run(arun_with_deadline("ahedge-usage-model", call, deadline=5, hedge=True)) == "fast"
+    usage = buffered_usage("ahedge-usage-model")
+    assert usage['requests'] == 1 and usage['output_tokens'] == len("fast")
@@ -0,0 +1,37 @@
+import json
+import threading
+import pytest
+import utils.generation
+
+pytest.importorskip("datasets")
+from utils.cache import get_response_cache
+from evaluation.modules.preference_matcher import PreferenceMatcher
+
+def fake_dispatch(calls):
+    def dispatch(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+        calls.append(threading.get_ident())
+        prompt = messages[-1]['content']
+        checklist = [line.split(". ", 1)[1] for line in prompt.splitlines() if line[:1].isdigit() and ". " in line]
+        return json.dumps({"results": [
+            {"index": i + 1, "entry": entry, "label": "Fully Covered"} for i, entry in enumerate(checklist)
+        ]})
+    return dispatch
+
+def test_match_pairs_uses_cache_from_worker_threads(monkeypatch):
+    calls = []
+    monkeypatch.setattr(utils.generation, "dispatch_provider", fake_dispatch(calls))
+    matcher = PreferenceMatcher()
+    pairs = [(["Is it short?"], "Keep it short."), (["Is it formal?", "Is it cited?"], "Formal, with citations.")]
+
+    matches = matcher.match_pairs(pairs)
+    assert [[result['entry'] for result in results] for results, _ in matches] == [checklist for checklist, _ in pairs]
+    assert len(calls) == 2
+    # The calls ran in the executor's threads, not the one that opened the cache
+    assert threading.get_ident() not in calls
+
+    # A second run is served from the cache by the worker threads
+    assert [results for results, _ in matcher.match_pairs(pairs)] == [results for results, _ in matches]
+    assert len(calls) == 2
+    stats = get_response_cache().stats()
+    assert stats['hits'] == 2
+    assert stats['entries'] == 2
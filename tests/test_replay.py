@@ -0,0 +1,54 @@
+import time
+import utils.generation
+from utils.cache import get_response_cache, make_cache_key
+from utils.generation import generate
+from utils.hedging import run_with_deadline, get_latency_tracker
+from utils.replay import ReplayBackend, set_replay_backend, replay_exchange, flush_replay
+
+def replay_backend(path, mode):
+    backend = ReplayBackend(str(path), mode, strict=True)
+    set_replay_backend(backend)
+    return backend
+
+def test_cache_hits_are_recorded(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.generation, "dispatch_provider", lambda *args, **kwargs: "uncached")
+    cache = get_response_cache()
+    # Cached before the recording starts
+    cache.set(make_cache_key("gpt-4o-2024-11-20", "system", "cached prompt", 0.0, 1024), "first")
+    try:
+        replay_backend(tmp_path / "tape", "record")
+        # Answered from the cache, so the provider is not called again
+        assert generate("gpt-4o-2024-11-20", "system", "cached prompt", cache=cache) == "first"
+        flush_replay()
+
+        # A replay with a cold cache finds the request on the tape
+        cache.clear()
+        replay_backend(tmp_path / "tape", "replay")
+        assert generate("gpt-4o-2024-11-20", "system", "cached prompt", cache=cache) == "first"
+    finally:
+        set_replay_backend(None)
+
+def test_hedged_call_is_recorded_once(tmp_path):
+    # Recent latencies of 50 ms make a call still running after 50 ms get a hedge
+    for _ in range(50):
+        get_latency_tracker().record("hedge-test-model", 0.05)
+    backend = replay_backend(tmp_path / "tape", "record")
+    outputs = iter(["slow", "fast"])
+
+    def provider_call():
+        output = next(outputs)
+        time.sleep(0.3 if output == "slow" else 0.01)
+        return output
+    try:
+        with replay_exchange("hedge-test-model", "system", "hedged prompt", 0, 16):
+            result = run_with_deadline(
+                "hedge-test-model",
+                lambda: backend.call("hedge-test-model", "system", ["hedged prompt"], provider_call),
+                deadline=5,
+                hedge=True
+            )
+        time.sleep(0.4)
+    finally:
+        set_replay_backend(None)
+    assert result == "fast"
+    assert [entry['output'] for entry in backend._buffer] == ["fast"]
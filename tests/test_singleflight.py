@@ -0,0 +1,41 @@
+import time
+import threading
+import utils.singleflight
+from utils.singleflight import SingleFlight
+
+def test_single_process_skips_the_shared_table(monkeypatch, tmp_path):
+    def claim(self, key, waited=False):
+        raise AssertionError("a process running alone must not claim flights in the shared table")
+    monkeypatch.setattr(SingleFlight, "_claim", claim)
+    flight = SingleFlight(str(tmp_path / "flights.sqlite"))
+    assert flight.do("key", lambda: "output") == "output"
+
+def test_finished_flight_is_not_reused(monkeypatch, tmp_path):
+    monkeypatch.setattr(utils.singleflight, "_shared", lambda: True)
+    flight = SingleFlight(str(tmp_path / "flights.sqlite"))
+    assert flight.do("key", lambda: "first") == "first"
+    # A request made after the flight finished is sent again, as with cache=False
+    assert flight.do("key", lambda: "second") == "second"
+    # Callers that were waiting on the flight still read its result
+    assert flight._claim("key", waited=True) == (False, "second")
+
+def test_waiting_process_shares_the_result(monkeypatch, tmp_path):
+    monkeypatch.setattr(utils.singleflight, "_shared", lambda: True)
+    path = str(tmp_path / "flights.sqlite")
+    # Two instances on one file stand in for two processes
+    leader, follower = SingleFlight(path), SingleFlight(path)
+    results = []
+
+    def lead():
+        time.sleep(0.3)
+        return "shared"
+    thread = threading.Thread(target=lambda: results.append(leader.do("key", lead)))
+    thread.start()
+    time.sleep(0.1)
+
+    def follow():
+        raise AssertionError("the follower must wait for the leader")
+    assert follower.do("key", follow) == "shared"
+    thread.join()
+    assert results == ["shared"]
+    assert follower.stats()['saved_all_processes'] == 1
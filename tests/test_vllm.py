@@ -0,0 +1,103 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import utils.providers
+import utils.async_generation
+from config import PREFMATCHER_MODEL_NAME
+from utils.generation import generate_vllm
+from utils.async_generation import agenerate
+from utils.hedging import run_with_deadline, DeadlineExceeded
+
+class StubServer(ThreadingHTTPServer):
+    """
+    OpenAI-compatible chat completions endpoint that echoes the last message and tracks concurrent requests.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.in_flight += 1
+            server.requests += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(5 if request['messages'][-1]['content'] == "slow" else 0.02)
+        with server.lock:
+            server.in_flight -= 1
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request['model'],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"echo: {request['messages'][-1]['content']}"},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8}
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    server = StubServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setattr(utils.providers, "VLLM_HOST", host)
+    monkeypatch.setattr(utils.providers, "_clients", {})
+    monkeypatch.setattr(utils.async_generation, "VLLM_HOST", host)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_generate_vllm_against_stub_server(stub_server):
+    output = generate_vllm(PREFMATCHER_MODEL_NAME, [{"role": "user", "content": "hello"}], 0, 16)
+    assert output == "echo: hello"
+    assert stub_server.requests == 1
+
+def test_vllm_concurrency_is_capped_by_provider_concurrency(stub_server, monkeypatch):
+    monkeypatch.setitem(utils.async_generation.PROVIDER_CONCURRENCY, "vllm", 3)
+    prompts = [f"request {i}" for i in range(12)]
+
+    async def run():
+        return await asyncio.gather(*[agenerate(PREFMATCHER_MODEL_NAME, "system", prompt, temperature=0.0) for prompt in prompts])
+
+    outputs = asyncio.run(run())
+    assert outputs == [f"echo: {prompt}" for prompt in prompts]
+    assert stub_server.requests == len(prompts)
+    assert stub_server.max_in_flight <= 3
+
+def test_call_past_its_deadline_ends_promptly(stub_server):
+    finished = []
+    def call():
+        try:
+            return generate_vllm(PREFMATCHER_MODEL_NAME, [{"role": "user", "content": "slow"}], 0, 16)
+        finally:
+            finished.append(time.monotonic())
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        run_with_deadline(PREFMATCHER_MODEL_NAME, call, deadline=0.5, hedge=False)
+    # The abandoned call times out with its deadline instead of waiting for the 5 s response
+    deadline = time.monotonic() + 4
+    while not finished and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert finished and finished[0] - start < 4
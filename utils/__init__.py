@@ -5,7 +5,7 @@ This package provides common utility functions for:
 - File operations (JSON loading/saving, directory management)
 - Logging operations (error logging, file logging setup)
 - Data validation (context factors, sessions validation)
-- LLM generation (API clients, generation functionality)
+- LLM generation (API clients, sync and async generation functionality)
 - Results processing (aggregation, compilation)
 - Data parsing (JSON/YAML parsing utilities)
 """
@@ -13,6 +13,7 @@ This package provides common utility functions for:
 from .files import load_json, save_json, ensure_directory
 from .validation import validate_context_factors, validate_sessions
 from .generation import generate, generate_chat, Generator, GeneratorChat
+from .async_generation import agenerate, agenerate_chat, AsyncGenerator, AsyncGeneratorChat
 from .parsing import parse_json, parse_yaml, json_to_yaml_str
 from .formatting import format_interaction_log
 from .logging import setup_main_logging, setup_worker_logging
@@ -26,6 +27,7 @@ __all__ = [
     
     # Generation utilities
     'generate', 'generate_chat', 'Generator', 'GeneratorChat',
+    'agenerate', 'agenerate_chat', 'AsyncGenerator', 'AsyncGeneratorChat',
     
     # Parsing utilities
     'parse_json', 'parse_yaml', 'json_to_yaml_str',
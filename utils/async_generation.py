@@ -0,0 +1,435 @@
+"""
+Asyncio counterparts of the generation utilities in utils.generation.
+
+agenerate/agenerate_chat mirror generate/generate_chat but run on the async
+OpenAI, Anthropic and Gemini clients, so a single process can keep many requests
+in flight. Each provider is capped by PROVIDER_CONCURRENCY in config.py.
+
+Async clients and semaphores are bound to the event loop they are first used in,
+so they are created lazily (importing the provider SDK on first use) and cached
+per running loop.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import weakref
+
+from config import VLLM_HOST, PROVIDER_CONCURRENCY, RATE_LIMIT_MAX_RETRIES, REQUEST_DEADLINE_RETRIES, ANTHROPIC_PROMPT_CACHING, BEDROCK_PROMPT_CACHING_MODELS
+from utils.rate_limit import get_rate_limiter, estimate_tokens, get_retry_after
+from utils.cache import make_cache_key
+from utils.usage import extract_usage, record_usage, record_stream_usage
+from utils.singleflight import get_single_flight
+from utils.hedging import arun_with_deadline, DeadlineExceeded
+from utils.providers import get_client
+from utils.router import get_router, is_endpoint_failure
+from utils.replay import get_replay_backend, replay_exchange, record_cache_hit
+from utils.generation import (
+    Generator,
+    GeneratorChat,
+    CHAT_PROVIDERS,
+    select_endpoints,
+    system_text,
+    build_messages,
+    build_chat_messages,
+    build_openai_request,
+    build_chat_completion_request,
+    build_anthropic_request,
+    build_gemini_config,
+    anthropic_output_text,
+)
+
+logger = logging.getLogger(__name__)
+
+# Per-event-loop state: {loop: {"clients": {...}, "semaphores": {...}}}
+_loop_state = weakref.WeakKeyDictionary()
+
+def _get_loop_state():
+    loop = asyncio.get_running_loop()
+    if loop not in _loop_state:
+        _loop_state[loop] = {"clients": {}, "semaphores": {}}
+    return _loop_state[loop]
+
+def _create_async_client(provider):
+    from utils.transport import get_async_http_client
+    if provider == "openai":
+        if os.environ.get("OPENAI_API_KEY") is None:
+            raise Exception("OPENAI_API_KEY is not set")
+        import openai
+        return openai.AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=get_async_http_client()
+        )
+    elif provider == "anthropic":
+        if os.environ.get("ANTHROPIC_API_KEY") is None:
+            raise Exception("ANTHROPIC_API_KEY is not set")
+        from anthropic import AsyncAnthropic
+        return AsyncAnthropic(
+            api_key=os.environ.get("ANTHROPIC_API_KEY"),
+            http_client=get_async_http_client()
+        )
+    elif provider == "anthropic_bedrock":
+        if os.environ.get("AWS_ACCESS_KEY") is None or os.environ.get("AWS_SECRET_KEY") is None:
+            raise Exception("AWS_ACCESS_KEY or AWS_SECRET_KEY is not set")
+        from anthropic import AsyncAnthropicBedrock
+        return AsyncAnthropicBedrock(
+            aws_access_key=os.environ.get("AWS_ACCESS_KEY"),
+            aws_secret_key=os.environ.get("AWS_SECRET_KEY"),
+            aws_region="us-west-2",
+            http_client=get_async_http_client()
+        )
+    elif provider == "together":
+        if os.environ.get("TOGETHER_API_KEY") is None:
+            raise Exception("TOGETHER_API_KEY is not set")
+        import openai
+        return openai.AsyncOpenAI(
+            api_key=os.environ.get("TOGETHER_API_KEY"),
+            base_url="https://api.together.xyz/v1",
+            http_client=get_async_http_client()
+        )
+    elif provider == "gemini":
+        return get_client("gemini").aio
+    elif provider == "vllm":
+        import openai
+        return openai.AsyncOpenAI(
+            api_key="EMPTY",
+            base_url=f"{VLLM_HOST}/v1",
+            http_client=get_async_http_client()
+        )
+    else:
+        raise Exception(f"Unknown provider: {provider}")
+
+def get_async_client(provider):
+    """
+    Return the async client for a provider, creating it on first use in the running event loop.
+    """
+    clients = _get_loop_state()["clients"]
+    if provider not in clients:
+        clients[provider] = _create_async_client(provider)
+    return clients[provider]
+
+def get_provider_semaphore(provider):
+    """
+    Return the semaphore limiting concurrent requests to a provider in the running event loop.
+    """
+    semaphores = _get_loop_state()["semaphores"]
+    if provider not in semaphores:
+        semaphores[provider] = asyncio.Semaphore(PROVIDER_CONCURRENCY.get(provider, 32))
+    return semaphores[provider]
+
+async def aread_stream(deltas, until):
+    """
+    Async counterpart of utils.generation.read_stream.
+    """
+    text = ""
+    n_deltas = 0
+    async for delta in deltas:
+        if not delta:
+            continue
+        text += delta
+        n_deltas += 1
+        if until(text):
+            return text, n_deltas, True
+    return text, n_deltas, False
+
+async def astream_openai_compatible(provider, client, request, until):
+    """
+    Async counterpart of utils.generation.stream_openai_compatible.
+    """
+    stream_request = dict(request, stream=True)
+    if provider != "together":
+        stream_request["stream_options"] = {"include_usage": True}
+    stream = await client.chat.completions.create(**stream_request)
+    final = {}
+
+    async def deltas():
+        async for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                final['response'] = chunk
+            if chunk.choices:
+                yield chunk.choices[0].delta.content
+
+    try:
+        text, n_deltas, stopped = await aread_stream(deltas(), until)
+    finally:
+        await stream.close()
+    record_stream_usage(
+        provider, request['model'], final.get('response'),
+        {"input_tokens": estimate_tokens(None, request['messages'], 0), "output_tokens": n_deltas}, stopped
+    )
+    return text
+
+async def astream_anthropic(provider, client, request, until):
+    """
+    Async counterpart of utils.generation.stream_anthropic.
+    """
+    async with client.messages.stream(**request) as stream:
+        text, n_deltas, stopped = await aread_stream(stream.text_stream, until)
+        # The snapshot's input usage is final once the message has started
+        estimate = extract_usage(provider, stream.current_message_snapshot)
+        estimate["output_tokens"] = n_deltas
+        response = None
+        if not stopped:
+            response = await stream.get_final_message()
+            thinking_text, text = anthropic_output_text(request['model'], response)
+    record_stream_usage(provider, request['model'], response, estimate, stopped)
+    return text
+
+async def agenerate_openai(model_name, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_async_client("openai")
+    request = build_openai_request(model_name, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return await astream_openai_compatible("openai", client, request, until)
+
+    output = await client.chat.completions.create(**request)
+    record_usage("openai", model_name, output)
+    return output.choices[0].message.content
+
+async def agenerate_together(model_name, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_async_client("together")
+    request = build_chat_completion_request(model_name, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return await astream_openai_compatible("together", client, request, until)
+
+    output = await client.chat.completions.create(**request)
+    record_usage("together", model_name, output)
+    return output.choices[0].message.content
+
+async def agenerate_anthropic(model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_async_client("anthropic")
+    request = build_anthropic_request(model_name, system, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return await astream_anthropic("anthropic", client, request, until)
+
+    output = await client.messages.create(**request)
+    record_usage("anthropic", model_name, output)
+    thinking_text, output_text = anthropic_output_text(model_name, output)
+    return output_text
+
+async def agenerate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_async_client("anthropic_bedrock")
+    request = build_anthropic_request(
+        model_name, system, messages, temperature, max_tokens, stop=stop,
+        prompt_caching=ANTHROPIC_PROMPT_CACHING and model_name in BEDROCK_PROMPT_CACHING_MODELS
+    )
+    if until is not None:
+        return await astream_anthropic("anthropic_bedrock", client, request, until)
+
+    output = await client.messages.create(**request)
+    record_usage("anthropic_bedrock", model_name, output)
+    thinking_text, output_text = anthropic_output_text(model_name, output)
+    return output_text
+
+async def agenerate_gemini(model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_async_client("gemini")
+    config = build_gemini_config(system, temperature, max_tokens, stop=stop)
+    if until is None:
+        response = await client.models.generate_content(
+            model=model_name,
+            config=config,
+            contents=messages
+        )
+        record_usage("gemini", model_name, response)
+        return response.text
+
+    stream = await client.models.generate_content_stream(
+        model=model_name,
+        config=config,
+        contents=messages
+    )
+    final = {}
+
+    async def deltas():
+        async for chunk in stream:
+            if chunk.usage_metadata is not None:
+                final['response'] = chunk
+            yield chunk.text
+
+    try:
+        text, n_deltas, stopped = await aread_stream(deltas(), until)
+    finally:
+        await stream.aclose()
+    record_stream_usage(
+        "gemini", model_name, final.get('response'),
+        {"input_tokens": estimate_tokens(system, messages, 0), "output_tokens": n_deltas}, stopped
+    )
+    return text
+
+async def agenerate_vllm(model_name, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_async_client("vllm")
+    request = build_chat_completion_request(model_name, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return await astream_openai_compatible("vllm", client, request, until)
+
+    output = await client.chat.completions.create(**request)
+    record_usage("vllm", model_name, output)
+    return output.choices[0].message.content
+
+async def acall_provider(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    """
+    Async counterpart of utils.generation.call_provider, bounded by the provider's concurrency limit.
+    """
+    async with get_provider_semaphore(provider):
+        backend = get_replay_backend()
+        if backend is not None:
+            return await backend.acall(
+                model_name, system, messages,
+                lambda: adispatch_provider(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+            )
+        return await adispatch_provider(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+
+async def adispatch_provider(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    if provider == "openai":
+        return await agenerate_openai(model_name, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "together":
+        return await agenerate_together(model_name, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "anthropic":
+        return await agenerate_anthropic(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "anthropic_bedrock":
+        return await agenerate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "gemini":
+        return await agenerate_gemini(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "vllm":
+        return await agenerate_vllm(model_name, messages, temperature, max_tokens, stop=stop, until=until)
+    else:
+        raise Exception(f"Unknown provider: {provider}")
+
+async def arequest_completion(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    """
+    Async counterpart of utils.generation.request_completion.
+    """
+    if temperature == 0:
+        key = make_cache_key(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+        return await get_single_flight().ado(
+            key, lambda: asend_request(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+        )
+    return await asend_request(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+
+async def asend_request(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    """
+    Async counterpart of utils.generation.send_request.
+    """
+    limiter = get_rate_limiter()
+    keys = [provider, model_name]
+    n_tokens = estimate_tokens(system, messages, max_tokens)
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        await limiter.aacquire(keys, n_tokens)
+        try:
+            return await arun_with_deadline(
+                model_name,
+                lambda: acall_provider(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until),
+                can_hedge=lambda: limiter.reserve(keys, n_tokens) == 0
+            )
+        except DeadlineExceeded as e:
+            if attempt >= REQUEST_DEADLINE_RETRIES:
+                raise
+            logger.warning(f"{e}; retrying")
+        except Exception as e:
+            retry_after = get_retry_after(e, attempt)
+            if retry_after is None or attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            await asyncio.to_thread(limiter.penalize, keys, retry_after)
+            if not limiter.limited_keys(keys):
+                await asyncio.sleep(retry_after)
+
+async def aroute_completion(model_name, system, build, temperature, max_tokens, stop=None, until=None, providers=None):
+    """
+    Async counterpart of utils.generation.route_completion.
+    The router's SQLite reads and writes block, so they run in a thread rather than on the event loop.
+    """
+    router = get_router()
+    endpoints = await asyncio.to_thread(select_endpoints, model_name, providers)
+    if not endpoints:
+        raise Exception(f"Model not found: {model_name}")
+    tracked = len(router.endpoints(model_name)) > 1
+    attempted = False
+    for i, (provider, endpoint_model) in enumerate(endpoints):
+        last = i == len(endpoints) - 1
+        # Another caller may hold the endpoint's half-open trial; with every breaker open the last endpoint is tried anyway
+        if tracked and not await asyncio.to_thread(router.claim, provider, endpoint_model) and (attempted or not last):
+            continue
+        attempted = True
+        start = time.monotonic()
+        try:
+            output = await arequest_completion(
+                provider, endpoint_model, system, build(provider), temperature, max_tokens, stop=stop, until=until
+            )
+        except Exception as e:
+            if not tracked or not is_endpoint_failure(e):
+                raise
+            await asyncio.to_thread(router.record_failure, provider, endpoint_model)
+            if last:
+                raise
+            logger.warning(f"{provider}/{endpoint_model} failed ({e}); failing over")
+            continue
+        if tracked:
+            await asyncio.to_thread(router.record_success, provider, endpoint_model, time.monotonic() - start)
+        return output
+
+async def agenerate(model_name, system, prompt, temperature=0.0, max_tokens=1024, verbose=False, cache=None, stop=None, until=None):
+    if cache is not None:
+        cache_key = make_cache_key(model_name, system_text(system), prompt, temperature, max_tokens, stop=stop, until=until)
+        # Cache lookups and writes are SQLite calls, kept off the event loop
+        output = await asyncio.to_thread(cache.get, cache_key)
+        if output is not None:
+            record_cache_hit(cache_key, model_name, system_text(system), prompt, output)
+            return output
+
+    with replay_exchange(model_name, system_text(system), prompt, temperature, max_tokens, stop=stop, until=until):
+        output = await aroute_completion(
+            model_name, system, lambda provider: build_messages(provider, system, prompt),
+            temperature, max_tokens, stop=stop, until=until
+        )
+    if cache is not None and output is not None:
+        await asyncio.to_thread(cache.set, cache_key, output, model_name=model_name)
+
+    if verbose:
+        logger.debug("\n\n---\n")
+        logger.debug(f"<<<SYSTEM>>>\n{system}\n")
+        logger.debug(f"<<<USER>>>\n{prompt}\n")
+        logger.debug(f"<<<ASSISTANT>>>\n{output}\n")
+        logger.debug("\n---\n")
+    return output
+
+async def agenerate_chat(model_name, system, messages, temperature=0.0, max_tokens=1024, verbose=False, stop=None, until=None):
+    with replay_exchange(model_name, system_text(system), messages, temperature, max_tokens, stop=stop, until=until):
+        output = await aroute_completion(
+            model_name, system, lambda provider: build_chat_messages(provider, system, messages),
+            temperature, max_tokens, stop=stop, until=until, providers=CHAT_PROVIDERS
+        )
+
+    if verbose:
+        logger.debug("\n\n---\n")
+        logger.debug(f"<<<SYSTEM>>>\n{system}\n")
+        logger.debug(f"<<<INPUT>>>\n{json.dumps(messages, indent=2)}\n")
+        logger.debug(f"<<<OUTPUT>>>\n{output}\n")
+        logger.debug("\n---\n")
+    return output
+
+class AsyncGenerator(Generator):
+    """
+    Generator whose call is a coroutine backed by agenerate.
+    """
+    async def __call__(self, *args, **kwargs):
+        return await self.acall(*args, **kwargs)
+
+class AsyncGeneratorChat(GeneratorChat):
+    """
+    GeneratorChat whose call is a coroutine backed by agenerate_chat.
+    Calls on one instance must be awaited one at a time since they share the chat history.
+    """
+    async def __call__(self, message):
+        self.chat_history.append({"role": "user", "content": message})
+        output = (await agenerate_chat(
+            self.model_name,
+            self.system_prompt,
+            self.chat_history,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            verbose=self.verbose,
+            stop=self.stop,
+            until=self.until
+        )).strip()
+        self.chat_history.append({"role": "assistant", "content": output})
+        return output
@@ -0,0 +1,340 @@
+"""
+Provider batch-API execution for offline runs.
+
+When a BatchCollector is active, generation requests to providers with a batch
+backend are not sent directly. A request with a known result returns it; an
+unseen request is queued and BatchPending is raised, which unwinds the caller
+(e.g. one evaluation instance) until the next round. The driver then submits all
+queued requests as batch jobs, polls them and stores the results, and re-runs the
+callers, which now find their responses and move on to the next request.
+
+Job ids and results are persisted under the collector's directory (manifest.json
+and responses.jsonl), so a crashed run resumes polling its submitted jobs instead
+of paying for them again.
+
+Backends are pluggable through register_batch_backend, so the submission/poll
+layer can be pointed at a local stand-in server by passing a custom client.
+"""
+import os
+import io
+import json
+import time
+import hashlib
+import logging
+from utils.providers import get_client
+from utils.usage import current_usage_stage, extract_usage, add_usage
+
+logger = logging.getLogger(__name__)
+
+class BatchPending(BaseException):
+    """
+    Raised when a request has been queued for the next batch.
+    Derives from BaseException so the pipeline's `except Exception` handlers let it pass through.
+    """
+    pass
+
+class BatchBackend:
+    """
+    Base class for provider batch APIs.
+    """
+    max_batch_size = 10000
+
+    def submit(self, requests):
+        """
+        Submit a list of (custom_id, request) pairs and return a job id.
+        """
+        raise NotImplementedError
+
+    def poll(self, job_id):
+        """
+        Return "in_progress", "completed" or "failed".
+        """
+        raise NotImplementedError
+
+    def fetch(self, job_id):
+        """
+        Return {custom_id: {"output": str, "usage": dict}} or {custom_id: {"error": str}} for a finished job.
+        """
+        raise NotImplementedError
+
+class OpenAIBatchBackend(BatchBackend):
+    """
+    OpenAI Batch API (/v1/chat/completions jobs uploaded as JSONL files).
+    """
+    max_batch_size = 50000
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_client("openai")
+
+    def submit(self, requests):
+        from utils.generation import build_openai_request
+        lines = []
+        for custom_id, request in requests:
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_openai_request(
+                    request['model'], request['messages'], request['temperature'], request['max_tokens']
+                )
+            }))
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+            purpose="batch"
+        )
+        job = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return job.id
+
+    def poll(self, job_id):
+        status = self.client.batches.retrieve(job_id).status
+        if status == "completed":
+            return "completed"
+        elif status in ["failed", "expired", "cancelled"]:
+            return "failed"
+        return "in_progress"
+
+    def fetch(self, job_id):
+        job = self.client.batches.retrieve(job_id)
+        results = {}
+        for file_id in [job.output_file_id, job.error_file_id]:
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get('response') or {}
+                body = response.get('body') or {}
+                if response.get('status_code') == 200:
+                    usage = body.get('usage') or {}
+                    results[entry['custom_id']] = {
+                        "output": body['choices'][0]['message']['content'],
+                        "usage": {
+                            "input_tokens": usage.get('prompt_tokens', 0),
+                            "output_tokens": usage.get('completion_tokens', 0),
+                            "cache_read_tokens": (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+                        }
+                    }
+                else:
+                    error = entry.get('error') or body.get('error') or "Unknown batch error"
+                    results[entry['custom_id']] = {"error": json.dumps(error)}
+        return results
+
+class AnthropicBatchBackend(BatchBackend):
+    """
+    Anthropic Message Batches API.
+    """
+    max_batch_size = 100000
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_client("anthropic")
+
+    def submit(self, requests):
+        from utils.generation import build_anthropic_request
+        job = self.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": custom_id,
+                    "params": build_anthropic_request(
+                        request['model'], request['system'], request['messages'], request['temperature'], request['max_tokens']
+                    )
+                } for custom_id, request in requests
+            ]
+        )
+        return job.id
+
+    def poll(self, job_id):
+        if self.client.messages.batches.retrieve(job_id).processing_status == "ended":
+            return "completed"
+        return "in_progress"
+
+    def fetch(self, job_id):
+        from utils.generation import anthropic_output_text
+        results = {}
+        for entry in self.client.messages.batches.results(job_id):
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                thinking_text, output_text = anthropic_output_text(message.model, message)
+                usage = extract_usage("anthropic", message)
+                del usage["requests"]
+                results[entry.custom_id] = {
+                    "output": output_text,
+                    "usage": usage
+                }
+            else:
+                error = getattr(entry.result, 'error', None)
+                results[entry.custom_id] = {"error": str(error) if error is not None else entry.result.type}
+        return results
+
+BATCH_BACKENDS = {
+    "openai": OpenAIBatchBackend(),
+    "anthropic": AnthropicBatchBackend(),
+}
+
+def register_batch_backend(provider, backend):
+    """
+    Use `backend` for the given provider's batch requests (e.g. a backend whose client points at a local server).
+    """
+    BATCH_BACKENDS[provider] = backend
+
+def make_request_id(model_name, system, messages, temperature, max_tokens):
+    payload = json.dumps([model_name, system, messages, temperature, max_tokens], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class BatchCollector:
+    """
+    Collects requests into provider batch jobs and serves their results, persisting progress in `directory`.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.responses_path = os.path.join(directory, "responses.jsonl")
+        self.pending = {}
+        self.results = {}
+        # Failed requests are only kept for this run so that a new run retries them
+        self.errors = {}
+        self.jobs = []
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.responses_path):
+            with open(self.responses_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-write leaves at most one partial line
+                        continue
+                    self.results[entry['custom_id']] = entry['output']
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.jobs = json.load(f)['jobs']
+        logger.info(f"Batch collector: {len(self.results)} stored responses, {len(self.unfinished_jobs())} unfinished jobs")
+
+    def _save_manifest(self):
+        # Write to a temporary file first so a crash never leaves a truncated manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def supports(self, provider):
+        return provider in BATCH_BACKENDS
+
+    def resolve(self, provider, model_name, system, messages, temperature, max_tokens):
+        """
+        Return the stored output for a request, or queue it for the next batch and raise BatchPending.
+        """
+        custom_id = make_request_id(model_name, system, messages, temperature, max_tokens)
+        if custom_id in self.results:
+            return self.results[custom_id]
+        if custom_id in self.errors:
+            raise Exception(f"Batch request failed: {self.errors[custom_id]}")
+        if custom_id not in self.pending and not self._is_submitted(custom_id):
+            self.pending[custom_id] = {
+                "provider": provider,
+                "model": model_name,
+                "system": system,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "stage": current_usage_stage()
+            }
+        raise BatchPending(custom_id)
+
+    def _is_submitted(self, custom_id):
+        return any(custom_id in job['custom_ids'] for job in self.unfinished_jobs())
+
+    def unfinished_jobs(self):
+        return [job for job in self.jobs if job['status'] == "in_progress"]
+
+    def submit_pending(self):
+        """
+        Submit all queued requests as batch jobs, grouped by provider.
+        """
+        by_provider = {}
+        for custom_id, request in self.pending.items():
+            by_provider.setdefault(request['provider'], []).append((custom_id, request))
+        for provider, requests in by_provider.items():
+            backend = BATCH_BACKENDS[provider]
+            for i in range(0, len(requests), backend.max_batch_size):
+                chunk = requests[i:i + backend.max_batch_size]
+                job_id = backend.submit(chunk)
+                self.jobs.append({
+                    "provider": provider,
+                    "job_id": job_id,
+                    "status": "in_progress",
+                    "submitted": time.time(),
+                    "custom_ids": [custom_id for custom_id, _ in chunk],
+                    "stages": {custom_id: [request['model'], request['stage']] for custom_id, request in chunk}
+                })
+                self._save_manifest()
+                logger.info(f"Submitted {provider} batch job {job_id} with {len(chunk)} requests")
+        self.pending = {}
+
+    def wait(self, poll_interval=60):
+        """
+        Poll unfinished jobs until all have finished, storing their results.
+        """
+        while self.unfinished_jobs():
+            for job in self.unfinished_jobs():
+                backend = BATCH_BACKENDS[job['provider']]
+                status = backend.poll(job['job_id'])
+                if status == "in_progress":
+                    continue
+                if status == "completed":
+                    self._store_results(job, backend.fetch(job['job_id']))
+                else:
+                    logger.error(f"Batch job {job['job_id']} failed")
+                    for custom_id in job['custom_ids']:
+                        self.errors[custom_id] = f"Batch job {job['job_id']} failed"
+                job['status'] = status
+                self._save_manifest()
+            if self.unfinished_jobs():
+                logger.info(f"Waiting on {len(self.unfinished_jobs())} batch jobs...")
+                time.sleep(poll_interval)
+
+    def _store_results(self, job, results):
+        n_failed = 0
+        with open(self.responses_path, "a") as f:
+            for custom_id in job['custom_ids']:
+                result = results.get(custom_id, {"error": "Missing from batch results"})
+                if 'error' in result:
+                    self.errors[custom_id] = result['error']
+                    n_failed += 1
+                    continue
+                self.results[custom_id] = result['output']
+                f.write(json.dumps({"custom_id": custom_id, "output": result['output']}) + "\n")
+                model_name, stage = job['stages'][custom_id]
+                add_usage(model_name, {
+                    "requests": 1,
+                    **result['usage'],
+                    "batch_input_tokens": result['usage']['input_tokens'],
+                    "batch_output_tokens": result['usage']['output_tokens']
+                }, stage=stage)
+        logger.info(f"Batch job {job['job_id']} finished: {len(job['custom_ids']) - n_failed} succeeded, {n_failed} failed")
+
+_collector = None
+
+def set_batch_collector(collector):
+    """
+    Route generation requests through `collector` (None disables batch mode).
+    """
+    global _collector
+    _collector = collector
+
+def get_batch_collector():
+    return _collector
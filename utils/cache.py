@@ -0,0 +1,215 @@
+"""
+Persistent on-disk cache for deterministic LLM responses.
+
+Responses are stored in SQLite, keyed by a hash of the full request
+(model, system prompt, prompt or messages, temperature, max_tokens).
+The cache is safe to share across Pool workers and threads: each process opens
+its own connection, used under a lock, and the database runs in WAL mode, so
+lookups are plain reads that never wait for the write lock. Hit/miss counters and
+access times are buffered in the process and written in one transaction at most
+every RESPONSE_CACHE_FLUSH_INTERVAL seconds (and with every write), so they still
+aggregate across processes. When the stored responses exceed the configured
+size, the least recently used entries are evicted.
+
+Caching is opt-in per Generator (see utils.generation.Generator) so that
+sampling calls are never served from the cache by accident.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from config import RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+_caches = {}
+
+def make_cache_key(model_name, system, prompt, temperature, max_tokens, stop=None, until=None):
+    """
+    Return a content-addressed key for a request. `prompt` may be a string or a list of chat messages.
+    Requests cut short by stop sequences or an `until` predicate are keyed apart from full ones;
+    predicates are identified by their qualified name.
+    """
+    request = [model_name, system, prompt, temperature, max_tokens]
+    if stop or until is not None:
+        request.append([stop, f"{until.__module__}.{until.__qualname__}" if until is not None else None])
+    payload = json.dumps(
+        request,
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with LRU eviction and shared hit/miss counters.
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=RESPONSE_CACHE_MAX_BYTES, flush_interval=RESPONSE_CACHE_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._setup()
+
+    def _connection(self):
+        # Connections must not be shared across forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            # Bookkeeping not yet written to the database
+            self._hits = 0
+            self._misses = 0
+            self._accessed = {}
+            self._flushed = time.monotonic()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        # Called with self._lock held
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _setup(self):
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, value TEXT, size INTEGER, created REAL, last_access REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+        conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('bytes', 0)")
+
+    def _write_bookkeeping(self, conn):
+        # Called inside a transaction with self._lock held
+        if self._accessed:
+            conn.executemany(
+                "UPDATE responses SET last_access = MAX(last_access, ?) WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()]
+            )
+        if self._hits:
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'", (self._hits,))
+        if self._misses:
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'", (self._misses,))
+        self._hits, self._misses, self._accessed = 0, 0, {}
+        self._flushed = time.monotonic()
+
+    def flush(self):
+        """
+        Write this process's buffered hit/miss counters and access times to the database.
+        """
+        self._connection()
+        with self._lock:
+            if not (self._hits or self._misses or self._accessed):
+                return
+            with self._transaction() as conn:
+                self._write_bookkeeping(conn)
+
+    def get(self, key):
+        """
+        Return the cached response for a key, or None on a miss.
+        """
+        conn = self._connection()
+        with self._lock:
+            row = conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._accessed[key] = time.time()
+            due = time.monotonic() - self._flushed >= self.flush_interval
+        if due:
+            self.flush()
+        return row[0] if row is not None else None
+
+    def set(self, key, value, model_name=None):
+        """
+        Store a response and evict least recently used entries if the cache is over its size limit.
+        """
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        self._connection()
+        with self._lock, self._transaction() as conn:
+            self._write_bookkeeping(conn)
+            row = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            previous_size = row[0] if row is not None else 0
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, value, size, now, now)
+            )
+            conn.execute("UPDATE counters SET value = value + ? WHERE name = 'bytes'", (size - previous_size,))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0]
+        while total > self.max_bytes:
+            rows = conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            logger.debug(f"Evicted cached responses, cache size is now {total} bytes")
+        conn.execute("UPDATE counters SET value = ? WHERE name = 'bytes'", (max(total, 0),))
+
+    def stats(self):
+        """
+        Return hit/miss counters and the current size of the cache.
+        """
+        self.flush()
+        conn = self._connection()
+        with self._lock:
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = counters['hits'] + counters['misses']
+        return {
+            "hits": counters['hits'],
+            "misses": counters['misses'],
+            "hit_rate": counters['hits'] / lookups if lookups > 0 else 0,
+            "entries": entries,
+            "bytes": counters['bytes']
+        }
+
+    def clear(self):
+        self._connection()
+        with self._lock, self._transaction() as conn:
+            self._hits, self._misses, self._accessed = 0, 0, {}
+            conn.execute("DELETE FROM responses")
+            conn.execute("UPDATE counters SET value = 0")
+
+def get_response_cache(path=RESPONSE_CACHE_PATH):
+    """
+    Return the process-wide ResponseCache for a path.
+    """
+    if path not in _caches:
+        _caches[path] = ResponseCache(path)
+    return _caches[path]
+
+def resolve_cache(cache):
+    """
+    Normalize a Generator's `cache` argument: True selects the default cache, False/None disables caching.
+    """
+    if cache is True:
+        return get_response_cache()
+    if cache is False:
+        return None
+    return cache
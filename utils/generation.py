@@ -1,353 +1,471 @@
 import os
 import json
-import yaml
-from importlib import resources
-
-import openai
-from anthropic import AnthropicBedrock, Anthropic
-from google import genai
-from google.genai import types
-from config import VLLM_HOST
+import time
+
+from config import RATE_LIMIT_MAX_RETRIES, REQUEST_DEADLINE_RETRIES, ANTHROPIC_PROMPT_CACHING, BEDROCK_PROMPT_CACHING_MODELS
+from utils.providers import MODEL_DICTIONARY, get_client
+from utils.cache import make_cache_key, resolve_cache
+from utils.rate_limit import get_rate_limiter, estimate_tokens, get_retry_after
+from utils.usage import extract_usage, record_usage, record_stream_usage
+from utils.batch import get_batch_collector
+from utils.singleflight import get_single_flight
+from utils.hedging import run_with_deadline, call_timeout, DeadlineExceeded
+from utils.router import get_router, is_endpoint_failure
+from utils.prompts import get_prompt
+from utils.replay import get_replay_backend, replay_exchange, record_cache_hit
 import logging
 
 logger = logging.getLogger(__name__)
 
-openai_client = None
-anthropic_client = None
-anthropic_bedrock_client = None
-together_client = None
-gemini_client = None
-vllm_client = None
-
-if os.environ.get("OPENAI_API_KEY") is not None:
-    openai_client = openai.Client(
-        api_key=os.environ.get("OPENAI_API_KEY")
-    )
-else:
-    logger.warning("OPENAI_API_KEY is not set")
-
-if os.environ.get("AWS_ACCESS_KEY") is not None and os.environ.get("AWS_SECRET_KEY") is not None:
-    anthropic_bedrock_client = AnthropicBedrock(
-        aws_access_key=os.environ.get("AWS_ACCESS_KEY"),
-        aws_secret_key=os.environ.get("AWS_SECRET_KEY"),
-        aws_region="us-west-2",
-    )
-else:
-    logger.warning("AWS_ACCESS_KEY or AWS_SECRET_KEY is not set")
-
-if os.environ.get("ANTHROPIC_API_KEY") is not None:
-    anthropic_client = Anthropic(
-        api_key=os.environ.get("ANTHROPIC_API_KEY")
+def system_text(system):
+    """
+    Return the system prompt as a single string.
+    A system prompt may be a list of segments whose first segment is a prefix shared across calls
+    (see Generator.format_system); only Anthropic keeps the segments apart, to cache the prefix.
+    """
+    if isinstance(system, list):
+        return "".join(system)
+    return system
+
+def build_messages(provider, system, prompt):
+    """
+    Build the provider-specific message list for a single-turn prompt.
+    Providers that take the system prompt as a separate argument keep it out of the list.
+    """
+    if provider == "gemini":
+        return [prompt]
+    messages = [{ "role": "user", "content": prompt }]
+    if system is not None:
+        if provider == "openai":
+            messages.insert(0, { "role": "developer", "content": system_text(system) })
+        elif provider in ["together", "vllm"]:
+            messages.insert(0, { "role": "system", "content": system_text(system) })
+    return messages
+
+def build_chat_messages(provider, system, messages):
+    """
+    Build the provider-specific message list for a multi-turn chat history.
+    """
+    # Create a copy of the messages to avoid modifying the original list
+    messages = messages.copy()
+    if system is not None and provider in ["openai", "together"]:
+        messages.insert(0, { "role": "system", "content": system_text(system) })
+    return messages
+
+def anthropic_output_text(model_name, output):
+    """
+    Split an Anthropic message into its (thinking, text) parts.
+    Extended thinking models return several content blocks; other models return a single text block.
+    """
+    if 'claude-3-7' not in model_name:
+        return "", output.content[0].text
+
+    output_text = ""
+    thinking_text = ""
+
+    if len(output.content) > 2:
+        logger.debug("Claude output content:")
+        logger.debug(output.content)
+
+    for content in output.content:
+        # check if has thinking attribute
+        if hasattr(content, 'thinking'):
+            thinking_text += " " + content.thinking
+        elif hasattr(content, 'text'):
+            output_text += " " + content.text
+
+    return thinking_text.strip(), output_text.strip()
+
+def build_openai_request(model_name, messages, temperature, max_tokens, stop=None):
+    """
+    Build the keyword arguments for an OpenAI chat.completions.create call.
+    o1 models only accept temperature 1 and o3 models do not accept a temperature.
+    Reasoning models do not accept stop sequences.
+    """
+    request = {
+        "model": model_name,
+        "messages": messages,
+        "max_completion_tokens": max_tokens
+    }
+    if 'o3' not in model_name:
+        request["temperature"] = temperature if 'o1' not in model_name else 1
+    if stop and not any(name in model_name for name in ['o1', 'o3', 'o4']):
+        request["stop"] = stop
+    return request
+
+def build_chat_completion_request(model_name, messages, temperature, max_tokens, stop=None):
+    """
+    Build the keyword arguments for a chat.completions.create call on an OpenAI-compatible API (Together, vLLM).
+    """
+    request = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if stop:
+        request["stop"] = stop
+    return request
+
+def read_stream(deltas, until):
+    """
+    Accumulate streamed text deltas until `until(text)` holds.
+    Returns the text, the number of deltas read and whether the stream was stopped early.
+    """
+    text = ""
+    n_deltas = 0
+    for delta in deltas:
+        if not delta:
+            continue
+        text += delta
+        n_deltas += 1
+        if until(text):
+            return text, n_deltas, True
+    return text, n_deltas, False
+
+def stream_openai_compatible(provider, client, request, until):
+    """
+    Stream a chat completion from an OpenAI-compatible API, closing the stream as soon as until(text) holds.
+    """
+    stream_request = dict(request, stream=True)
+    if provider != "together":
+        stream_request["stream_options"] = {"include_usage": True}
+    stream = client.chat.completions.create(**stream_request)
+    final = {}
+
+    def deltas():
+        for chunk in stream:
+            # The last chunk carries the usage of the whole request
+            if getattr(chunk, 'usage', None) is not None:
+                final['response'] = chunk
+            if chunk.choices:
+                yield chunk.choices[0].delta.content
+
+    try:
+        text, n_deltas, stopped = read_stream(deltas(), until)
+    finally:
+        stream.close()
+    record_stream_usage(
+        provider, request['model'], final.get('response'),
+        {"input_tokens": estimate_tokens(None, request['messages'], 0), "output_tokens": n_deltas}, stopped
     )
-else:
-    logger.warning("ANTHROPIC_API_KEY is not set")
+    return text
 
-if os.environ.get("TOGETHER_API_KEY") is not None:
-    together_client = openai.OpenAI(
-        api_key=os.environ.get("TOGETHER_API_KEY"),
-        base_url="https://api.together.xyz/v1"
-    )
-else:
-    logger.warning("TOGETHER_API_KEY is not set")
-
-if os.environ.get("GEMINI_PROJECT_ID") is not None:
-    gemini_client = genai.Client(
-        vertexai=True, 
-        project=os.environ.get("GEMINI_PROJECT_ID"),
-        location="us-central1"
-    )
-else:
-    logger.warning("GEMINI_PROJECT_ID is not set")
-
-vllm_client = openai.Client(
-    api_key="EMPTY",
-    base_url=f"{VLLM_HOST}/v1"
-)
-
-MODEL_DICTIONARY = {
-    "openai": [
-        model.id for model in openai_client.models.list().data if openai_client is not None
-    ] if openai_client is not None else [],
-    "anthropic": [
-        "claude-3-7-sonnet-20250219",
-        "claude-3-5-sonnet-20241022",
-        "claude-3-5-sonnet-20240620",
-        "claude-3-opus-20240229",
-        "claude-3-sonnet-20240229",
-        "claude-3-haiku-20240307",
-        "claude-3-5-haiku-20241022"
-    ],
-    "anthropic_bedrock": [
-        "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
-        "anthropic.claude-3-5-sonnet-20241022-v2:0",
-        "anthropic.claude-3-5-sonnet-20240620-v1:0",
-        "anthropic.claude-3-5-haiku-20241022-v1:0"
-    ],
-    "together": [
-        "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
-        "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
-        "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo",
-        "meta-llama/Meta-Llama-3-8B-Instruct-Turbo",
-        "meta-llama/Meta-Llama-3-70B-Instruct-Turbo",
-        "mistralai/Mixtral-8x7B-Instruct-v0.1",
-        "mistralai/Mixtral-8x22B-Instruct-v0.1",
-        'deepseek-ai/DeepSeek-R1',
-        'meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo',
-        "mistralai/Mistral-7B-Instruct-v0.3",
-        "Qwen/Qwen2.5-72B-Instruct-Turbo",
-    ],
-    "gemini": [
-        "gemini-2.0-pro-exp-02-05",
-        "gemini-2.0-flash-thinking-exp-01-21"
-    ],
-    "vllm": [
-        "kixlab/prefmatcher-7b"
-    ]
-}
-
-def anthropic_track_usage(model_name, system, messages, output_text):
-    anthropic_usage_file = "anthropic_usage.jsonl"
-    input_tokens = anthropic_client.messages.count_tokens(
-        model= "claude-3-5-sonnet-20241022",
-        system=system,
-        messages=messages
-    ).input_tokens
-    output_tokens = anthropic_client.messages.count_tokens(
-        model= "claude-3-5-sonnet-20241022",
-        messages=[{
-            "role": "assistant",
-            "content": output_text
-        }]
-    ).input_tokens
-    with open(anthropic_usage_file, "a") as f:
-        f.write(json.dumps({
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens
-        }) + "\n")
-
-def generate_openai(model_name, messages, temperature, max_tokens):
-    if openai_client is None:
-        raise Exception("OPENAI_API_KEY is not set")
+def generate_openai(model_name, messages, temperature, max_tokens, stop=None, until=None):
+    openai_client = get_client("openai")
+    request = build_openai_request(model_name, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return stream_openai_compatible("openai", openai_client, request, until)
 
-    if 'o3' not in model_name:
-        output = openai_client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature if 'o1' not in model_name else 1,
-            max_completion_tokens=max_tokens
-        )
-    else:
-        output = openai_client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            max_completion_tokens=max_tokens
-        )
+    output = openai_client.chat.completions.create(**request)
+    record_usage("openai", model_name, output)
     return output.choices[0].message.content
 
-def generate_together(model_name, messages, temperature, max_tokens):
-    if together_client is None:
-        raise Exception("TOGETHER_API_KEY is not set")
+def generate_together(model_name, messages, temperature, max_tokens, stop=None, until=None):
+    together_client = get_client("together")
+    request = build_chat_completion_request(model_name, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return stream_openai_compatible("together", together_client, request, until)
 
-    output = together_client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    output = together_client.chat.completions.create(**request)
+    record_usage("together", model_name, output)
     return output.choices[0].message.content
 
-def generate_anthropic(model_name, system, messages, temperature, max_tokens):
-    if anthropic_client is None:
-        raise Exception("ANTHROPIC_API_KEY is not set")
-
-    if system is not None:
-        if "claude-3-7" in model_name:
-            output = anthropic_client.messages.create(
-                model=model_name,
-                system=system,
-                messages=messages,
-                temperature=1,
-                max_tokens=max_tokens,
-                thinking={
-                    "type": "enabled",
-                    "budget_tokens": 1024
-                }
-            )
-        else:
-            output = anthropic_client.messages.create(
-                model=model_name,
-                system=system,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-    else:
-        if "claude-3-7" in model_name:
-            output = anthropic_client.messages.create(
-                model=model_name,
-                messages=messages,
-                temperature=1,
-                max_tokens=max_tokens,
-                thinking={
-                    "type": "enabled",
-                    "budget_tokens": 1024
-                }
-            )
-        else:
-            output = anthropic_client.messages.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-
-    if 'claude-3-7' in model_name:
-        output_text = ""
-        thinking_text = ""
-
-        if len(output.content) > 2:
-            logger.debug("Claude output content:")
-            logger.debug(output.content)
-
-        for content in output.content:
-            # check if has thinking attribute
-            if hasattr(content, 'thinking'):
-                thinking_text += " " + content.thinking
-            elif hasattr(content, 'text'):
-                output_text += " " + content.text
-
-        thinking_text = thinking_text.strip()
-        output_text = output_text.strip()
-        return output_text
+def anthropic_system_blocks(system):
+    """
+    Build the system prompt blocks with a cache breakpoint after the first segment,
+    the part of the system prompt that is identical across calls.
+    """
+    segments = system if isinstance(system, list) else [system]
+    blocks = [{"type": "text", "text": segment} for segment in segments if segment]
+    if blocks:
+        blocks[0]["cache_control"] = {"type": "ephemeral"}
+    return blocks
+
+def anthropic_cached_messages(messages):
+    """
+    Return a copy of a chat history with a cache breakpoint on its last message, so the next turn,
+    which resends this history as its prefix, reads it from the cache instead of paying for it again.
+    """
+    last = messages[-1]
+    content = last['content']
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
     else:
-        return output.content[0].text
-
-def generate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens):
-    if anthropic_bedrock_client is None:
-        raise Exception("AWS_ACCESS_KEY or AWS_SECRET_KEY is not set")
-
+        content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return messages[:-1] + [{**last, "content": content}]
+
+def build_anthropic_request(model_name, system, messages, temperature, max_tokens, stop=None, prompt_caching=ANTHROPIC_PROMPT_CACHING):
+    """
+    Build the keyword arguments for an Anthropic messages.create call.
+    Extended thinking models are run with thinking enabled, which requires temperature 1.
+    With prompt caching, cache breakpoints are placed on the stable system prompt prefix and, for
+    multi-turn histories, on the last message. Single-turn prompts are not cached since they vary per call.
+    """
+    if prompt_caching and len(messages) > 1:
+        messages = anthropic_cached_messages(messages)
+    request = {
+        "model": model_name,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
     if system is not None:
-        if "claude-3-7" in model_name:
-            output = anthropic_bedrock_client.messages.create(
-                model=model_name,
-                system=system,
-                messages=messages,
-                temperature=1,
-                max_tokens=max_tokens,
-                thinking={
-                    "type": "enabled",
-                    "budget_tokens": 1024
-                }
-            )
-        else:
-            output = anthropic_bedrock_client.messages.create(
-                model=model_name,
-                system=system,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-    else:
-        if "claude-3-7" in model_name:
-            output = anthropic_bedrock_client.messages.create(
-                model=model_name,
-                messages=messages,
-                temperature=1,
-                max_tokens=max_tokens,
-                thinking={
-                    "type": "enabled",
-                    "budget_tokens": 1024
-                }
-            )
-        else:
-            output = anthropic_bedrock_client.messages.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-
-    if 'claude-3-7' in model_name:
-        output_text = ""
-        thinking_text = ""
-
-        if len(output.content) > 2:
-            logger.debug("Claude output content:")
-            logger.debug(output.content)
-
-        for content in output.content:
-            # check if has thinking attribute
-            if hasattr(content, 'thinking'):
-                thinking_text += " " + content.thinking
-            elif hasattr(content, 'text'):
-                output_text += " " + content.text
-
-        thinking_text = thinking_text.strip()
-        output_text = output_text.strip()
-        anthropic_track_usage(model_name, system, messages, thinking_text + " " + output_text)
-        return output_text
-    else:
-        anthropic_track_usage(model_name, system, messages, output.content[0].text)
-        return output.content[0].text
-
+        request["system"] = anthropic_system_blocks(system) if prompt_caching else system_text(system)
+    if stop:
+        request["stop_sequences"] = stop
+    if "claude-3-7" in model_name:
+        request["temperature"] = 1
+        request["thinking"] = {
+            "type": "enabled",
+            "budget_tokens": 1024
+        }
+    return request
+
+def stream_anthropic(provider, client, request, until):
+    """
+    Stream an Anthropic message, closing the stream as soon as until(text) holds.
+    Only text blocks are streamed to the predicate; thinking blocks are skipped.
+    """
+    with client.messages.stream(**request) as stream:
+        text, n_deltas, stopped = read_stream(stream.text_stream, until)
+        # The snapshot's input usage is final once the message has started
+        estimate = extract_usage(provider, stream.current_message_snapshot)
+        estimate["output_tokens"] = n_deltas
+        response = None
+        if not stopped:
+            response = stream.get_final_message()
+            thinking_text, text = anthropic_output_text(request['model'], response)
+    record_stream_usage(provider, request['model'], response, estimate, stopped)
+    return text
+
+def generate_anthropic(model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    anthropic_client = get_client("anthropic")
+    request = build_anthropic_request(model_name, system, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return stream_anthropic("anthropic", anthropic_client, request, until)
+
+    output = anthropic_client.messages.create(**request)
+    record_usage("anthropic", model_name, output)
+    thinking_text, output_text = anthropic_output_text(model_name, output)
+    return output_text
+
+def generate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    anthropic_bedrock_client = get_client("anthropic_bedrock")
+    request = build_anthropic_request(
+        model_name, system, messages, temperature, max_tokens, stop=stop,
+        prompt_caching=ANTHROPIC_PROMPT_CACHING and model_name in BEDROCK_PROMPT_CACHING_MODELS
+    )
+    if until is not None:
+        return stream_anthropic("anthropic_bedrock", anthropic_bedrock_client, request, until)
+
+    output = anthropic_bedrock_client.messages.create(**request)
+    record_usage("anthropic_bedrock", model_name, output)
+    thinking_text, output_text = anthropic_output_text(model_name, output)
+    return output_text
+
+def build_gemini_config(system, temperature, max_tokens, stop=None):
+    from google.genai import types
+
+    # The Gemini client does not use the shared HTTP transport, so the call deadline is passed here
+    timeout = call_timeout()
+    return types.GenerateContentConfig(
+        system_instruction=system_text(system),
+        max_output_tokens=max_tokens,
+        temperature=temperature,
+        stop_sequences=stop or None,
+        http_options=types.HttpOptions(timeout=max(int(timeout * 1000), 1)) if timeout is not None else None,
+    )
 
-def generate_gemini(model_name, system, messages, temperature, max_tokens):
-    if gemini_client is None:
-        raise Exception("GEMINI_PROJECT_ID is not set")
+def generate_gemini(model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    client = get_client("gemini")
+    config = build_gemini_config(system, temperature, max_tokens, stop=stop)
+    if until is None:
+        response = client.models.generate_content(
+            model=model_name,
+            config=config,
+            contents=messages
+        )
+        record_usage("gemini", model_name, response)
+        return response.text
 
-    response = gemini_client.models.generate_content(
+    stream = client.models.generate_content_stream(
         model=model_name,
-        config=types.GenerateContentConfig(
-            system_instruction=system,
-            max_output_tokens=max_tokens,
-            temperature=temperature,
-        ),
+        config=config,
         contents=messages
     )
-    return response.text
-
-def generate_vllm(model_name, messages, temperature, max_tokens):
-    output = vllm_client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
+    final = {}
+
+    def deltas():
+        for chunk in stream:
+            # Every chunk carries the usage so far
+            if chunk.usage_metadata is not None:
+                final['response'] = chunk
+            yield chunk.text
+
+    try:
+        text, n_deltas, stopped = read_stream(deltas(), until)
+    finally:
+        stream.close()
+    record_stream_usage(
+        "gemini", model_name, final.get('response'),
+        {"input_tokens": estimate_tokens(system, messages, 0), "output_tokens": n_deltas}, stopped
     )
+    return text
+
+def generate_vllm(model_name, messages, temperature, max_tokens, stop=None, until=None):
+    vllm_client = get_client("vllm")
+    request = build_chat_completion_request(model_name, messages, temperature, max_tokens, stop=stop)
+    if until is not None:
+        return stream_openai_compatible("vllm", vllm_client, request, until)
+
+    output = vllm_client.chat.completions.create(**request)
+    record_usage("vllm", model_name, output)
     return output.choices[0].message.content
 
-def generate(model_name, system, prompt, temperature=0.0, max_tokens=1024, verbose=False):
-    if model_name in MODEL_DICTIONARY['openai']:
-        messages = [{ "role": "user", "content": prompt }]
-        if system is not None:
-            messages.insert(0, { "role": "developer", "content": system })
-        output = generate_openai(model_name, messages, temperature, max_tokens)
-
-    elif model_name in MODEL_DICTIONARY['together']:
-        messages = [{ "role": "user", "content": prompt }]
-        if system is not None:
-            messages.insert(0, { "role": "system", "content": system })
-        output = generate_together(model_name, messages, temperature, max_tokens)
-        
-    elif model_name in MODEL_DICTIONARY['anthropic']:
-        messages = [{ "role": "user", "content": prompt }]
-        output = generate_anthropic(model_name, system, messages, temperature, max_tokens)
-    
-    elif model_name in MODEL_DICTIONARY['anthropic_bedrock']:
-        messages = [{ "role": "user", "content": prompt }]
-        output = generate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens)
-    
-    elif model_name in MODEL_DICTIONARY['gemini']:
-        messages = [prompt]
-        output = generate_gemini(model_name, system, messages, temperature, max_tokens)
-    
-    elif model_name in MODEL_DICTIONARY['vllm']:
-        messages = [{ "role": "user", "content": prompt }]
-        if system is not None:
-            messages.insert(0, { "role": "system", "content": system })
-        output = generate_vllm(model_name, messages, temperature, max_tokens)
-    
+def call_provider(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    """
+    Send already-built messages to the provider's generation function.
+    With `until`, the response is streamed and cut off as soon as until(text) holds.
+    Under a replay backend the call is recorded, or answered from its tape (see utils.replay).
+    """
+    backend = get_replay_backend()
+    if backend is not None:
+        return backend.call(
+            model_name, system, messages,
+            lambda: dispatch_provider(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+        )
+    return dispatch_provider(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+
+def dispatch_provider(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    if provider == "openai":
+        return generate_openai(model_name, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "together":
+        return generate_together(model_name, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "anthropic":
+        return generate_anthropic(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "anthropic_bedrock":
+        return generate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "gemini":
+        return generate_gemini(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+    elif provider == "vllm":
+        return generate_vllm(model_name, messages, temperature, max_tokens, stop=stop, until=until)
     else:
+        raise Exception(f"Unknown provider: {provider}")
+
+def request_completion(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    """
+    Request a completion, sharing the result of identical deterministic requests that are already in flight.
+    In batch mode, requests to providers with a batch backend are routed to the batch collector instead;
+    batch results are always full completions, so `stop` and `until` do not apply there.
+    """
+    collector = get_batch_collector()
+    if collector is not None and collector.supports(provider):
+        return collector.resolve(provider, model_name, system, messages, temperature, max_tokens)
+
+    if temperature == 0:
+        key = make_cache_key(model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+        return get_single_flight().do(
+            key, lambda: send_request(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+        )
+    return send_request(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until)
+
+def send_request(provider, model_name, system, messages, temperature, max_tokens, stop=None, until=None):
+    """
+    Call the provider within the shared rate limits for the provider and model,
+    retrying with backoff when the provider still responds with a rate limit error.
+    Each call runs under a deadline and may be hedged with a duplicate (see utils.hedging);
+    a duplicate is only sent if the rate limits have room for it.
+    """
+    limiter = get_rate_limiter()
+    keys = [provider, model_name]
+    n_tokens = estimate_tokens(system, messages, max_tokens)
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        limiter.acquire(keys, n_tokens)
+        try:
+            return run_with_deadline(
+                model_name,
+                lambda: call_provider(provider, model_name, system, messages, temperature, max_tokens, stop=stop, until=until),
+                can_hedge=lambda: limiter.reserve(keys, n_tokens) == 0
+            )
+        except DeadlineExceeded as e:
+            if attempt >= REQUEST_DEADLINE_RETRIES:
+                raise
+            logger.warning(f"{e}; retrying")
+        except Exception as e:
+            retry_after = get_retry_after(e, attempt)
+            if retry_after is None or attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            limiter.penalize(keys, retry_after)
+            if not limiter.limited_keys(keys):
+                time.sleep(retry_after)
+
+def select_endpoints(model_name, providers=None):
+    """
+    Return the (provider, model) endpoints to try for a logical model, best first.
+    """
+    router = get_router()
+    if get_batch_collector() is not None:
+        # Every batch round must resolve a request to the same endpoint
+        return [endpoint for endpoint in router.endpoints(model_name) if providers is None or endpoint[0] in providers]
+    return router.select(model_name, providers)
+
+def route_completion(model_name, system, build, temperature, max_tokens, stop=None, until=None, providers=None):
+    """
+    Request a completion from a logical model's endpoints (see utils.router), failing over to the
+    next endpoint when one fails. `build(provider)` returns the provider-specific messages.
+    """
+    router = get_router()
+    endpoints = select_endpoints(model_name, providers)
+    if not endpoints:
         raise Exception(f"Model not found: {model_name}")
+    # Only models with several endpoints need latency and failure tracking
+    tracked = len(router.endpoints(model_name)) > 1
+    attempted = False
+    for i, (provider, endpoint_model) in enumerate(endpoints):
+        last = i == len(endpoints) - 1
+        # Another caller may hold the endpoint's half-open trial; with every breaker open the last endpoint is tried anyway
+        if tracked and not router.claim(provider, endpoint_model) and (attempted or not last):
+            continue
+        attempted = True
+        start = time.monotonic()
+        try:
+            output = request_completion(
+                provider, endpoint_model, system, build(provider), temperature, max_tokens, stop=stop, until=until
+            )
+        except Exception as e:
+            if not tracked or not is_endpoint_failure(e):
+                raise
+            router.record_failure(provider, endpoint_model)
+            if last:
+                raise
+            logger.warning(f"{provider}/{endpoint_model} failed ({e}); failing over")
+            continue
+        if tracked:
+            router.record_success(provider, endpoint_model, time.monotonic() - start)
+        return output
+
+def generate(model_name, system, prompt, temperature=0.0, max_tokens=1024, verbose=False, cache=None, stop=None, until=None):
+    """
+    Generate a completion for a single-turn prompt.
+    `stop` is a list of stop sequences; `until` is a predicate on the output so far, and when given the
+    response is streamed and cut off as soon as it holds (e.g. once the section the caller parses is complete).
+    """
+    if cache is not None:
+        cache_key = make_cache_key(model_name, system_text(system), prompt, temperature, max_tokens, stop=stop, until=until)
+        output = cache.get(cache_key)
+        if output is not None:
+            record_cache_hit(cache_key, model_name, system_text(system), prompt, output)
+            return output
+
+    with replay_exchange(model_name, system_text(system), prompt, temperature, max_tokens, stop=stop, until=until):
+        output = route_completion(
+            model_name, system, lambda provider: build_messages(provider, system, prompt),
+            temperature, max_tokens, stop=stop, until=until
+        )
+    if cache is not None and output is not None:
+        cache.set(cache_key, output, model_name=model_name)
 
     if verbose:
         logger.debug("\n\n---\n")
@@ -358,10 +476,8 @@ def generate(model_name, system, prompt, temperature=0.0, max_tokens=1024, verbo
     return output
 
 class Generator:
-    def __init__(self, model_name, prompt_path, temperature=0.0, max_tokens=1024, verbose=False):
-        prompt_file = resources.files('prompts') / prompt_path
-        with prompt_file.open('r') as file:
-            prompt = yaml.safe_load(file)
+    def __init__(self, model_name, prompt_path, temperature=0.0, max_tokens=1024, verbose=False, cache=False, stop=None, until=None):
+        prompt = get_prompt(prompt_path)
         
         self.model_name = model_name
         self.system_template = prompt.get('system_prompt', None)
@@ -369,41 +485,62 @@ class Generator:
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.verbose = verbose
+        self.stop = stop
+        self.until = until
+        # Only deterministic generators should opt in to the response cache
+        self.cache = resolve_cache(cache)
+
+    def format_system(self, *args, **kwargs):
+        """
+        Format the system prompt, split into [static prefix, rest] when the template has fields
+        so that providers with prompt caching can cache the prefix.
+        """
+        return self.system_template.format_split(*args, **kwargs)
 
     def __call__(self, *args, **kwargs):
         output = generate(
             self.model_name,
-            self.system_template.format(*args, **kwargs),
+            self.format_system(*args, **kwargs),
             self.prompt_template.format(*args, **kwargs),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
-            verbose=self.verbose
+            verbose=self.verbose,
+            cache=self.cache,
+            stop=self.stop,
+            until=self.until
         )
         return output.strip()
 
-def generate_chat(model_name, system, messages, temperature=0.0, max_tokens=1024, verbose=False):
-    # Create a copy of the messages to avoid modifying the original list
-    messages = messages.copy()
-
-    # Generate response using correct api and format
-    if model_name in MODEL_DICTIONARY['openai']:
-        if system is not None:
-            messages.insert(0, { "role": "system", "content": system })
-        output = generate_openai(model_name, messages, temperature, max_tokens)
-
-    elif model_name in MODEL_DICTIONARY['together']:
-        if system is not None:
-            messages.insert(0, { "role": "system", "content": system })
-        output = generate_together(model_name, messages, temperature, max_tokens)
-
-    elif model_name in MODEL_DICTIONARY['anthropic']:
-        output = generate_anthropic(model_name, system, messages, temperature, max_tokens)
-
-    elif model_name in MODEL_DICTIONARY['anthropic_bedrock']:
-        output = generate_anthropic_bedrock(model_name, system, messages, temperature, max_tokens)
+    async def acall(self, *args, **kwargs):
+        """
+        Coroutine counterpart of __call__, backed by agenerate.
+        """
+        from utils.async_generation import agenerate
+        output = await agenerate(
+            self.model_name,
+            self.format_system(*args, **kwargs),
+            self.prompt_template.format(*args, **kwargs),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            verbose=self.verbose,
+            cache=self.cache,
+            stop=self.stop,
+            until=self.until
+        )
+        return output.strip()
 
-    else:
-        raise Exception(f"Model not found: {model_name}")
+# Providers whose APIs accept a multi-turn chat history
+CHAT_PROVIDERS = ["openai", "together", "anthropic", "anthropic_bedrock"]
+
+def generate_chat(model_name, system, messages, temperature=0.0, max_tokens=1024, verbose=False, stop=None, until=None):
+    """
+    Generate the next message of a multi-turn chat. `stop` and `until` are as in generate.
+    """
+    with replay_exchange(model_name, system_text(system), messages, temperature, max_tokens, stop=stop, until=until):
+        output = route_completion(
+            model_name, system, lambda provider: build_chat_messages(provider, system, messages),
+            temperature, max_tokens, stop=stop, until=until, providers=CHAT_PROVIDERS
+        )
 
     if verbose:
         logger.debug("\n\n---\n")
@@ -414,10 +551,8 @@ def generate_chat(model_name, system, messages, temperature=0.0, max_tokens=1024
     return output
 
 class GeneratorChat:
-    def __init__(self, model_name, prompt_path, initial_message=None, temperature=0.0, max_tokens=1024, verbose=False, **kwargs):
-        prompt_file = resources.files('prompts') / prompt_path
-        with prompt_file.open('r') as file:
-            prompt = yaml.safe_load(file)
+    def __init__(self, model_name, prompt_path, initial_message=None, temperature=0.0, max_tokens=1024, verbose=False, stop=None, until=None, **kwargs):
+        prompt = get_prompt(prompt_path)
         
         self.model_name = model_name
         self.system_prompt = prompt.get('system_prompt', None).format(**kwargs)
@@ -429,6 +564,8 @@ class GeneratorChat:
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.verbose = verbose
+        self.stop = stop
+        self.until = until
 
     def __call__(self, message):
         self.chat_history.append({"role": "user", "content": message})
@@ -438,7 +575,9 @@ class GeneratorChat:
             self.chat_history,
             temperature=self.temperature,
             max_tokens=self.max_tokens,
-            verbose=self.verbose
+            verbose=self.verbose,
+            stop=self.stop,
+            until=self.until
         ).strip()
         self.chat_history.append({"role": "assistant", "content": output})
         return output
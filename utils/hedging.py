@@ -0,0 +1,221 @@
+"""
+Per-call deadlines and hedged requests.
+
+Every provider call runs under a deadline (REQUEST_DEADLINE_SECONDS), so a stuck
+connection raises DeadlineExceeded instead of holding a worker for minutes. With
+hedging enabled, a call that is still running after the model's hedge delay gets
+a duplicate, and whichever finishes first is returned. The hedge delay is the
+HEDGE_PERCENTILE of the model's recent latencies, kept in a rolling window per
+process; until HEDGE_MIN_SAMPLES latencies have been seen, no hedges are sent.
+Since only calls slower than the percentile are duplicated, at most about
+(100 - HEDGE_PERCENTILE)% extra requests are sent.
+
+Sync calls run in a per-process thread pool; async calls run as tasks, and the
+losing task is cancelled. A thread cannot be cancelled, so the HTTP transport caps
+each call's timeouts at the time left before its deadline (see call_timeout), and
+an abandoned call ends once the deadline passes. Only the usage of the call whose
+result is returned is recorded.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import (
+    REQUEST_DEADLINE_SECONDS,
+    HEDGING,
+    HEDGE_PERCENTILE,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_WINDOW
+)
+from utils.usage import add_usage, deferred_usage, commit_usage
+
+logger = logging.getLogger(__name__)
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a provider call does not finish within its deadline.
+    """
+    pass
+
+class LatencyTracker:
+    """
+    Rolling window of recent call latencies per model.
+    """
+    def __init__(self, window=HEDGE_WINDOW):
+        self.window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name, seconds):
+        with self._lock:
+            self._latencies.setdefault(model_name, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, model_name, q):
+        """
+        Return the q-th percentile of the model's recent latencies, or None with fewer than HEDGE_MIN_SAMPLES.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(model_name, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(int(len(latencies) * q / 100), len(latencies) - 1)]
+
+# time.monotonic() by which the running provider call must finish
+_call_deadline = contextvars.ContextVar("call_deadline", default=None)
+_tracker = LatencyTracker()
+_executor = None
+_executor_pid = None
+
+def get_latency_tracker():
+    return _tracker
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor_pid != os.getpid():
+        # Threads do not survive fork
+        _executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="provider-call")
+        _executor_pid = os.getpid()
+    return _executor
+
+def _hedge_delay(model_name, hedge):
+    if not (HEDGING if hedge is None else hedge):
+        return None
+    return _tracker.percentile(model_name, HEDGE_PERCENTILE)
+
+def call_timeout():
+    """
+    Return the seconds left before the running call's deadline, or None for a call without one.
+    """
+    deadline_at = _call_deadline.get()
+    if deadline_at is None:
+        return None
+    return max(deadline_at - time.monotonic(), 0)
+
+def _timed(fn):
+    start = time.monotonic()
+    result = fn()
+    return result, time.monotonic() - start
+
+def _timed_call(fn, deadline_at):
+    # Runs in a copied context, so the deadline and the usage collection stay local to this call
+    _call_deadline.set(deadline_at)
+    with deferred_usage() as usage:
+        result, latency = _timed(fn)
+    return result, latency, usage
+
+def run_with_deadline(model_name, fn, deadline=REQUEST_DEADLINE_SECONDS, can_hedge=None, hedge=None):
+    """
+    Return fn() within `deadline` seconds, sending a duplicate call once the model's hedge delay has passed.
+    `can_hedge()` is asked before a duplicate is sent (e.g. whether the rate limits have room for it).
+    """
+    hedge_delay = _hedge_delay(model_name, hedge)
+    if deadline is None and hedge_delay is None:
+        result, latency = _timed(fn)
+        _tracker.record(model_name, latency)
+        return result
+
+    executor = _get_executor()
+    start = time.monotonic()
+    deadline_at = start + deadline if deadline is not None else None
+    # Worker threads do not inherit context variables such as the usage stage
+    futures = {executor.submit(contextvars.copy_context().run, _timed_call, fn, deadline_at)}
+    hedged = False
+    errors = []
+    while futures:
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - (time.monotonic() - start), 0)
+        if not hedged and hedge_delay is not None:
+            hedge_wait = max(hedge_delay - (time.monotonic() - start), 0)
+            timeout = min(timeout, hedge_wait) if timeout is not None else hedge_wait
+        done, futures = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result, latency, usage = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            _tracker.record(model_name, latency)
+            commit_usage(usage)
+            return result
+        if done:
+            continue
+        elapsed = time.monotonic() - start
+        if deadline is not None and elapsed >= deadline:
+            add_usage(model_name, {"deadline_exceeded": 1})
+            raise DeadlineExceeded(f"{model_name} call did not finish within {deadline}s")
+        if not hedged and hedge_delay is not None and elapsed >= hedge_delay:
+            hedged = True
+            if can_hedge is None or can_hedge():
+                logger.debug(f"Hedging {model_name} call after {elapsed:.1f}s")
+                add_usage(model_name, {"hedges": 1})
+                futures.add(executor.submit(contextvars.copy_context().run, _timed_call, fn, deadline_at))
+    raise errors[0]
+
+async def _atimed(coro_fn):
+    start = time.monotonic()
+    result = await coro_fn()
+    return result, time.monotonic() - start
+
+async def _atimed_call(coro_fn, deadline_at):
+    # Each task runs in its own copy of the context
+    _call_deadline.set(deadline_at)
+    with deferred_usage() as usage:
+        result, latency = await _atimed(coro_fn)
+    return result, latency, usage
+
+async def arun_with_deadline(model_name, coro_fn, deadline=REQUEST_DEADLINE_SECONDS, can_hedge=None, hedge=None):
+    """
+    Async counterpart of run_with_deadline; the losing call is cancelled.
+    can_hedge may block (e.g. on a rate limiter transaction), so it runs in a thread.
+    """
+    hedge_delay = _hedge_delay(model_name, hedge)
+    if deadline is None and hedge_delay is None:
+        result, latency = await _atimed(coro_fn)
+        _tracker.record(model_name, latency)
+        return result
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline_at = time.monotonic() + deadline if deadline is not None else None
+    tasks = {asyncio.ensure_future(_atimed_call(coro_fn, deadline_at))}
+    hedged = False
+    errors = []
+    try:
+        while tasks:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - (loop.time() - start), 0)
+            if not hedged and hedge_delay is not None:
+                hedge_wait = max(hedge_delay - (loop.time() - start), 0)
+                timeout = min(timeout, hedge_wait) if timeout is not None else hedge_wait
+            done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    result, latency, usage = task.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                _tracker.record(model_name, latency)
+                commit_usage(usage)
+                return result
+            if done:
+                continue
+            elapsed = loop.time() - start
+            if deadline is not None and elapsed >= deadline:
+                add_usage(model_name, {"deadline_exceeded": 1})
+                raise DeadlineExceeded(f"{model_name} call did not finish within {deadline}s")
+            if not hedged and hedge_delay is not None and elapsed >= hedge_delay:
+                hedged = True
+                if can_hedge is None or await asyncio.to_thread(can_hedge):
+                    logger.debug(f"Hedging {model_name} call after {elapsed:.1f}s")
+                    add_usage(model_name, {"hedges": 1})
+                    tasks.add(asyncio.ensure_future(_atimed_call(coro_fn, deadline_at)))
+        raise errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,125 @@
+"""
+Process-wide registry of the prompt templates under prompts/.
+
+Every YAML file under prompts/ is read and parsed once per process, on first use,
+and each template is split into its static prefix (the literal text before the
+first field) and the remaining dynamic part. Building a Generator or an
+evaluation module therefore costs a dictionary lookup, and formatting a prompt
+only formats the dynamic part and joins it to the pre-rendered prefix.
+
+Fields whose values never change (e.g. few-shot examples) can be rendered into a
+template once with bind(), which also extends its static prefix.
+
+Usage:
+    prompt = get_prompt("evaluation/response_generator.yaml")
+    user_prompt = prompt['user_prompt'].format(curr_request=..., interaction_log=...)
+"""
+import string
+import logging
+import threading
+from importlib import resources
+import yaml
+
+logger = logging.getLogger(__name__)
+
+_formatter = string.Formatter()
+_prompts = None
+_lock = threading.Lock()
+
+def _escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+def _field(field_name, conversion, format_spec):
+    return "{" + field_name + (f"!{conversion}" if conversion else "") + (f":{format_spec}" if format_spec else "") + "}"
+
+class PromptTemplate:
+    """
+    A format template parsed once into its static prefix and its dynamic remainder.
+    """
+    def __init__(self, template):
+        self.template = template
+        self.parts = list(_formatter.parse(template))
+        self.fields = [field_name for _, field_name, _, _ in self.parts if field_name is not None]
+
+        # Literal text up to the first field, and the rest re-assembled as a format template
+        self.prefix = ""
+        rest = []
+        for literal_text, field_name, format_spec, conversion in self.parts:
+            if rest:
+                rest.append(_escape(literal_text))
+            else:
+                self.prefix += literal_text
+            if field_name is not None:
+                rest.append(_field(field_name, conversion, format_spec))
+        self.rest = "".join(rest)
+
+    def format(self, *args, **kwargs):
+        if not self.fields:
+            return self.prefix
+        return self.prefix + self.rest.format(*args, **kwargs)
+
+    def format_split(self, *args, **kwargs):
+        """
+        Format the template, split into [static prefix, rest] when it has both,
+        so that providers with prompt caching can cache the prefix.
+        """
+        if not self.fields:
+            return self.prefix
+        rest = self.rest.format(*args, **kwargs)
+        if self.prefix and rest:
+            return [self.prefix, rest]
+        return self.prefix + rest
+
+    def bind(self, **values):
+        """
+        Return a template with the given fields rendered in.
+        """
+        template = []
+        for literal_text, field_name, format_spec, conversion in self.parts:
+            template.append(_escape(literal_text))
+            if field_name is None:
+                continue
+            if field_name in values:
+                value = _formatter.convert_field(values[field_name], conversion)
+                template.append(_escape(_formatter.format_field(value, format_spec)))
+            else:
+                template.append(_field(field_name, conversion, format_spec))
+        return PromptTemplate("".join(template))
+
+    def __str__(self):
+        return self.template
+
+def _load_directory(directory, prefix, prompts):
+    for entry in directory.iterdir():
+        name = f"{prefix}{entry.name}"
+        if entry.is_dir():
+            _load_directory(entry, f"{name}/", prompts)
+        elif entry.name.endswith((".yaml", ".yml")):
+            with entry.open('r') as file:
+                prompt = yaml.safe_load(file)
+            prompts[name] = {
+                key: PromptTemplate(value) if isinstance(value, str) else value
+                for key, value in prompt.items()
+            }
+
+def load_prompts():
+    """
+    Return all prompt files under prompts/ by relative path, loading them on the first call in a process.
+    """
+    global _prompts
+    with _lock:
+        if _prompts is None:
+            prompts = {}
+            _load_directory(resources.files('prompts'), "", prompts)
+            logger.debug(f"Loaded {len(prompts)} prompt files")
+            _prompts = prompts
+    return _prompts
+
+def get_prompt(prompt_path):
+    """
+    Return the templates of a prompt file, e.g. {"system_prompt": PromptTemplate, "user_prompt": PromptTemplate}.
+    """
+    prompts = load_prompts()
+    if prompt_path not in prompts:
+        raise Exception(f"Prompt not found: {prompt_path}")
+    return prompts[prompt_path]
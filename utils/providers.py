@@ -0,0 +1,232 @@
+"""
+Provider clients and the model -> provider registry.
+
+Provider SDKs are imported and their clients created on first use, so importing
+the generation utilities does not touch the network or pay for heavy SDK imports.
+Clients are cached per process so that Pool workers never share connections
+inherited through fork, and all of them send requests through the process's
+shared connection pool (utils.transport). The Gemini client manages its own
+authenticated HTTP client.
+
+MODEL_DICTIONARY is built from a static list of known models, extended by the
+models discovered on the last explicit refresh (stored at MODEL_REGISTRY_PATH).
+Refresh the registry with:
+
+    python -m utils.providers --refresh
+"""
+import os
+import json
+import argparse
+import logging
+from config import VLLM_HOST, MODEL_REGISTRY_PATH
+
+logger = logging.getLogger(__name__)
+
+STATIC_MODEL_DICTIONARY = {
+    "openai": [
+        "gpt-4o-2024-11-20",
+        "gpt-4o-2024-08-06",
+        "gpt-4o",
+        "gpt-4o-mini",
+        "gpt-4o-mini-2024-07-18",
+        "gpt-4.1-2025-04-14",
+        "gpt-4.1-mini-2025-04-14",
+        "gpt-4.1-nano-2025-04-14",
+        "o1",
+        "o1-2024-12-17",
+        "o1-mini",
+        "o3-mini",
+        "o3-mini-2025-01-31",
+        "o3",
+        "o4-mini"
+    ],
+    "anthropic": [
+        "claude-3-7-sonnet-20250219",
+        "claude-3-5-sonnet-20241022",
+        "claude-3-5-sonnet-20240620",
+        "claude-3-opus-20240229",
+        "claude-3-sonnet-20240229",
+        "claude-3-haiku-20240307",
+        "claude-3-5-haiku-20241022"
+    ],
+    "anthropic_bedrock": [
+        "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
+        "anthropic.claude-3-5-sonnet-20241022-v2:0",
+        "anthropic.claude-3-5-sonnet-20240620-v1:0",
+        "anthropic.claude-3-5-haiku-20241022-v1:0"
+    ],
+    "together": [
+        "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
+        "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
+        "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo",
+        "meta-llama/Meta-Llama-3-8B-Instruct-Turbo",
+        "meta-llama/Meta-Llama-3-70B-Instruct-Turbo",
+        "mistralai/Mixtral-8x7B-Instruct-v0.1",
+        "mistralai/Mixtral-8x22B-Instruct-v0.1",
+        "deepseek-ai/DeepSeek-R1",
+        "mistralai/Mistral-7B-Instruct-v0.3",
+        "Qwen/Qwen2.5-72B-Instruct-Turbo",
+    ],
+    "gemini": [
+        "gemini-2.0-pro-exp-02-05",
+        "gemini-2.0-flash-thinking-exp-01-21"
+    ],
+    "vllm": [
+        "kixlab/prefmatcher-7b"
+    ]
+}
+
+# Providers whose model lists can be discovered from their API
+DISCOVERABLE_PROVIDERS = ["openai", "vllm"]
+
+def load_model_dictionary(path=MODEL_REGISTRY_PATH):
+    """
+    Merge the static model lists with the models discovered on the last refresh.
+    """
+    model_dictionary = {provider: list(models) for provider, models in STATIC_MODEL_DICTIONARY.items()}
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                discovered = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"Failed to load model registry from {path}: {e}")
+            discovered = {}
+        for provider, models in discovered.items():
+            if provider not in model_dictionary:
+                continue
+            for model in models:
+                if model not in model_dictionary[provider]:
+                    model_dictionary[provider].append(model)
+    return model_dictionary
+
+MODEL_DICTIONARY = load_model_dictionary()
+
+def get_provider(model_name):
+    """
+    Return the provider key in MODEL_DICTIONARY that serves the given model.
+    """
+    for provider, models in MODEL_DICTIONARY.items():
+        if model_name in models:
+            return provider
+    raise Exception(f"Model not found: {model_name} (run `python -m utils.providers --refresh` to update the model registry)")
+
+# Environment variables each provider needs; providers without an entry need none
+PROVIDER_CREDENTIALS = {
+    "openai": ["OPENAI_API_KEY"],
+    "anthropic": ["ANTHROPIC_API_KEY"],
+    "anthropic_bedrock": ["AWS_ACCESS_KEY", "AWS_SECRET_KEY"],
+    "together": ["TOGETHER_API_KEY"],
+    "gemini": ["GEMINI_PROJECT_ID"],
+}
+
+def has_credentials(provider):
+    return all(os.environ.get(name) is not None for name in PROVIDER_CREDENTIALS.get(provider, []))
+
+_clients = {}
+_clients_pid = None
+
+def _create_client(provider):
+    from utils.transport import get_http_client
+    if provider == "openai":
+        if os.environ.get("OPENAI_API_KEY") is None:
+            raise Exception("OPENAI_API_KEY is not set")
+        import openai
+        return openai.Client(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=get_http_client()
+        )
+    elif provider == "anthropic":
+        if os.environ.get("ANTHROPIC_API_KEY") is None:
+            raise Exception("ANTHROPIC_API_KEY is not set")
+        from anthropic import Anthropic
+        return Anthropic(
+            api_key=os.environ.get("ANTHROPIC_API_KEY"),
+            http_client=get_http_client()
+        )
+    elif provider == "anthropic_bedrock":
+        if os.environ.get("AWS_ACCESS_KEY") is None or os.environ.get("AWS_SECRET_KEY") is None:
+            raise Exception("AWS_ACCESS_KEY or AWS_SECRET_KEY is not set")
+        from anthropic import AnthropicBedrock
+        return AnthropicBedrock(
+            aws_access_key=os.environ.get("AWS_ACCESS_KEY"),
+            aws_secret_key=os.environ.get("AWS_SECRET_KEY"),
+            aws_region="us-west-2",
+            http_client=get_http_client()
+        )
+    elif provider == "together":
+        if os.environ.get("TOGETHER_API_KEY") is None:
+            raise Exception("TOGETHER_API_KEY is not set")
+        import openai
+        return openai.OpenAI(
+            api_key=os.environ.get("TOGETHER_API_KEY"),
+            base_url="https://api.together.xyz/v1",
+            http_client=get_http_client()
+        )
+    elif provider == "gemini":
+        if os.environ.get("GEMINI_PROJECT_ID") is None:
+            raise Exception("GEMINI_PROJECT_ID is not set")
+        from google import genai
+        return genai.Client(
+            vertexai=True,
+            project=os.environ.get("GEMINI_PROJECT_ID"),
+            location="us-central1"
+        )
+    elif provider == "vllm":
+        import openai
+        return openai.Client(
+            api_key="EMPTY",
+            base_url=f"{VLLM_HOST}/v1",
+            http_client=get_http_client()
+        )
+    else:
+        raise Exception(f"Unknown provider: {provider}")
+
+def get_client(provider):
+    """
+    Return the client for a provider, creating it on first use in this process.
+    """
+    global _clients, _clients_pid
+    if _clients_pid != os.getpid():
+        # Clients inherited through fork share sockets with the parent
+        _clients = {}
+        _clients_pid = os.getpid()
+    if provider not in _clients:
+        _clients[provider] = _create_client(provider)
+    return _clients[provider]
+
+def refresh_model_registry(path=MODEL_REGISTRY_PATH):
+    """
+    Query the providers that expose a model list and store the discovered models at `path`.
+    """
+    discovered = {}
+    for provider in DISCOVERABLE_PROVIDERS:
+        try:
+            discovered[provider] = sorted(model.id for model in get_client(provider).models.list().data)
+            logger.info(f"Discovered {len(discovered[provider])} {provider} models")
+        except Exception as e:
+            logger.warning(f"Could not list {provider} models: {e}")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(discovered, f, indent=2)
+
+    # Update the registry of the running process as well
+    MODEL_DICTIONARY.clear()
+    MODEL_DICTIONARY.update(load_model_dictionary(path))
+    return discovered
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or refresh the model -> provider registry.")
+    parser.add_argument("--refresh", action="store_true", help="Query provider APIs and update the cached model registry")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.refresh:
+        refresh_model_registry()
+    for provider, models in MODEL_DICTIONARY.items():
+        print(f"{provider}: {len(models)} models")
+        for model in models:
+            print(f"  {model}")
+
+if __name__ == "__main__":
+    main()
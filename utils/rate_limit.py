@@ -0,0 +1,214 @@
+"""
+Cross-process token-bucket rate limiting for LLM providers and models.
+
+Each limited key (a provider name or a model name from MODEL_DICTIONARY) has two
+buckets, one for requests/min and one for tokens/min, stored in a SQLite file so
+that every Pool worker draws from the same budget. When a provider still answers
+with a 429, the key is blocked for the duration given by its retry-after header
+(or an exponential backoff) and its buckets are drained, so all workers back off
+together instead of retrying into the same wall.
+"""
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from config import RATE_LIMIT_PATH, RATE_LIMITS
+
+logger = logging.getLogger(__name__)
+
+_limiters = {}
+
+def estimate_tokens(system, messages, max_tokens):
+    """
+    Estimate the tokens a request counts against a tokens/min limit.
+    Providers reserve max_tokens for the completion, so it is included in full.
+    """
+    if isinstance(system, list):
+        system = "".join(system)
+    n_chars = len(system) if isinstance(system, str) else 0
+    for message in messages:
+        content = message.get('content', "") if isinstance(message, dict) else message
+        n_chars += len(content) if isinstance(content, str) else len(str(content))
+    return n_chars // 4 + max_tokens
+
+def get_retry_after(error, attempt):
+    """
+    Return how long to wait before retrying a rate-limited request, or None if the error is not a rate limit.
+    """
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if status != 429:
+        return None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers.get('retry-after-ms')) / 1000
+        if headers.get('retry-after') is not None:
+            return float(headers.get('retry-after'))
+    except ValueError:
+        pass
+    return min(2 ** attempt, 60)
+
+class RateLimiter:
+    """
+    Token buckets shared across processes through SQLite.
+    """
+    def __init__(self, path=RATE_LIMIT_PATH, limits=RATE_LIMITS):
+        self.path = path
+        self.limits = limits
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL, blocked_until REAL)"
+        )
+
+    def _connection(self):
+        # Connections must not be shared across forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def limited_keys(self, keys):
+        return [key for key in keys if key in self.limits]
+
+    def reserve(self, keys, n_tokens):
+        """
+        Try to take one request and n_tokens from every key's buckets.
+        Returns 0 on success, otherwise the number of seconds to wait before trying again.
+        """
+        keys = self.limited_keys(keys)
+        if not keys:
+            return 0
+        now = time.time()
+        with self._transaction() as conn:
+            wait = 0
+            states = {}
+            for key in keys:
+                rpm = self.limits[key].get('rpm')
+                tpm = self.limits[key].get('tpm')
+                row = conn.execute(
+                    "SELECT requests, tokens, updated, blocked_until FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    row = (rpm or 0, tpm or 0, now, 0)
+                requests, tokens, updated, blocked_until = row
+                elapsed = max(now - updated, 0)
+                if rpm is not None:
+                    requests = min(rpm, requests + elapsed * rpm / 60)
+                    if requests < 1:
+                        wait = max(wait, (1 - requests) * 60 / rpm)
+                if tpm is not None:
+                    tokens = min(tpm, tokens + elapsed * tpm / 60)
+                    # A request larger than the whole bucket only waits for a full bucket
+                    needed = min(n_tokens, tpm)
+                    if tokens < needed:
+                        wait = max(wait, (needed - tokens) * 60 / tpm)
+                if blocked_until > now:
+                    wait = max(wait, blocked_until - now)
+                states[key] = [requests, tokens, blocked_until]
+
+            if wait == 0:
+                for key, state in states.items():
+                    if self.limits[key].get('rpm') is not None:
+                        state[0] -= 1
+                    if self.limits[key].get('tpm') is not None:
+                        state[1] -= min(n_tokens, self.limits[key]['tpm'])
+            for key, (requests, tokens, blocked_until) in states.items():
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                    (key, requests, tokens, now, blocked_until)
+                )
+        return wait
+
+    def headroom(self, keys):
+        """
+        Return the fraction of the tightest bucket that is currently available (1 when no key is limited).
+        """
+        keys = self.limited_keys(keys)
+        now = time.time()
+        headroom = 1.0
+        conn = self._connection()
+        for key in keys:
+            with self._lock:
+                row = conn.execute(
+                    "SELECT requests, tokens, updated, blocked_until FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None:
+                continue
+            requests, tokens, updated, blocked_until = row
+            if blocked_until > now:
+                return 0.0
+            elapsed = max(now - updated, 0)
+            for capacity, level in [(self.limits[key].get('rpm'), requests), (self.limits[key].get('tpm'), tokens)]:
+                if capacity:
+                    headroom = min(headroom, max(min(capacity, level + elapsed * capacity / 60), 0) / capacity)
+        return headroom
+
+    def acquire(self, keys, n_tokens):
+        """
+        Block until the request fits within every key's limits.
+        """
+        while True:
+            wait = self.reserve(keys, n_tokens)
+            if wait == 0:
+                return
+            # Jitter keeps workers from waking up in lockstep
+            time.sleep(wait + random.uniform(0, 0.1))
+
+    async def aacquire(self, keys, n_tokens):
+        """
+        Async counterpart of acquire. The reservation is a blocking SQLite transaction, so it runs in a thread.
+        """
+        while True:
+            wait = await asyncio.to_thread(self.reserve, keys, n_tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait + random.uniform(0, 0.1))
+
+    def penalize(self, keys, retry_after):
+        """
+        Block the keys for retry_after seconds and drain their buckets after a 429.
+        """
+        keys = self.limited_keys(keys)
+        if not keys:
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            for key in keys:
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, 0, 0, ?, ?)",
+                    (key, now, now + retry_after)
+                )
+        logger.warning(f"Rate limited on {', '.join(keys)}: backing off for {retry_after:.1f}s")
+
+def get_rate_limiter(path=RATE_LIMIT_PATH):
+    """
+    Return the process-wide RateLimiter for a path.
+    """
+    if path not in _limiters:
+        _limiters[path] = RateLimiter(path)
+    return _limiters[path]
@@ -0,0 +1,308 @@
+"""
+Record/replay backend for running the pipelines without provider access.
+
+In record mode, every provider call made on behalf of generate/generate_chat (and
+their async counterparts) is sent as usual and the exchange is appended to a tape:
+a directory of gzipped JSON-lines files, one per process. In replay mode, the same
+calls are answered from the tape instead of a provider, after a synthetic latency
+(the recorded one, scaled, or drawn around a fixed mean), and a configurable share
+of calls fail with injected rate-limit (429) or server (500) errors. The rest of
+the generation path above the provider call (routing, rate limiting, deadlines,
+hedging, single-flight) runs unchanged, so full pipelines can be profiled and
+load-tested offline.
+
+Exchanges are keyed by the logical request (model, system prompt, prompt or chat
+history, sampling parameters), so a replay does not depend on which endpoint a
+routed model used while recording. Requests repeated with the same key (e.g. at
+temperature > 0) are answered with their recorded outputs in turn. Prompts that
+differ from the recording, e.g. because synthesis samples personas and sessions
+at random, are answered with the outputs recorded for the same model and usage
+stage instead, unless the backend is strict.
+
+Each logical request is recorded once: when a call is hedged, only the first
+output to arrive is kept, and requests answered from the response cache while
+recording are recorded too (see record_cache_hit), so that a replay with a cold
+cache finds them on the tape.
+
+Usage:
+    python -m evaluation.run ... --record tapes/eval
+    python -m evaluation.run ... --replay tapes/eval --replay_latency_scale 0.5 --replay_error_rate 0.05
+"""
+import os
+import gzip
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import REPLAY_RETRY_AFTER
+from utils.cache import make_cache_key
+from utils.rate_limit import estimate_tokens
+from utils.usage import add_usage, current_usage_stage
+
+logger = logging.getLogger(__name__)
+
+_exchange = contextvars.ContextVar("replay_exchange", default=None)
+
+class _Response:
+    def __init__(self, headers):
+        self.headers = headers
+
+class _Exchange:
+    """
+    The logical request that the provider calls of a generate/generate_chat call answer.
+    Hedged duplicates share it, so that only one of them is recorded.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.recorded = False
+
+class InjectedError(Exception):
+    """
+    A synthetic provider error raised during replay. Rate-limit errors carry status_code 429 and a
+    retry-after header, like the providers' own, so the retry paths are exercised.
+    """
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = _Response({"retry-after": str(REPLAY_RETRY_AFTER)} if status_code == 429 else {})
+
+@contextmanager
+def replay_exchange(model_name, system, payload, temperature, max_tokens, stop=None, until=None):
+    """
+    Mark the provider calls made inside the block as answering this logical request.
+    """
+    if _backend is None:
+        yield
+        return
+    token = _exchange.set(_Exchange(make_cache_key(model_name, system, payload, temperature, max_tokens, stop=stop, until=until)))
+    try:
+        yield
+    finally:
+        _exchange.reset(token)
+
+class ReplayBackend:
+    """
+    Records provider exchanges to a tape directory, or answers them from one.
+    """
+    def __init__(self, path, mode, latency=None, latency_scale=1.0, error_rate=0.0, rate_limit_share=0.5, strict=False, seed=None):
+        if mode not in ["record", "replay"]:
+            raise Exception(f"Unknown replay backend mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.rate_limit_share = rate_limit_share
+        self.strict = strict
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._pid = os.getpid()
+        self._exchanges = {}
+        self._by_stage = {}
+        self._served = {}
+        os.makedirs(path, exist_ok=True)
+        if mode == "replay":
+            self._load()
+
+    def _load(self):
+        n_exchanges = 0
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith(".jsonl.gz"):
+                continue
+            try:
+                with gzip.open(os.path.join(self.path, filename), "rt") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        self._exchanges.setdefault(entry['key'], []).append(entry)
+                        self._by_stage.setdefault((entry['model'], entry.get('stage')), []).append(entry)
+                        n_exchanges += 1
+            except (EOFError, OSError, json.JSONDecodeError) as e:
+                # A process killed mid-flush leaves a truncated last member
+                logger.warning(f"Stopped reading {filename} at a damaged record: {e}")
+        logger.info(f"Loaded {n_exchanges} recorded exchanges ({len(self._exchanges)} distinct requests) from {self.path}")
+
+    def _current(self, model_name):
+        exchange = _exchange.get()
+        if exchange is None:
+            raise Exception(f"Provider call for {model_name} made outside generate/generate_chat cannot be recorded or replayed")
+        return exchange
+
+    def _key(self, model_name):
+        return self._current(model_name).key
+
+    def _record(self, exchange, model_name, system, messages, output, latency):
+        entry = {
+            "key": exchange.key,
+            "model": model_name,
+            "output": output,
+            "latency": round(latency, 4),
+            "stage": current_usage_stage(),
+            # Token estimates stand in for provider usage during replay
+            "input_tokens": estimate_tokens(system, messages, 0),
+            "output_tokens": len(output or "") // 4
+        }
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked workers must not write out exchanges buffered by their parent
+                self._pid = os.getpid()
+                self._buffer = []
+            # A hedged duplicate that finishes second answers the same logical request
+            if exchange.recorded:
+                return
+            exchange.recorded = True
+            self._buffer.append(entry)
+
+    def record_cached(self, key, model_name, system, prompt, output):
+        """
+        Record a request answered from the response cache, which never reaches the provider call.
+        """
+        messages = prompt if isinstance(prompt, list) else [prompt]
+        self._record(_Exchange(key), model_name, system, messages, output, 0.0)
+
+    def _next(self, model_name):
+        """
+        Return the recorded exchange to serve next, and how long to wait before answering; raise an
+        injected error for the configured share of calls.
+        """
+        key = self._key(model_name)
+        fallback = False
+        with self._lock:
+            entries = self._exchanges.get(key)
+            if not entries and not self.strict:
+                key = (model_name, current_usage_stage())
+                entries = self._by_stage.get(key)
+                fallback = True
+            if not entries:
+                raise Exception(f"No recorded response for this {model_name} request in {self.path}")
+            entry = entries[self._served.get(key, 0) % len(entries)]
+            if self.latency is not None:
+                delay = self._random.expovariate(1 / self.latency) if self.latency > 0 else 0
+            else:
+                delay = entry['latency'] * self.latency_scale
+            if self._random.random() < self.error_rate:
+                status_code = 429 if self._random.random() < self.rate_limit_share else 500
+                return None, delay, InjectedError(f"Injected error {status_code} for {model_name}", status_code)
+            # Failed calls do not use up a recorded output, so retries get the same one
+            self._served[key] = self._served.get(key, 0) + 1
+        if fallback:
+            add_usage(model_name, {"replay_fallbacks": 1})
+        return entry, delay, None
+
+    def _replayed(self, model_name, entry):
+        add_usage(model_name, {
+            "requests": 1,
+            "input_tokens": entry.get('input_tokens', 0),
+            "output_tokens": entry.get('output_tokens', 0),
+            "replayed": 1
+        })
+        return entry['output']
+
+    def call(self, model_name, system, messages, fn):
+        """
+        Return fn(), the provider call for these messages, recording its output; in replay mode answer
+        from the tape instead.
+        """
+        if self.mode == "record":
+            exchange = self._current(model_name)
+            start = time.monotonic()
+            output = fn()
+            self._record(exchange, model_name, system, messages, output, time.monotonic() - start)
+            return output
+        entry, delay, error = self._next(model_name)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return self._replayed(model_name, entry)
+
+    async def acall(self, model_name, system, messages, coro_fn):
+        """
+        Async counterpart of call.
+        """
+        if self.mode == "record":
+            exchange = self._current(model_name)
+            start = time.monotonic()
+            output = await coro_fn()
+            self._record(exchange, model_name, system, messages, output, time.monotonic() - start)
+            return output
+        entry, delay, error = self._next(model_name)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return self._replayed(model_name, entry)
+
+    def flush(self):
+        """
+        Append this process's recorded exchanges to {path}/{pid}.jsonl.gz.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._buffer = []
+            entries, self._buffer = self._buffer, []
+        if not entries:
+            return
+        # Each flush appends one gzip member; readers see the members as one stream
+        with gzip.open(os.path.join(self.path, f"{os.getpid()}.jsonl.gz"), "at") as f:
+            f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+
+_backend = None
+
+def set_replay_backend(backend):
+    """
+    Record or replay provider calls through `backend` (None sends them to the providers as usual).
+    """
+    global _backend
+    _backend = backend
+
+def get_replay_backend():
+    return _backend
+
+def record_cache_hit(key, model_name, system, prompt, output):
+    """
+    Record a response-cache hit of generate/agenerate as an exchange, if recording.
+    `key` is the request's cache key, which is also its exchange key.
+    """
+    if _backend is not None and _backend.mode == "record":
+        _backend.record_cached(key, model_name, system, prompt, output)
+
+def flush_replay():
+    """
+    Write out the exchanges recorded by this process, if recording.
+    """
+    if _backend is not None and _backend.mode == "record":
+        _backend.flush()
+
+def add_replay_arguments(parser):
+    """
+    Add the record/replay options shared by the pipeline entry points.
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", type=str, help="Record every LLM exchange to this tape directory")
+    group.add_argument("--replay", type=str, help="Answer LLM calls from this tape directory instead of the providers")
+    parser.add_argument("--replay_latency", type=float, default=None, help="Mean synthetic latency in seconds for replayed calls (default: recorded latencies)")
+    parser.add_argument("--replay_latency_scale", type=float, default=1.0, help="Factor applied to recorded latencies (default: 1.0)")
+    parser.add_argument("--replay_error_rate", type=float, default=0.0, help="Share of replayed calls that fail with an injected 429 or 500 error (default: 0)")
+    parser.add_argument("--replay_strict", action="store_true", help="Fail replayed calls whose exact request was not recorded (default: False)")
+    parser.add_argument("--replay_seed", type=int, default=None, help="Seed for replay latencies and error injection")
+
+def setup_replay(args):
+    """
+    Install the replay backend selected by the options of add_replay_arguments, if any.
+    """
+    if args.record:
+        set_replay_backend(ReplayBackend(args.record, "record"))
+    elif args.replay:
+        set_replay_backend(ReplayBackend(
+            args.replay,
+            "replay",
+            latency=args.replay_latency,
+            latency_scale=args.replay_latency_scale,
+            error_rate=args.replay_error_rate,
+            strict=args.replay_strict,
+            seed=args.replay_seed
+        ))
@@ -0,0 +1,245 @@
+"""
+Routing of logical models to several provider endpoints.
+
+MODEL_ROUTES in config.py maps a logical model name to the (provider, model)
+endpoints that serve it, e.g. a Claude model on both the Anthropic API and
+Bedrock. Each request picks an endpoint at random, weighted by the endpoint's
+remaining rate-limit quota over its observed latency, and fails over to the
+others in order of weight. Models without a route have their single endpoint
+from MODEL_DICTIONARY.
+
+Each endpoint has a circuit breaker: after CIRCUIT_BREAKER_FAILURES consecutive
+failures it is skipped for CIRCUIT_BREAKER_COOLDOWN seconds, after which a single
+trial request is let through (half-open) and either closes the breaker or opens
+it again. Only errors that say something about the endpoint count as failures
+(server errors, 429s, timeouts and connection errors); a request the provider
+rejects, such as a prompt that is too long, fails the same way everywhere and is
+raised without failing over. Breaker state and latencies are kept in SQLite, so
+an outage seen by one Pool worker is seen by all of them. Ranking endpoints only
+reads that state; the half-open trial is claimed for the endpoint actually called.
+"""
+import os
+import time
+import random
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from config import (
+    ROUTER_PATH,
+    MODEL_ROUTES,
+    CIRCUIT_BREAKER_FAILURES,
+    CIRCUIT_BREAKER_COOLDOWN
+)
+from utils.providers import get_client, get_provider, has_credentials
+from utils.rate_limit import get_rate_limiter
+from utils.replay import get_replay_backend
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest latency in the moving average
+LATENCY_SMOOTHING = 0.2
+
+# Providers whose endpoints can be probed cheaply by listing models
+PROBE_PROVIDERS = ["openai", "together", "vllm", "anthropic"]
+
+# Exception classes (matched by name, so that no provider SDK has to be imported) of errors
+# that say an endpoint is unreachable or too slow
+ENDPOINT_ERRORS = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "TimeoutException",
+    "TransportError",
+    "NetworkError",
+    "DeadlineExceeded",
+    "TimeoutError",
+    "ConnectionError"
+}
+
+_routers = {}
+
+def is_endpoint_failure(error):
+    """
+    Return whether an error counts against the endpoint's circuit breaker: a 5xx or 429 response,
+    a timeout or a connection error. Other errors (e.g. a 400 for a prompt that is too long) would
+    fail the same way on every endpoint.
+    """
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return any(cls.__name__ in ENDPOINT_ERRORS for cls in type(error).__mro__)
+
+class Router:
+    """
+    Endpoint selection with shared latency averages and circuit breakers.
+    """
+    def __init__(self, path=ROUTER_PATH, routes=MODEL_ROUTES):
+        self.path = path
+        self.routes = routes
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS endpoints ("
+            "key TEXT PRIMARY KEY, failures INTEGER, opened_until REAL, latency REAL)"
+        )
+
+    def _connection(self):
+        # Connections must not be shared across forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        with self._lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def endpoints(self, model_name):
+        """
+        Return the configured (provider, model) endpoints of a logical model, in configured order.
+        """
+        if model_name in self.routes:
+            endpoints = [tuple(endpoint) for endpoint in self.routes[model_name]]
+            available = [endpoint for endpoint in endpoints if has_credentials(endpoint[0])]
+            return available or endpoints
+        return [(get_provider(model_name), model_name)]
+
+    def _states(self, keys):
+        """
+        Return {key: (failures, opened_until, latency)} for the endpoints with recorded state, without writing.
+        """
+        conn = self._connection()
+        with self._lock:
+            rows = conn.execute(
+                f"SELECT key, failures, opened_until, latency FROM endpoints WHERE key IN ({', '.join('?' * len(keys))})",
+                keys
+            ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def claim(self, provider, endpoint_model):
+        """
+        Return whether a request may be sent to an endpoint now: its breaker is closed, or its cooldown
+        is over and this caller wins the single half-open trial. Call it only for the endpoint about to be called.
+        """
+        key = f"{provider}/{endpoint_model}"
+        state = self._states([key]).get(key)
+        if state is None or state[0] < CIRCUIT_BREAKER_FAILURES:
+            return True
+        if state[1] > time.time():
+            return False
+        with self._transaction() as conn:
+            now = time.time()
+            row = conn.execute("SELECT failures, opened_until FROM endpoints WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] < CIRCUIT_BREAKER_FAILURES:
+                return True
+            if row[1] > now:
+                # Another caller took the trial
+                return False
+            # Half-open: keep the breaker open for everyone else while this trial runs
+            conn.execute("UPDATE endpoints SET opened_until = ? WHERE key = ?", (now + CIRCUIT_BREAKER_COOLDOWN, key))
+        logger.info(f"Circuit breaker for {key} is half-open, sending a trial request")
+        return True
+
+    def select(self, model_name, providers=None):
+        """
+        Return the endpoints to try for a request, best first. Endpoints with an open breaker are left out
+        unless every endpoint is open, in which case all are returned in configured order.
+        `providers` restricts the endpoints to the given providers. Endpoints whose cooldown is over are
+        ranked like closed ones; the caller claims their half-open trial (see claim) before calling them.
+        """
+        endpoints = self.endpoints(model_name)
+        if providers is not None:
+            endpoints = [endpoint for endpoint in endpoints if endpoint[0] in providers]
+        if len(endpoints) <= 1:
+            return endpoints
+
+        now = time.time()
+        limiter = get_rate_limiter()
+        states = self._states([f"{provider}/{endpoint_model}" for provider, endpoint_model in endpoints])
+        weighted = []
+        for provider, endpoint_model in endpoints:
+            failures, opened_until, latency = states.get(f"{provider}/{endpoint_model}", (0, 0, None))
+            if failures >= CIRCUIT_BREAKER_FAILURES and opened_until > now:
+                continue
+            if latency is None:
+                latency = 1.0
+            headroom = limiter.headroom([provider, endpoint_model])
+            weighted.append(((provider, endpoint_model), max(headroom, 0.01) / max(latency, 0.1)))
+        if not weighted:
+            logger.warning(f"All endpoints for {model_name} have open circuit breakers")
+            return endpoints
+
+        # Spread load: draw the first endpoint by weight, keep the rest as fallbacks by weight
+        first = random.choices(range(len(weighted)), weights=[weight for _, weight in weighted])[0]
+        fallbacks = sorted(weighted[:first] + weighted[first + 1:], key=lambda item: -item[1])
+        return [weighted[first][0]] + [endpoint for endpoint, _ in fallbacks]
+
+    def record_success(self, provider, endpoint_model, latency):
+        key = f"{provider}/{endpoint_model}"
+        with self._transaction() as conn:
+            row = conn.execute("SELECT latency FROM endpoints WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] is not None:
+                latency = (1 - LATENCY_SMOOTHING) * row[0] + LATENCY_SMOOTHING * latency
+            conn.execute("INSERT OR REPLACE INTO endpoints VALUES (?, 0, 0, ?)", (key, latency))
+
+    def record_failure(self, provider, endpoint_model, trip=False):
+        """
+        Count a failure and open the breaker once the endpoint has failed too many times in a row
+        (or right away with `trip`).
+        """
+        key = f"{provider}/{endpoint_model}"
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT failures, latency FROM endpoints WHERE key = ?", (key,)).fetchone()
+            failures, latency = row if row is not None else (0, None)
+            failures = max(failures + 1, CIRCUIT_BREAKER_FAILURES if trip else 0)
+            opened_until = now + CIRCUIT_BREAKER_COOLDOWN if failures >= CIRCUIT_BREAKER_FAILURES else 0
+            conn.execute("INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?)", (key, failures, opened_until, latency))
+        if failures == CIRCUIT_BREAKER_FAILURES or trip:
+            logger.warning(f"Circuit breaker opened for {key} after {failures} consecutive failures")
+
+    def check_health(self):
+        """
+        Probe the endpoints of every multi-endpoint route once, opening the breaker of unreachable ones.
+        Replayed runs send no live requests, so they are not probed.
+        """
+        if get_replay_backend() is not None:
+            return
+        healthy = {}
+        for model_name, endpoints in self.routes.items():
+            if len(endpoints) <= 1:
+                continue
+            for provider, endpoint_model in endpoints:
+                if provider not in PROBE_PROVIDERS or not has_credentials(provider):
+                    continue
+                if provider not in healthy:
+                    try:
+                        get_client(provider).models.list()
+                        healthy[provider] = True
+                    except Exception as e:
+                        logger.warning(f"Health check failed for {provider}: {e}")
+                        healthy[provider] = False
+                if not healthy[provider]:
+                    self.record_failure(provider, endpoint_model, trip=True)
+
+def get_router(path=ROUTER_PATH):
+    """
+    Return the process-wide Router for a path.
+    """
+    if path not in _routers:
+        _routers[path] = Router(path)
+    return _routers[path]
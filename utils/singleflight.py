@@ -0,0 +1,263 @@
+"""
+Single-flight deduplication of identical in-flight LLM requests.
+
+When several callers issue the same deterministic request at the same time,
+only the first (the leader) calls the provider; the others wait for its result.
+Callers in the same process wait on the leader directly. When the process is
+one of several of a run (Pool workers and their parent), callers in other
+processes find the leader's claim in a shared SQLite file and poll it until the
+result is written there; a process running alone never touches that file. If
+the leader fails, its claim is released and a waiting process takes over; if
+the leader process dies, its claim is taken over once the owner is gone or the
+lease has expired.
+
+Finished results are kept for SINGLEFLIGHT_LINGER_SECONDS so that processes that
+are still polling can read them, then removed. They are only returned to callers
+that were waiting on the flight: a request made after its flight finished is sent
+again, since reusing earlier results is the job of the response cache (utils.cache),
+which callers opt into.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+import weakref
+import multiprocessing
+from config import SINGLEFLIGHT_PATH, SINGLEFLIGHT_LEASE_SECONDS, SINGLEFLIGHT_LINGER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_single_flights = {}
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _shared():
+    # Pool workers have a parent process, and the parent has live children while the pool runs
+    return multiprocessing.parent_process() is not None or bool(multiprocessing.active_children())
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Shares the result of one upstream call among all concurrent callers with the same key.
+    """
+    def __init__(self, path=SINGLEFLIGHT_PATH, lease=SINGLEFLIGHT_LEASE_SECONDS, linger=SINGLEFLIGHT_LINGER_SECONDS):
+        self.path = path
+        self.lease = lease
+        self.linger = linger
+        self.saved = 0  # Calls saved in this process
+        self._pid = None
+        self._ensure_process()
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = self._connection()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS flights ("
+                "key TEXT PRIMARY KEY, owner INTEGER, started REAL, finished REAL, value TEXT)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO counters VALUES ('saved', 0)")
+
+    def _ensure_process(self):
+        # Connections, locks and in-flight calls must not be shared across forked processes
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = None
+            self._lock = threading.Lock()
+            self._calls = {}
+            self._async_calls = weakref.WeakKeyDictionary()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        return self._conn
+
+    def _count_saved(self):
+        with self._lock:
+            self.saved += 1
+            if self.path is not None:
+                self._connection().execute("UPDATE counters SET value = value + 1 WHERE name = 'saved'")
+
+    def _claim(self, key, waited=False):
+        """
+        Try to become the leader for a key across processes.
+        Returns (True, None) if claimed, (False, value) if the flight this caller `waited` on has finished,
+        else (False, None).
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM flights WHERE finished IS NOT NULL AND finished < ?", (now - self.linger,))
+                row = conn.execute("SELECT owner, started, finished, value FROM flights WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    owner, started, finished, value = row
+                    if finished is not None:
+                        if waited:
+                            conn.execute("COMMIT")
+                            return False, value
+                        # The flight finished before this caller arrived, so it starts a new one
+                    elif started + self.lease > now and _pid_alive(owner):
+                        conn.execute("COMMIT")
+                        return False, None
+                    else:
+                        logger.warning(f"Taking over stale in-flight request from process {owner}")
+                conn.execute(
+                    "INSERT OR REPLACE INTO flights VALUES (?, ?, ?, NULL, NULL)",
+                    (key, os.getpid(), now)
+                )
+                conn.execute("COMMIT")
+                return True, None
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _finish(self, key, value):
+        with self._lock:
+            conn = self._connection()
+            if value is None:
+                # Release the claim so that a waiting process can retry
+                conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, os.getpid()))
+            else:
+                conn.execute(
+                    "UPDATE flights SET finished = ?, value = ? WHERE key = ? AND owner = ?",
+                    (time.time(), value, key, os.getpid())
+                )
+
+    def _lead(self, key, fn):
+        if self.path is None or not _shared():
+            return fn()
+        poll_interval = 0.05
+        waited = False
+        while True:
+            claimed, value = self._claim(key, waited)
+            if claimed:
+                break
+            if value is not None:
+                self._count_saved()
+                return value
+            waited = True
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, 1.0)
+        output = None
+        try:
+            output = fn()
+            return output
+        finally:
+            self._finish(key, output)
+
+    def do(self, key, fn):
+        """
+        Return fn() for the first caller with `key`; concurrent callers with the same key share its result.
+        """
+        self._ensure_process()
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+        if not is_leader:
+            call.event.wait()
+            self._count_saved()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._lead(key, fn)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    async def _alead(self, key, coro_fn):
+        # The claim and its release are SQLite transactions, so they run in a thread rather than on the event loop
+        if self.path is None or not _shared():
+            return await coro_fn()
+        poll_interval = 0.05
+        waited = False
+        while True:
+            claimed, value = await asyncio.to_thread(self._claim, key, waited)
+            if claimed:
+                break
+            if value is not None:
+                await asyncio.to_thread(self._count_saved)
+                return value
+            waited = True
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, 1.0)
+        output = None
+        try:
+            output = await coro_fn()
+            return output
+        finally:
+            await asyncio.to_thread(self._finish, key, output)
+
+    async def ado(self, key, coro_fn):
+        """
+        Async counterpart of do: coro_fn is awaited by the first caller only.
+        """
+        self._ensure_process()
+        loop = asyncio.get_running_loop()
+        calls = self._async_calls.setdefault(loop, {})
+        if key in calls:
+            result = await asyncio.shield(calls[key])
+            await asyncio.to_thread(self._count_saved)
+            return result
+        future = loop.create_future()
+        calls[key] = future
+        try:
+            result = await self._alead(key, coro_fn)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when no other caller is waiting on it
+            future.exception()
+            raise
+        finally:
+            calls.pop(key, None)
+
+    def stats(self):
+        """
+        Return the number of upstream calls saved, in this process and across all processes.
+        """
+        stats = {"saved": self.saved}
+        if self.path is not None:
+            with self._lock:
+                stats["saved_all_processes"] = self._connection().execute(
+                    "SELECT value FROM counters WHERE name = 'saved'"
+                ).fetchone()[0]
+        return stats
+
+def get_single_flight(path=SINGLEFLIGHT_PATH):
+    """
+    Return the process-wide SingleFlight for a path (None keeps deduplication within the process).
+    """
+    if path not in _single_flights:
+        _single_flights[path] = SingleFlight(path)
+    return _single_flights[path]
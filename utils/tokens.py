@@ -0,0 +1,136 @@
+"""
+Local token counting and context-window fitting.
+
+Prompts are counted locally with tiktoken when it is installed (the encoding of
+the model if tiktoken knows it, o200k_base otherwise), or estimated at four
+characters per token. Counts for non-OpenAI models are approximate, so
+CONTEXT_WINDOW_MARGIN of every window is held back. tiktoken downloads an
+encoding the first time it is used, so load_tokenizer() loads the encodings once
+at startup, before any worker is forked, and warns if counts will be estimated.
+
+fit_interaction_log checks a prompt built around an interaction log against the
+model's window from CONTEXT_WINDOWS before it is sent, and applies an explicit
+policy when it does not fit: "skip" raises ContextLengthExceeded without a round
+trip, "truncate" drops the oldest sessions until it fits.
+"""
+import logging
+from functools import lru_cache
+from config import CONTEXT_WINDOWS, CONTEXT_WINDOW_MARGIN
+from utils.formatting import format_interaction_log
+
+logger = logging.getLogger(__name__)
+
+OVERSIZE_POLICIES = ["skip", "truncate"]
+
+class ContextLengthExceeded(Exception):
+    """
+    Raised before sending a prompt that does not fit the model's context window.
+    The message contains "context_length_exceeded", like the providers' own errors.
+    """
+    pass
+
+@lru_cache(maxsize=None)
+def _load_encoding(encoding_name):
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken is not installed; estimating token counts from characters")
+        return None
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(f"Could not load the tiktoken encoding {encoding_name} ({e}); estimating token counts from characters")
+        return None
+
+@lru_cache(maxsize=None)
+def _encoding(model_name):
+    try:
+        from tiktoken.model import encoding_name_for_model
+        encoding_name = encoding_name_for_model(model_name)
+    except (ImportError, KeyError):
+        encoding_name = "o200k_base"
+    # Models sharing an encoding share one loaded copy
+    return _load_encoding(encoding_name)
+
+def load_tokenizer(model_names=()):
+    """
+    Load the encodings used to count the prompts of the given models (and the default one) in this process.
+    Returns whether counts will be exact rather than estimated from characters.
+    """
+    return all([_encoding("") is not None] + [_encoding(model_name) is not None for model_name in model_names])
+
+def count_tokens(text, model_name=None):
+    """
+    Return the number of tokens in `text` for the model (exact for OpenAI models with tiktoken, estimated otherwise).
+    """
+    if not text:
+        return 0
+    encoding = _encoding(model_name or "")
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode_ordinary(text))
+
+def context_window(model_name):
+    """
+    Return the model's context window in tokens, or None if it is not listed in CONTEXT_WINDOWS.
+    The longest listed prefix of the model name matches, so dated model versions share an entry.
+    """
+    if model_name in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[model_name]
+    matches = [name for name in CONTEXT_WINDOWS if model_name.startswith(name)]
+    if not matches:
+        return None
+    return CONTEXT_WINDOWS[max(matches, key=len)]
+
+def prompt_budget(model_name, max_tokens):
+    """
+    Return how many prompt tokens fit next to a completion of `max_tokens`, or None if the window is unknown.
+    """
+    window = context_window(model_name)
+    if window is None:
+        return None
+    return int(window * (1 - CONTEXT_WINDOW_MARGIN)) - (max_tokens or 0)
+
+def fit_interaction_log(model_name, max_tokens, build_prompt, prior_interactions, policy="skip"):
+    """
+    Format the interaction log so that build_prompt(interaction_log), the full prompt text, fits the model's
+    context window. Returns (interaction_log, fit) where fit records the prompt size and any dropped sessions.
+    Raises ContextLengthExceeded if it does not fit under the policy.
+    """
+    if policy not in OVERSIZE_POLICIES:
+        raise Exception(f"Unknown oversize policy: {policy}")
+    interaction_log = format_interaction_log(prior_interactions)
+    budget = prompt_budget(model_name, max_tokens)
+    if budget is None:
+        return interaction_log, {"prompt_tokens": None, "sessions_dropped": 0}
+
+    n_tokens = count_tokens(build_prompt(interaction_log), model_name)
+    if n_tokens <= budget:
+        return interaction_log, {"prompt_tokens": n_tokens, "sessions_dropped": 0}
+    if policy == "skip":
+        raise ContextLengthExceeded(
+            f"context_length_exceeded: prompt has ~{n_tokens} tokens, {model_name} fits {budget} next to {max_tokens} output tokens"
+        )
+
+    # Drop the oldest sessions, estimating from per-session counts, then confirm on the re-formatted log
+    session_tokens = [count_tokens(format_interaction_log([session]), model_name) for session in prior_interactions]
+    excess = n_tokens - budget
+    n_dropped = 0
+    while n_dropped < len(prior_interactions):
+        excess -= session_tokens[n_dropped]
+        n_dropped += 1
+        if excess > 0 and n_dropped < len(prior_interactions):
+            continue
+        interaction_log = format_interaction_log(prior_interactions[n_dropped:])
+        n_tokens = count_tokens(build_prompt(interaction_log), model_name)
+        if n_tokens <= budget:
+            logger.info(f"Dropped the {n_dropped} oldest of {len(prior_interactions)} sessions to fit {model_name}'s context window")
+            return interaction_log, {
+                "prompt_tokens": n_tokens,
+                "sessions_dropped": n_dropped,
+                "sessions_kept": len(prior_interactions) - n_dropped
+            }
+        excess = n_tokens - budget
+    raise ContextLengthExceeded(
+        f"context_length_exceeded: the prompt without any prior sessions does not fit {model_name} ({budget} tokens)"
+    )
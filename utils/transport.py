@@ -0,0 +1,178 @@
+"""
+Shared HTTP connection pools for the provider clients.
+
+All provider SDK clients in a process send their requests through one pooled
+HTTP client (one per event loop for the async clients), configured by the HTTP_*
+settings in config.py: pool size, keep-alive, HTTP/2 and timeouts. Idle
+connections are kept alive long enough to bridge the gaps between pipeline
+stages, so a worker pays for the TCP/TLS handshake to a host once rather than
+after every pause.
+
+New connections and TLS handshakes are counted per host through the transport's
+trace hook. Each process flushes its counts to {directory}/http/{pid}.json and
+aggregate_http_stats() combines them, which shows how often requests reused a
+pooled connection.
+
+A request made by a provider call under a deadline (see utils.hedging) has its
+timeouts capped at the time left before that deadline, so a call abandoned by a
+hedge or a deadline does not hold its thread and connection until the read timeout.
+"""
+import os
+import json
+import asyncio
+import logging
+import threading
+import weakref
+import importlib.util
+from config import (
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP2,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT
+)
+
+try:
+    # Recent openai/anthropic SDKs are built on httpx2 and only accept its clients
+    import httpx2 as httpx
+except ImportError:
+    import httpx
+
+from utils.hedging import call_timeout
+
+logger = logging.getLogger(__name__)
+
+STAT_FIELDS = ["requests", "connections", "tls_handshakes"]
+
+_stats = {}
+_stats_lock = threading.Lock()
+_client = None
+_client_pid = None
+_async_clients = weakref.WeakKeyDictionary()
+
+def _count(host, field):
+    with _stats_lock:
+        counts = _stats.setdefault(host, {name: 0 for name in STAT_FIELDS})
+        counts[field] += 1
+
+def _trace_event(host, name):
+    if name == "connection.connect_tcp.complete":
+        _count(host, "connections")
+    elif name == "connection.start_tls.complete":
+        _count(host, "tls_handshakes")
+
+def _cap_timeout(request):
+    remaining = call_timeout()
+    if remaining is None:
+        return
+    timeout = request.extensions.get("timeout") or dict.fromkeys(["connect", "read", "write", "pool"])
+    request.extensions["timeout"] = {
+        name: remaining if value is None else min(value, remaining) for name, value in timeout.items()
+    }
+
+class TracingTransport(httpx.HTTPTransport):
+    """
+    Transport that counts requests, new connections and TLS handshakes per host,
+    and caps the timeouts of requests made under a call deadline.
+    """
+    def handle_request(self, request):
+        host = request.url.host
+        _count(host, "requests")
+        _cap_timeout(request)
+        request.extensions["trace"] = lambda name, info: _trace_event(host, name)
+        return super().handle_request(request)
+
+class AsyncTracingTransport(httpx.AsyncHTTPTransport):
+    """
+    Async counterpart of TracingTransport.
+    """
+    async def handle_async_request(self, request):
+        host = request.url.host
+        _count(host, "requests")
+        _cap_timeout(request)
+
+        async def trace(name, info):
+            _trace_event(host, name)
+
+        request.extensions["trace"] = trace
+        return await super().handle_async_request(request)
+
+def _transport_options():
+    http2 = HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP/2 is enabled but the h2 package is not installed (pip install httpx[http2]); using HTTP/1.1")
+        http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    }
+
+def _timeout():
+    return httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+def get_http_client():
+    """
+    Return the pooled HTTP client shared by all provider clients in this process.
+    """
+    global _client, _client_pid
+    if _client_pid != os.getpid():
+        # Connections inherited through fork share sockets with the parent
+        _client = httpx.Client(transport=TracingTransport(**_transport_options()), timeout=_timeout())
+        _client_pid = os.getpid()
+    return _client
+
+def get_async_http_client():
+    """
+    Return the pooled async HTTP client shared by all async provider clients in the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = httpx.AsyncClient(transport=AsyncTracingTransport(**_transport_options()), timeout=_timeout())
+    return _async_clients[loop]
+
+def http_stats():
+    """
+    Return this process's per-host request, connection and TLS handshake counts.
+    """
+    with _stats_lock:
+        return {host: dict(counts) for host, counts in _stats.items()}
+
+def flush_http_stats(directory):
+    """
+    Write this process's per-host counts to {directory}/http/{pid}.json.
+    Counts are cumulative for the process, so the file is overwritten rather than appended to.
+    """
+    stats = http_stats()
+    if not stats:
+        return
+    stats_dir = os.path.join(directory, "http")
+    os.makedirs(stats_dir, exist_ok=True)
+    path = os.path.join(stats_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(stats, f)
+    os.replace(path + ".tmp", path)
+
+def aggregate_http_stats(directory):
+    """
+    Combine the flushed per-process counts under {directory}/http, with the connection reuse rate per host.
+    """
+    stats_dir = os.path.join(directory, "http")
+    by_host = {}
+    if os.path.isdir(stats_dir):
+        for filename in os.listdir(stats_dir):
+            if not filename.endswith(".json"):
+                continue
+            with open(os.path.join(stats_dir, filename), "r") as f:
+                stats = json.load(f)
+            for host, counts in stats.items():
+                totals = by_host.setdefault(host, {name: 0 for name in STAT_FIELDS})
+                for field in STAT_FIELDS:
+                    totals[field] += counts.get(field, 0)
+    for totals in by_host.values():
+        totals["reuse_rate"] = 1 - totals["connections"] / totals["requests"] if totals["requests"] > 0 else 0
+    return by_host
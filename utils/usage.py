@@ -0,0 +1,227 @@
+"""
+Token usage and cost accounting for LLM calls.
+
+Token counts are read from the usage metadata that every provider already
+returns with its response, so accounting costs no extra requests. Counts are
+buffered in memory per process, grouped by pipeline stage and model, and
+flushed as one line per flush to a per-process file, so concurrent workers
+never write to the same file. aggregate_usage() combines those files into
+per-stage/per-model totals with a cost estimate from MODEL_PRICES.
+When one process evaluates several models, usage_scope() tags the usage of each
+evaluation so that flush_usage() writes it to that evaluation's directory only.
+
+Usage:
+    with usage_stage("matching"):
+        matcher(checklist, preference)
+    flush_usage(f"{results_dir}/{model_name}")
+"""
+import os
+import json
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from config import MODEL_PRICES, BATCH_PRICE_FACTOR
+
+logger = logging.getLogger(__name__)
+
+USAGE_FIELDS = ["requests", "input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens"]
+
+_current_stage = contextvars.ContextVar("usage_stage", default="default")
+_current_scope = contextvars.ContextVar("usage_scope", default=None)
+_deferred = contextvars.ContextVar("deferred_usage", default=None)
+_buffer = {}
+_lock = threading.Lock()
+# Serializes appends to the usage files, which the async drivers flush from several threads
+_write_lock = threading.Lock()
+
+@contextmanager
+def usage_stage(stage):
+    """
+    Attribute the usage of all LLM calls made inside the block to `stage`.
+    """
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+@contextmanager
+def usage_scope(scope):
+    """
+    Attribute the usage of all LLM calls made inside the block to the evaluation `scope`
+    (e.g. the evaluated model of a multi-model run), to be flushed with flush_usage(directory, scope).
+    """
+    token = _current_scope.set(scope)
+    try:
+        yield
+    finally:
+        _current_scope.reset(token)
+
+@contextmanager
+def deferred_usage():
+    """
+    Collect the usage recorded inside the block in the yielded list instead of the buffer,
+    to be added with commit_usage() (e.g. only for the call that won a hedge).
+    """
+    pending = []
+    token = _deferred.set(pending)
+    try:
+        yield pending
+    finally:
+        _deferred.reset(token)
+
+def commit_usage(pending):
+    """
+    Add usage collected by deferred_usage() to this process's buffer.
+    """
+    with _lock:
+        for key, usage in pending:
+            _add(key, usage)
+
+def current_usage_stage():
+    return _current_stage.get()
+
+def extract_usage(provider, response):
+    """
+    Read token counts from a provider response object.
+    input_tokens always counts the whole prompt; cache_read_tokens and cache_write_tokens
+    are the parts of it served from and written to the provider's prompt cache.
+    """
+    usage = {field: 0 for field in USAGE_FIELDS}
+    usage["requests"] = 1
+    if provider == "gemini":
+        metadata = getattr(response, 'usage_metadata', None)
+        if metadata is not None:
+            usage["input_tokens"] = metadata.prompt_token_count or 0
+            usage["output_tokens"] = (metadata.candidates_token_count or 0) + (getattr(metadata, 'thoughts_token_count', None) or 0)
+            usage["cache_read_tokens"] = getattr(metadata, 'cached_content_token_count', None) or 0
+    elif provider in ["anthropic", "anthropic_bedrock"]:
+        metadata = getattr(response, 'usage', None)
+        if metadata is not None:
+            # Anthropic reports cached prompt tokens separately from input_tokens
+            usage["cache_read_tokens"] = getattr(metadata, 'cache_read_input_tokens', None) or 0
+            usage["cache_write_tokens"] = getattr(metadata, 'cache_creation_input_tokens', None) or 0
+            usage["input_tokens"] = (metadata.input_tokens or 0) + usage["cache_read_tokens"] + usage["cache_write_tokens"]
+            usage["output_tokens"] = metadata.output_tokens or 0
+    else:
+        # OpenAI-compatible APIs (OpenAI, Together, vLLM)
+        metadata = getattr(response, 'usage', None)
+        if metadata is not None:
+            usage["input_tokens"] = metadata.prompt_tokens or 0
+            usage["output_tokens"] = metadata.completion_tokens or 0
+            details = getattr(metadata, 'prompt_tokens_details', None)
+            if details is not None:
+                usage["cache_read_tokens"] = getattr(details, 'cached_tokens', None) or 0
+    return usage
+
+def add_usage(model_name, usage, stage=None):
+    """
+    Add already-extracted token counts to this process's buffer.
+    """
+    key = (_current_scope.get(), stage or _current_stage.get(), model_name)
+    pending = _deferred.get()
+    if pending is not None:
+        pending.append((key, usage))
+        return
+    with _lock:
+        _add(key, usage)
+
+def _add(key, usage):
+    totals = _buffer.setdefault(key, {field: 0 for field in USAGE_FIELDS})
+    for field, value in usage.items():
+        totals[field] = totals.get(field, 0) + value
+
+def record_usage(provider, model_name, response):
+    """
+    Record the usage reported in a provider response. Never raises: accounting must not fail a generation.
+    """
+    try:
+        add_usage(model_name, extract_usage(provider, response))
+    except Exception as e:
+        logger.warning(f"Failed to record usage for {model_name}: {e}")
+
+def record_stream_usage(provider, model_name, response, estimate, stopped):
+    """
+    Record the usage of a streamed request. A stream closed early never receives the provider's
+    final usage, so the `estimate` token counts are recorded instead. Never raises.
+    """
+    try:
+        if response is not None:
+            usage = extract_usage(provider, response)
+        else:
+            usage = {"requests": 1, **estimate}
+        if stopped:
+            usage["early_stops"] = 1
+        add_usage(model_name, usage)
+    except Exception as e:
+        logger.warning(f"Failed to record usage for {model_name}: {e}")
+
+def flush_usage(directory, scope=None):
+    """
+    Append this process's buffered usage to {directory}/usage/{pid}.jsonl and clear it from the buffer.
+    With a scope, only the usage of that scope (and usage recorded outside any scope) is flushed.
+    """
+    with _lock:
+        keys = [key for key in _buffer if key[0] is None or key[0] == scope]
+        if not keys:
+            return
+        entries = [
+            {"stage": stage, "model": model_name, **_buffer.pop((key_scope, stage, model_name))}
+            for key_scope, stage, model_name in keys
+        ]
+    usage_dir = os.path.join(directory, "usage")
+    os.makedirs(usage_dir, exist_ok=True)
+    with _write_lock, open(os.path.join(usage_dir, f"{os.getpid()}.jsonl"), "a") as f:
+        f.write(json.dumps(entries) + "\n")
+
+def estimate_cost(model_name, totals):
+    """
+    Estimate the cost in USD of the given token totals, or None if the model has no listed price.
+    """
+    prices = MODEL_PRICES.get(model_name)
+    if prices is None:
+        return None
+    # Prompt tokens read from or written to a provider's prompt cache are billed at their own rates
+    cache_read = totals.get("cache_read_tokens", 0)
+    cache_write = totals.get("cache_write_tokens", 0)
+    cost = (totals["input_tokens"] - cache_read - cache_write) * prices["input"] + totals["output_tokens"] * prices["output"]
+    cost += cache_read * prices.get("cache_read", prices["input"]) + cache_write * prices.get("cache_write", prices["input"])
+    # Tokens processed through a provider batch API are billed at a discount
+    discount = 1 - BATCH_PRICE_FACTOR
+    cost -= discount * (totals.get("batch_input_tokens", 0) * prices["input"] + totals.get("batch_output_tokens", 0) * prices["output"])
+    return cost / 1e6
+
+def aggregate_usage(directory):
+    """
+    Combine all flushed usage under {directory}/usage into per-stage/per-model totals with cost estimates.
+    """
+    usage_dir = os.path.join(directory, "usage")
+    by_stage = {}
+    if os.path.isdir(usage_dir):
+        for filename in os.listdir(usage_dir):
+            with open(os.path.join(usage_dir, filename), "r") as f:
+                for line in f:
+                    try:
+                        entries = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A worker killed mid-write leaves at most one partial line
+                        continue
+                    for entry in entries:
+                        totals = by_stage.setdefault(entry["stage"], {}).setdefault(
+                            entry["model"], {field: 0 for field in USAGE_FIELDS}
+                        )
+                        for field, value in entry.items():
+                            if field not in ["stage", "model"]:
+                                totals[field] = totals.get(field, 0) + value
+
+    total = {field: 0 for field in USAGE_FIELDS}
+    total["cost"] = 0
+    for stage, models in by_stage.items():
+        for model_name, totals in models.items():
+            totals["cost"] = estimate_cost(model_name, totals)
+            for field, value in totals.items():
+                if field != "cost":
+                    total[field] = total.get(field, 0) + value
+            total["cost"] += totals["cost"] or 0
+    return {"total": total, "by_stage": by_stage}